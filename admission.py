@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+import random
+from twisted.internet import reactor
+from twisted.internet.interfaces import IReactorTime, IDelayedCall
+from shared import METRICS
+
+__author__ = 'larryhou'
+
+ADMISSION_RATE = 200.0
+ADMISSION_BURST = 400
+MAX_HANDSHAKES = 128
+HANDSHAKE_TIMEOUT = 30.0
+
+class TokenBucket(object):
+    def __init__(self, rate, burst, clock=reactor):
+        self.rate = float(rate)
+        self.burst = float(max(1, burst))
+        self.tokens = self.burst
+        self.clock = clock
+
+    @property
+    def clock(self): return self.__clock # type: IReactorTime
+
+    @clock.setter
+    def clock(self, clock): # type: (IReactorTime)->None
+        self.__clock = clock
+        self.__stamp = clock.seconds()
+
+    def __refill(self):
+        now = self.__clock.seconds()
+        self.tokens = min(self.burst, self.tokens + (now - self.__stamp) * self.rate)
+        self.__stamp = now
+
+    def take(self): # type: ()->bool
+        self.__refill()
+        if self.tokens < 1: return False
+        self.tokens -= 1
+        return True
+
+class AdmissionControl(object):
+    # after a queen restart every slave comes back within seconds, handshakes are let through at a steady rate with
+    # a cap on how many may wait for their inventory at once, the rest are told when to come back
+    def __init__(self, clock=reactor, rate=ADMISSION_RATE, burst=ADMISSION_BURST, max_handshakes=MAX_HANDSHAKES,
+                 jitter=0.2, min_delay=0.5, timeout=HANDSHAKE_TIMEOUT):
+        self.bucket = TokenBucket(rate, burst, clock=clock) if rate > 0 else None
+        self.__clock = clock # type: IReactorTime
+        self.max_handshakes = max_handshakes
+        self.jitter = jitter
+        self.min_delay = min_delay
+        self.timeout = timeout
+        self.admitted = 0
+        self.deferred = 0
+        self.__handshakes = {} # type: dict[any, tuple[float, IDelayedCall]]
+        self.__average = 0.0
+        self.__next_slot = 0.0
+
+    @property
+    def clock(self): return self.__clock # type: IReactorTime
+
+    @clock.setter
+    def clock(self, clock): # type: (IReactorTime)->None
+        self.__clock = clock
+        if self.bucket: self.bucket.clock = clock
+
+    def __len__(self):
+        return len(self.__handshakes)
+
+    def __full(self):
+        return 0 < self.max_handshakes <= len(self.__handshakes)
+
+    def admit(self, key, cheap=False): # type: (any, bool)->float
+        # zero when the handshake may go on, otherwise the seconds the slave should wait before asking again,
+        # cheap handshakes only trade digests and are let through, they still count against the others
+        if key in self.__handshakes: return 0.0
+        if cheap or not self.__full() and (not self.bucket or self.bucket.take()):
+            self.begin(key)
+            return 0.0
+        self.deferred += 1
+        METRICS.inc('handshakes', label='deferred')
+        return self.__retry_delay()
+
+    def __retry_delay(self): # type: ()->float
+        # deferred slaves get evenly spaced slots at what the queen gets through, the jitter keeps those
+        # that were told the same slot from landing on the same tick
+        interval = 1.0 / self.bucket.rate if self.bucket else 0.0
+        if self.max_handshakes > 0: interval = max(interval, self.__average / self.max_handshakes)
+        now = self.clock.seconds()
+        self.__next_slot = max(now, self.__next_slot) + interval
+        delay = max(self.min_delay, self.__next_slot - now)
+        return round(delay * random.uniform(1.0, 1.0 + self.jitter), 3)
+
+    def begin(self, key):
+        # slaves that cannot be asked to wait still take a slot, so they are counted against the others
+        if key in self.__handshakes: return
+        self.admitted += 1
+        METRICS.inc('handshakes', label='admitted')
+        call = self.clock.callLater(self.timeout, self.release, key, 'timeout') if self.timeout > 0 else None
+        self.__handshakes[key] = self.clock.seconds(), call
+
+    def release(self, key, outcome='done'): # type: (any, str)->float
+        handshake = self.__handshakes.pop(key, None)
+        if not handshake: return None
+        start, call = handshake
+        if call and call.active(): call.cancel()
+        elapse = self.clock.seconds() - start
+        if outcome == 'done':
+            self.__average = elapse if not self.__average else self.__average * 0.9 + elapse * 0.1
+            METRICS.observe('handshake_us', elapse * 1e6)
+        else: METRICS.inc('handshakes', label=outcome)
+        return elapse
+
+    def describe(self): # type: ()->dict
+        return {'handshakes': len(self.__handshakes), 'admitted': self.admitted, 'deferred': self.deferred,
+                'tokens': round(self.bucket.tokens, 1) if self.bucket else None, 'average': round(self.__average, 4)}
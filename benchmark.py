@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+from twisted.internet.endpoints import IPv4Address
+from shared import *
+from serialization import decode_system_information
+import random, time, json, socket, threading
+
+__author__ = 'larryhou'
+
+class FrameCounter(TCP):
+    def __init__(self):
+        super(FrameCounter, self).__init__(address=IPv4Address('TCP', '127.0.0.1', 0), verbose=False)
+        self.frames = 0
+        self.bytes = 0
+
+    def frameReceived(self, flags, data):
+        self.frames += 1
+        self.bytes += len(data)
+
+class NullTransport(object):
+    def __init__(self):
+        self.writes = 0
+        self.bytes = 0
+
+    def write(self, data):
+        self.writes += 1
+        self.bytes += len(data)
+
+    def writeSequence(self, sequence):
+        for data in sequence: self.write(data)
+
+    def registerProducer(self, producer, streaming):
+        pass
+
+    def unregisterProducer(self):
+        pass
+
+def make_connections(count, codec=JSONCodec, compression=None):
+    connections = []
+    for n in range(count):
+        connection = TCP(address=IPv4Address('TCP', '127.0.0.1', 10000 + n), verbose=False)
+        connection.codec = codec
+        connection.compression = compression
+        connection.transport = NullTransport()
+        connections.append(connection)
+    return connections
+
+def make_frame(size):
+    return FRAME_HEADER.pack(TRANSPORT_MAGIC_NUMBER, size + FRAME_HEADER_SIZE) + b'x' * size
+
+def split_chunks(stream, rng, min_chunk, max_chunk):
+    view = memoryview(stream)
+    offset = 0
+    while offset < len(view):
+        step = rng.randint(min_chunk, max_chunk)
+        yield bytes(view[offset:offset + step])
+        offset += step
+
+def bench_decoder(options):
+    rng = random.Random(options.seed)
+    report = []
+    for size in options.sizes:
+        frame = make_frame(size)
+        count = max(1, options.volume // len(frame))
+        stream = frame * count
+        for min_chunk, max_chunk in ((1, 64), (512, 16 << 10), (16 << 10, 256 << 10)):
+            if len(stream) // min_chunk > options.max_chunks: continue
+            chunks = list(split_chunks(stream, rng, min_chunk, max_chunk))
+            protocol = FrameCounter()
+            protocol.max_frame_size = max(MAX_FRAME_SIZE, len(frame))
+            elapse = time.perf_counter()
+            for chunk in chunks: protocol.dataReceived(chunk)
+            elapse = time.perf_counter() - elapse
+            assert protocol.frames == count and protocol.bytes == count * size
+            report.append({'frame': size, 'frames': count, 'chunks': len(chunks),
+                           'chunk_range': [min_chunk, max_chunk], 'seconds': round(elapse, 6),
+                           'MB/s': round(len(stream) / (1 << 20) / elapse, 2)})
+            print(json.dumps(report[-1]))
+    return report
+
+def sample_hardware(seed):
+    return {'Hardware': {'HardwareOverview': {
+        'ModelName': 'Mac Pro', 'ModelIdentifier': 'MacPro7,1', 'ProcessorName': '16-Core Intel Xeon W',
+        'ProcessorSpeed': '3.2 GHz', 'NumberofProcessors': '1', 'TotalNumberofCores': '16',
+        'L2Cache(perCore)': '1 MB', 'L3Cache': '22 MB', 'Memory': '96 GB', 'BootROMVersion': '1554.80.3.0.0',
+        'SerialNumber(system)': 'F5KZ{:08d}'.format(seed), 'HardwareUUID': '{:08X}-0000-0000-0000-000000000000'.format(seed)}}}
+
+def sample_storage(seed, volumes=4):
+    storage = {}
+    for n in range(volumes):
+        storage['Volume{}'.format(n)] = {
+            'Available': '{}.{} GB (123,456,789,012 bytes)'.format(seed % 900, n), 'Capacity': '1 TB (1,000,000,000,000 bytes)',
+            'MountPoint': '/Volumes/Volume{}'.format(n), 'FileSystem': 'APFS', 'Writable': 'Yes', 'Ignore Ownership': 'No',
+            'BSDName': 'disk1s{}'.format(n), 'VolumeUUID': '{:08X}-1111-2222-3333-{:012X}'.format(seed, n),
+            'PhysicalDrive': {'DeviceName': 'APPLE SSD AP1024M', 'MediaName': 'AppleAPFSMedia', 'MediumType': 'SSD',
+                              'Protocol': 'PCI-Express', 'Internal': 'Yes', 'PartitionMapType': 'Unknown', 'S.M.A.R.T.Status': 'Verified'}}
+    return {'Storage': storage}
+
+def sample_network(seed):
+    return {'Network': {'Ethernet': {
+        'Type': 'Ethernet', 'Hardware': 'Ethernet', 'BSDDeviceName': 'en0',
+        'IPv4Addresses': '10.0.{}.{}'.format(seed >> 8 & 0xFF, seed & 0xFF),
+        'IPv4': {'Addresses': '10.0.0.1', 'ConfigurationMethod': 'DHCP', 'InterfaceName': 'en0', 'SubnetMasks': '255.255.255.0'},
+        'DNS': {'ServerAddresses': '10.0.0.2, 10.0.0.3'}, 'Proxies': {'ExceptionsList': '*.local, 169.254/16', 'FTPPassiveMode': 'Yes'},
+        'Ethernet': {'MACAddress': '3c:22:fb:{:02x}:{:02x}:00'.format(seed >> 8 & 0xFF, seed & 0xFF), 'MediaOptions': 'Full Duplex', 'MediaSubtype': '1000baseT'}}}}
+
+def sample_usb(seed, devices=24):
+    return {'USB': {'USB3.1Bus': {'HostControllerDriver': 'AppleUSBXHCITR', 'PCIDeviceID': '0x15ec', 'PCIRevisionID': '0x0006',
+        'PCIVendorID': '0x8086', 'BusNumber': '0x00',
+        'Devices': {'Device{}'.format(n): {'ProductID': '0x{:04x}'.format(n), 'VendorID': '0x05ac (Apple Inc.)', 'Version': '1.00',
+                                            'Speed': 'Up to 480 Mb/s', 'Manufacturer': 'Apple Inc.', 'LocationID': '0x{:08x}'.format(seed + n),
+                                            'CurrentAvailable(mA)': '500', 'ExtraOperatingCurrent(mA)': '0'} for n in range(devices)}}}}
+
+def sample_memory(seed):
+    return {'total': 98304.0, 'available': 61234.5 + seed % 100, 'percent': 37.7, 'used': 30120.25, 'free': 2048.0,
+            'active': 29000.75, 'inactive': 28000.5, 'wired': 1200.0, 'unit': 'MB'}
+
+def sample_messages(fleet=100):
+    stime = time.time()
+    heartbeat = {'retcode': 0, 'command': Commands.HEARTBEAT_REQ, 'data': {'ts': stime}, 'ts': stime}
+    mission = {'retcode': 0, 'command': Commands.COLLABORATE_MISSION_REQ, 'ts': stime,
+               'data': {'id': 7, 'mission': CollaborateMissions.REPORT_SYSTEM_STATS, 'mission_timeout': 10.0}}
+    performance = {'retcode': 0, 'command': Commands.COLLABORATE_COMPLETE_REQ, 'ts': stime,
+                   'data': {'cpu': 12.5, 'mem': sample_memory(0), 'id': 7, 'mission': CollaborateMissions.REPORT_PERFORMANCE_STATS,
+                            'mission_timeout': 10.0, 'stime': stime, 'etime': stime + 0.01}}
+    artifacts = []
+    for n in range(fleet):
+        item = {'client': {'address': '10.0.0.{}'.format(n % 255), 'port': 50000 + n}, 'User': 'larryhou',
+                'Machine': 'mac-{}.local'.format(n), 'CPU': 10.0 + n % 50, 'MEM': sample_memory(n),
+                'Address': '10.0.0.{}'.format(n % 255), 'id': n, 'mission': CollaborateMissions.REPORT_SYSTEM_STATS,
+                'mission_timeout': 10.0, 'stime': stime, 'etime': stime + 0.5}
+        item.update(sample_hardware(n))
+        item.update(sample_storage(n))
+        item['Network'] = sample_network(n)['Network']['Ethernet']
+        artifacts.append(item)
+    notify = {'retcode': 0, 'command': Commands.COLLABORATE_NOTIFY, 'data': artifacts, 'ts': stime}
+    information = {'uname': 'Darwin mac-0.local 19.6.0 Darwin Kernel Version 19.6.0 x86_64', 'whoami': 'larryhou',
+                   'SPHardwareDataType': sample_hardware(0), 'SPStorageDataType': sample_storage(0, volumes=12),
+                   'SPNetworkDataType': sample_network(0), 'SPDisplaysDataType': {}, 'SPUSBDataType': sample_usb(0)}
+    system = {'retcode': 0, 'command': Commands.SYSTEM_INFORMATION_NOTIFY, 'data': information, 'ts': stime}
+    return {'heartbeat': heartbeat, 'collaborate_mission': mission, 'performance_stats': performance,
+            'collaborate_notify_x{}'.format(fleet): notify, 'system_information': system}
+
+def measure(func, repeat, *args):
+    elapse = time.perf_counter()
+    for _ in range(repeat): func(*args)
+    return (time.perf_counter() - elapse) / repeat
+
+def bench_codec(options):
+    report = []
+    for name, message in sample_messages(fleet=options.fleet).items():
+        for codec in CODECS:
+            encoded = codec.encode(message)
+            assert codec.decode(memoryview(encoded)) == message
+            repeat = max(10, options.budget // len(encoded))
+            report.append({'message': name, 'codec': codec.name, 'bytes': len(encoded),
+                           'encode_us': round(measure(codec.encode, repeat, message) * 1e6, 2),
+                           'decode_us': round(measure(codec.decode, repeat, memoryview(encoded)) * 1e6, 2)})
+            print(json.dumps(report[-1]))
+    if len(CODECS) == 1: print('msgpack is not installed, only json was measured')
+    return report
+
+def bench_compression(options):
+    report = []
+    for name, message in sample_messages(fleet=options.fleet).items():
+        for codec in CODECS:
+            encoded = codec.encode(message)
+            for level in options.levels:
+                compression = ZlibCompression(level=level)
+                compressed = compression.compress(encoded)
+                repeat = max(5, options.budget // len(encoded))
+                compress_cost = measure(compression.compress, repeat, encoded)
+                decompress_cost = measure(compression.decompress, repeat, memoryview(compressed), MAX_FRAME_SIZE)
+                item = {'message': name, 'codec': codec.name, 'level': level, 'bytes': len(encoded),
+                        'compressed': len(compressed), 'ratio': round(len(encoded) / len(compressed), 2),
+                        'compress_us': round(compress_cost * 1e6, 2), 'decompress_us': round(decompress_cost * 1e6, 2)}
+                # positive gain means compression pays for itself on a link of that bandwidth
+                for mbps in options.bandwidth:
+                    saved = (len(encoded) - len(compressed)) * 8 / (mbps * 1e6)
+                    item['gain_us@{}Mbps'.format(mbps)] = round((saved - compress_cost - decompress_cost) * 1e6, 2)
+                report.append(item)
+                print(json.dumps(item))
+    return report
+
+def bench_fanout(options):
+    report = []
+    messages = sample_messages(fleet=options.fleet)
+    chat = {'sender': {'ip': '10.0.0.1', 'port': 50000}, 'msg': 'Hi~', 'type': Broadcasts.CHAT}
+    payloads = {'broadcast_chat': (Commands.BROADCAST_NOTIFY, chat),
+                'collaborate_notify_x{}'.format(options.fleet): (Commands.COLLABORATE_NOTIFY, messages['collaborate_notify_x{}'.format(options.fleet)]['data'])}
+    for name, (command, data) in payloads.items():
+        for codec in CODECS:
+            for count in options.recipients:
+                connections = make_connections(count, codec=codec, compression=ZlibCompression() if options.compress else None)
+                repeat = max(1, options.budget // count)
+                naive = measure(lambda: [x.send(command, data) for x in connections], repeat)
+                shared = measure(fanout, repeat, connections, command, data)
+                report.append({'message': name, 'codec': codec.name, 'recipients': count,
+                               'send_per_second': round(count / naive), 'fanout_per_second': round(count / shared),
+                               'speedup': round(naive / shared, 2)})
+                print(json.dumps(report[-1]))
+    return report
+
+class CountingSocket(object):
+    def __init__(self, sock):
+        self.sock = sock # type: socket.socket
+        self.sends = 0
+
+    def send(self, data, *args):
+        self.sends += 1
+        return self.sock.send(data, *args)
+
+    def sendall(self, data): # counts the send calls sendall makes on its own
+        with memoryview(data) as view:
+            offset = 0
+            while offset < len(view): offset += self.send(view[offset:])
+
+    def __getattr__(self, name):
+        return getattr(self.sock, name)
+
+class DrainServer(object):
+    def __init__(self):
+        self.sock = socket.socket()
+        self.sock.bind(('127.0.0.1', 0))
+        self.sock.listen(8)
+        self.port = self.sock.getsockname()[1]
+        self.done = threading.Event()
+
+    def expect(self, size): # type: (int)->None
+        self.done.clear()
+        threading.Thread(target=self.__drain, args=(size,), daemon=True).start()
+
+    def __drain(self, size):
+        connection, _ = self.sock.accept()
+        with connection:
+            received = 0
+            while received < size:
+                data = connection.recv(1 << 20)
+                if not data: break
+                received += len(data)
+        self.done.set()
+
+def tcp_segments(): # host wide, so the acks of the receiving side are counted too
+    try:
+        with open('/proc/net/snmp') as fp:
+            rows = [x.split() for x in fp if x.startswith('Tcp:')]
+        return int(rows[1][rows[0].index('OutSegs')])
+    except (IOError, ValueError, IndexError):
+        return None
+
+def write_frames(sock, frames, split):
+    for frame in frames:
+        if split: # magic, length and body one by one as TCP.send used to
+            sock.sendall(frame[:4])
+            sock.sendall(frame[4:FRAME_HEADER_SIZE])
+            sock.sendall(frame[FRAME_HEADER_SIZE:])
+        else:
+            sock.sendall(frame)
+
+def bench_writes(options):
+    from twisted.internet import reactor, defer, task
+    from twisted.internet.protocol import Factory
+    from twisted.internet.endpoints import TCP4ClientEndpoint
+    report = []
+    messages = sample_messages(fleet=1)
+    shapes = [messages[x] for x in ('heartbeat', 'collaborate_mission', 'performance_stats')]
+    frames = []
+    for n in range(options.frames):
+        frames.append(TCP(address=IPv4Address('TCP', '127.0.0.1', 0), verbose=False).encode_frame(shapes[n % len(shapes)]))
+    total = sum(len(x) for x in frames)
+    server = DrainServer()
+
+    class WriterFactory(Factory):
+        def buildProtocol(self, addr):
+            return TCP(address=addr, verbose=False)
+
+    @defer.inlineCallbacks
+    def run():
+        for mode in ('split', 'frame', 'transport'):
+            for burst in options.bursts:
+                if mode != 'transport' and burst != options.bursts[0]: continue # turns do not matter to blocking sends
+                server.expect(total)
+                segments, elapse = tcp_segments(), time.perf_counter()
+                if mode == 'transport':
+                    protocol = yield TCP4ClientEndpoint(reactor, '127.0.0.1', server.port).connect(WriterFactory())
+                    sock = protocol.transport.socket = CountingSocket(protocol.transport.socket)
+                    for n in range(0, len(frames), burst):
+                        for frame in frames[n:n + burst]: protocol.write_frame(frame)
+                        yield task.deferLater(reactor, 0, lambda: None) # next reactor turn
+                    while not server.done.is_set(): yield task.deferLater(reactor, 0.0005, lambda: None)
+                    protocol.transport.loseConnection()
+                else:
+                    sock = CountingSocket(socket.create_connection(('127.0.0.1', server.port)))
+                    write_frames(sock, frames, split=mode == 'split')
+                    server.done.wait()
+                    sock.close()
+                elapse = time.perf_counter() - elapse
+                item = {'mode': mode, 'frames_per_turn': burst if mode == 'transport' else 1, 'frames': len(frames),
+                        'bytes': total, 'sends': sock.sends, 'sends_per_frame': round(sock.sends / len(frames), 3)}
+                if segments is not None: item['segments'] = tcp_segments() - segments
+                item.update({'seconds': round(elapse, 4), 'frames_per_second': round(len(frames) / elapse),
+                             'MB/s': round(total / (1 << 20) / elapse, 2)})
+                report.append(item)
+                print(json.dumps(item))
+
+    def stop(result):
+        if isinstance(result, defer.Failure): result.printTraceback()
+        reactor.stop()
+    reactor.callWhenRunning(lambda: run().addBoth(stop))
+    reactor.run()
+    return report
+
+def render_profiler_text(tree, indent=0): # type: (dict, int)->list[str]
+    lines = []
+    for name, value in tree.items():
+        if isinstance(value, dict):
+            lines.append('{}{}:'.format(' ' * indent, name))
+            lines.append('')
+            lines.extend(render_profiler_text(value, indent + 4 if indent else 4))
+        else:
+            lines.append('{}{}: {}'.format(' ' * indent, name, value))
+    return lines
+
+def sample_profiler_text(size):
+    sections, n = [], 0
+    while sum(len(x) for x in sections) < size:
+        usb = sample_usb(n, devices=64)
+        storage = sample_storage(n, volumes=32)
+        sections.append('\n'.join(render_profiler_text(usb) + render_profiler_text(storage)) + '\n')
+        n += 1
+    return ''.join(sections)
+
+def fixture_profiler_text(): # type: ()->dict[str, str]
+    # the system_profiler fixtures the golden tests check against
+    import gzip, glob, os
+    texts = {}
+    for path in sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'tests', 'fixtures', '*.txt.gz'))):
+        with gzip.open(path, 'rt', encoding='utf-8') as fp: texts[os.path.basename(path)[:-7]] = fp.read()
+    return texts
+
+def bench_profiler(options):
+    import io
+    report = []
+    inputs = [(None, sample_profiler_text(x)) for x in options.sizes] + list(fixture_profiler_text().items())
+    for fixture, text in inputs:
+        expect = decode_system_information(text)
+        assert decode_system_information(io.StringIO(text)) == expect
+        section = 'USB' if 'USB' in expect else list(expect)[0]
+        cases = {'text': lambda: decode_system_information(text),
+                 'stream': lambda: decode_system_information(io.StringIO(text)),
+                 'sections=' + section: lambda: decode_system_information(io.StringIO(text), sections=[section])}
+        for name, func in cases.items():
+            repeat = max(1, options.budget // len(text))
+            elapse = measure(func, repeat)
+            report.append({'bytes': len(text), 'fixture': fixture, 'input': name, 'ms': round(elapse * 1e3, 2),
+                           'MB/s': round(len(text) / (1 << 20) / elapse, 2)})
+            print(json.dumps(report[-1]))
+    return report
+
+def main():
+    import argparse, sys
+    arguments = argparse.ArgumentParser()
+    commands = arguments.add_subparsers(dest='benchmark')
+    commands.required = True
+    decoder = commands.add_parser('decoder', help='frame decoder throughput with random chunking')
+    decoder.add_argument('--sizes', type=int, nargs='+', default=[1 << 10, 64 << 10, 1 << 20, 10 << 20, 50 << 20])
+    decoder.add_argument('--volume', type=int, default=100 << 20, help='bytes fed per frame size')
+    decoder.add_argument('--max-chunks', type=int, default=200000)
+    decoder.add_argument('--seed', type=int, default=0)
+    decoder.set_defaults(func=bench_decoder)
+    codec = commands.add_parser('codec', help='encode/decode cost of each codec on protocol message shapes')
+    codec.add_argument('--fleet', type=int, default=100, help='number of artifacts in collaborate notify')
+    codec.add_argument('--budget', type=int, default=20 << 20, help='bytes encoded per measurement')
+    codec.set_defaults(func=bench_codec)
+    compression = commands.add_parser('compression', help='zlib ratio and cpu cost on protocol message shapes')
+    compression.add_argument('--fleet', type=int, default=100, help='number of artifacts in collaborate notify')
+    compression.add_argument('--levels', type=int, nargs='+', default=[1, 6, 9])
+    compression.add_argument('--bandwidth', type=float, nargs='+', default=[10, 100, 1000], help='link speeds in Mbps')
+    compression.add_argument('--budget', type=int, default=10 << 20, help='bytes compressed per measurement')
+    compression.set_defaults(func=bench_compression)
+    broadcast = commands.add_parser('fanout', help='per-recipient send against serialize-once fanout')
+    broadcast.add_argument('--recipients', type=int, nargs='+', default=[1, 100, 1000])
+    broadcast.add_argument('--fleet', type=int, default=20, help='number of artifacts in collaborate notify')
+    broadcast.add_argument('--compress', action='store_true', help='negotiate zlib on every recipient')
+    broadcast.add_argument('--budget', type=int, default=2000, help='recipient writes per measurement')
+    broadcast.set_defaults(func=bench_fanout)
+    writes = commands.add_parser('writes', help='send syscalls and packets per frame over loopback')
+    writes.add_argument('--frames', type=int, default=20000)
+    writes.add_argument('--bursts', type=int, nargs='+', default=[1, 3, 16], help='frames written per reactor turn')
+    writes.set_defaults(func=bench_writes)
+    profiler = commands.add_parser('profiler', help='system_profiler text decoder throughput')
+    profiler.add_argument('--sizes', type=int, nargs='+', default=[64 << 10, 1 << 20, 8 << 20])
+    profiler.add_argument('--budget', type=int, default=32 << 20, help='bytes decoded per measurement')
+    profiler.set_defaults(func=bench_profiler)
+    options = arguments.parse_args(sys.argv[1:])
+    LOG.configure(level=WARNING)
+    options.func(options)
+
+if __name__ == '__main__':
+    main()
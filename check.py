@@ -1,11 +1,12 @@
 #!/usr/bin/env python3
 
-import json
+import json, sys, os
 
 from twisted.internet import reactor
-from twisted.internet.protocol import ClientFactory
+from twisted.internet.protocol import ClientFactory, connectionDone
 
 from shared import *
+from transfer import TransferManager
 
 __author__ = 'larryhou'
 
@@ -13,53 +14,195 @@ class CheckProtocol(TCP):
     def __init__(self, options, address):
         super(CheckProtocol, self).__init__(address=address, verbose=options.verbose)
         self.options = options
+        self.factory = None # type: CheckFactory
+        self.features = {FEATURE_ARTIFACT_TRANSFER}
+        self.transfers = TransferManager(self)
+        self.__partials = {} # type: dict[tuple, str]
 
     def connectionMade(self):
-        self.send(command=Commands.COLLABORATE_REQ,
-                  data={'mission': self.options.mission, 'mission_timeout':self.options.timeout})
+        self.negotiate()
+        if self.options.put or self.options.get: return # transfers wait for the negotiated features
+        if self.options.status:
+            self.send(command=Commands.SLAVE_STATUS_REQ)
+            return
+        if self.options.stats:
+            self.send(command=Commands.STATS_REQ, data={'connections': self.options.connections})
+            return
+        if self.options.telemetry:
+            query = {'metric': self.options.telemetry, 'last': self.options.last, 'selector': self.options.selector,
+                     'resolution': self.options.resolution, 'series': self.options.series}
+            self.send(command=Commands.TELEMETRY_QUERY_REQ, data=query)
+            return
+        request = {'mission': self.options.mission, 'mission_timeout':self.options.timeout,
+                   'stream': self.options.stream, 'selector': self.options.selector}
+        if self.options.refresh: request['refresh'] = True
+        if self.options.max_staleness: request['max_staleness'] = self.options.max_staleness
+        projection = self.projection()
+        if projection: request['projection'] = projection
+        if self.options.command:
+            request['mission'] = CollaborateMissions.RUN_COMMAND
+            request['command'] = self.options.command
+            if self.options.parallel: request['slots_per_slave'] = self.options.parallel
+            if self.options.artifact: request['artifacts'] = self.options.artifact
+        if self.options.task:
+            request['tasks'] = [self.decode_task(x) for x in self.options.task]
+            request['task_timeout'] = self.options.task_timeout
+        self.send(command=Commands.COLLABORATE_REQ, data=request)
         self.send(command=Commands.BROADCAST_REQ, data={'msg': 'Hi~', 'type': Broadcasts.CHAT})
 
-    def packReceived(self, data):
-        msg = json.loads(data, encoding='utf-8') # type: dict
+    def negotiated(self):
+        if self.options.put:
+            deferred = self.transfers.upload(self.options.put, name=self.options.name)
+        elif self.options.get:
+            output = self.options.output or os.path.basename(self.options.get)
+            deferred = self.transfers.download(self.options.get, output)
+        else: return
+        deferred.addCallbacks(self.transferred, self.transfer_failed)
+
+    def transferred(self, result): # type: (dict)->None
+        print(json.dumps(result, ensure_ascii=False))
+        self.transport.loseConnection()
+
+    def transfer_failed(self, failure):
+        print(json.dumps({'error': failure.getErrorMessage()}, ensure_ascii=False))
+        self.factory.exit_code = 1
+        self.transport.loseConnection()
+
+    def connectionLost(self, reason=connectionDone):
+        self.transfers.close()
+
+    def packReceived(self, msg): # type: (dict)->None
         command = msg.get('command') # type: int
         payload = msg.get('data')
-        if self.verbose:
-            self.print('>>> {} {}'.format(self.get_command_name(command), data.decode('utf-8')))
-        if command == Commands.COLLABORATE_NOTIFY:
+        self.log_frame('>>>', msg)
+        if command in ARTIFACT_COMMANDS:
+            self.transfers.handle(msg)
+        elif command == Commands.COLLABORATE_RSP and msg.get('retcode'):
+            print(json.dumps(payload, ensure_ascii=False))
+            self.factory.exit_code = 1
+            self.transport.loseConnection()
+        elif command == Commands.COLLABORATE_OUTPUT_NOTIFY:
+            self.print_output(payload)
+        elif command in (Commands.TELEMETRY_QUERY_RSP, Commands.SLAVE_STATUS_RSP, Commands.STATS_RSP):
+            print(json.dumps(payload, ensure_ascii=False, indent=4))
             self.transport.loseConnection()
-            for it in payload:
-                if not self.options.storage:
-                    if 'Storage' in it: del it['Storage']
-                if not self.options.network:
-                    if 'Network' in it: del it['Network']
+        elif command == Commands.COLLABORATE_ARTIFACT_NOTIFY:
+            print(json.dumps(self.strip(payload), ensure_ascii=False), flush=True)
+        elif command == Commands.COLLABORATE_NOTIFY:
+            self.transport.loseConnection()
+            self.flush_output()
+            if msg.get('retcode'): self.factory.exit_code = 1
+            summary = payload.get('summary') if isinstance(payload, dict) else None
+            if summary and (summary.get('failed') or summary.get('missing')): self.factory.exit_code = 1
+            if summary and any(x != '0' for x in summary.get('exit_codes') or {}): self.factory.exit_code = 1
+            if isinstance(payload, list) and self.options.command:
+                if any(x.get('exit_code') != 0 for x in payload): self.factory.exit_code = 1
+            if self.options.stream:
+                print(json.dumps(payload, ensure_ascii=False), flush=True)
+                return
+            for it in payload: self.strip(it)
             print(json.dumps(payload, ensure_ascii=False, indent=4))
 
+    def print_output(self, item): # type: (dict)->None
+        client = item.get('client') or {}
+        key = (client.get('address'), client.get('port'), item.get('stream_id'), item.get('stream'))
+        prefix = '[{}:{}] '.format(client.get('address'), client.get('port'))
+        text = self.__partials.pop(key, '') + (item.get('data') or '')
+        lines = text.split('\n')
+        # hold back an unfinished line so slaves do not interleave mid-line, but never more than a chunk of it
+        partial = lines.pop()
+        if len(partial) > COMMAND_CHUNK_SIZE: lines.append(partial); partial = ''
+        if partial: self.__partials[key] = partial
+        if not lines: return
+        stream = sys.stderr if item.get('stream') == 'stderr' else sys.stdout
+        stream.write(''.join(prefix + x + '\n' for x in lines))
+        stream.flush()
+
+    def flush_output(self):
+        for (address, port, _, name), partial in self.__partials.items():
+            stream = sys.stderr if name == 'stderr' else sys.stdout
+            stream.write('[{}:{}] {}\n'.format(address, port, partial))
+        self.__partials.clear()
+
+    @staticmethod
+    def decode_task(text): # type: (str)->dict
+        try:
+            task = json.loads(text)
+        except ValueError:
+            task = text
+        return task if isinstance(task, dict) else {'argument': task}
+
+    def projection(self): # type: ()->dict
+        # subtrees nobody asked for are dropped on the slaves, their profiler sections are not even run
+        exclude = list(self.options.exclude or ())
+        if not self.options.command:
+            if not self.options.storage: exclude.append('Storage')
+            if not self.options.network: exclude.append('Network')
+        projection = {'exclude': exclude} if exclude else {}
+        if self.options.projection: projection['include'] = self.options.projection
+        return projection
+
+    def strip(self, it): # type: (dict)->dict
+        if not self.options.storage:
+            if 'Storage' in it: del it['Storage']
+        if not self.options.network:
+            if 'Network' in it: del it['Network']
+        return it
+
 class CheckFactory(ClientFactory):
     def __init__(self, options):
         self.options = options
+        self.exit_code = 0
 
     def buildProtocol(self, addr):
-        return CheckProtocol(options=self.options, address=addr)
+        protocol = CheckProtocol(options=self.options, address=addr)
+        protocol.factory = self
+        return protocol
 
     def clientConnectionLost(self, connector, reason):
         reactor.stop()
 
     def clientConnectionFailed(self, connector, reason):
+        self.exit_code = 1
         reactor.stop()
 
 def main():
-    import argparse, sys
+    import argparse
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--server', '-s', default='localhost', type=str, help='server address')
     arguments.add_argument('--port', '-p', required=True, type=int, help='server port')
     arguments.add_argument('--storage', '-g', action='store_true')
     arguments.add_argument('--network', '-n', action='store_true')
     arguments.add_argument('--mission', '-m', type=int, default=CollaborateMissions.REPORT_SYSTEM_STATS)
+    arguments.add_argument('--projection', '-f', action='append', help='only report this key path, globs per level, e.g. "MEM.percent" or "Storage.*.Capacity"')
+    arguments.add_argument('--exclude', '-x', action='append', help='leave out this key path')
     arguments.add_argument('--timeout', '-t', type=float, default=10)
+    arguments.add_argument('--selector', '-q', help='slave selector, e.g. "any 5 idle" or "model = MacPro7,1 and memory >= 64GB"')
+    arguments.add_argument('--task', action='append', help='queue a task (JSON object or plain argument) for job mode')
+    arguments.add_argument('--task-timeout', type=float, default=0, help='re-queue a task not finished in time')
+    arguments.add_argument('--max-staleness', type=float, default=0, help='accept cached slave results up to this age in seconds')
+    arguments.add_argument('--refresh', action='store_true', help='bypass the slave system_profiler cache')
+    arguments.add_argument('--command', '-c', help='run a command on the slaves and stream its output, e.g. "sh -c \'make test\'"')
+    arguments.add_argument('--parallel', type=int, default=0, help='commands run at once per slave in job mode')
+    arguments.add_argument('--artifact', action='append', help='file pattern uploaded to the queen after --command finishes')
+    arguments.add_argument('--put', metavar='FILE', help='upload a file to the queen artifact directory, resuming a partial upload')
+    arguments.add_argument('--name', help='artifact name for --put, the file name by default')
+    arguments.add_argument('--get', metavar='NAME', help='download an artifact from the queen, resuming a partial download')
+    arguments.add_argument('--output', '-o', help='file --get writes to, the artifact file name by default')
+    arguments.add_argument('--stream', action='store_true', help='print each artifact as it arrives in NDJSON')
+    arguments.add_argument('--stats', action='store_true', help='print queen counters and latency histograms')
+    arguments.add_argument('--connections', action='store_true', help='include per-connection traffic with --stats')
+    arguments.add_argument('--status', action='store_true', help='list slaves with liveness status and heartbeat rtt')
+    arguments.add_argument('--telemetry', metavar='METRIC', help='query slave telemetry (cpu, mem or load) instead of a collaborate round')
+    arguments.add_argument('--last', type=float, default=300, help='telemetry range in seconds up to now')
+    arguments.add_argument('--resolution', type=float, help='telemetry bucket size in seconds, picked from the range by default')
+    arguments.add_argument('--series', action='store_true', help='include per-slave telemetry points')
     arguments.add_argument('--verbose', '-v', action='store_true')
     options = arguments.parse_args(sys.argv[1:])
-    reactor.connectTCP(options.server, options.port, CheckFactory(options))
+    factory = CheckFactory(options)
+    reactor.connectTCP(options.server, options.port, factory)
     reactor.run()
+    sys.exit(factory.exit_code)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
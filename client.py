@@ -1,22 +1,113 @@
 #!/usr/bin/env python3
-import os, json, time, psutil, datetime
-from twisted.internet.protocol import ReconnectingClientFactory
-from twisted.internet import reactor, task
+import os, json, time, psutil, datetime, getpass, shlex, collections
+from twisted.internet.protocol import ReconnectingClientFactory, connectionDone
+from twisted.internet import reactor, task, defer
 from twisted.internet.endpoints import IPv4Address
 from shared import *
 from client_mission import *
+from registry import local_os_version
+from executor import MissionExecutor
+from inventory import InventoryStore, digest, machine_id, diff
+from telemetry import TELEMETRY_FIELDS
+from transfer import TransferManager
+import logger
 
 __author__ = 'larryhou'
 
+PROFILER_SECTIONS = ['SPHardwareDataType', 'SPStorageDataType', 'SPNetworkDataType', 'SPDisplaysDataType', 'SPUSBDataType']
+# top level key each section shows up as in the decoded system_profiler output
+PROFILER_SECTION_KEYS = {
+    'SPHardwareDataType': 'Hardware',
+    'SPStorageDataType': 'Storage',
+    'SPNetworkDataType': 'Network',
+    'SPDisplaysDataType': 'Graphics/Displays',
+    'SPUSBDataType': 'USB',
+}
+
+PROFILER_TTL = {
+    'SPHardwareDataType': 86400.0,
+    'SPDisplaysDataType': 3600.0,
+    'SPUSBDataType': 600.0,
+    'SPStorageDataType': 300.0,
+    'SPNetworkDataType': 60.0,
+}
+
+def should_refresh(refresh, name): # type: (bool|list[str], str)->bool
+    if isinstance(refresh, (list, tuple)): return name in refresh
+    return bool(refresh)
+
+class ProfilerCache(object):
+    def __init__(self, clock=reactor, ttl=None, default_ttl=300.0, capacity=32):
+        self.clock = clock
+        self.ttl = dict(PROFILER_TTL, **(ttl or {})) # type: dict[str, float]
+        self.default_ttl = default_ttl
+        self.capacity = capacity
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.__entries = collections.OrderedDict() # type: dict[str, tuple[float, any]]
+        self.__loading = {} # type: dict[str, list[defer.Deferred]]
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(self.__entries), 'loading': len(self.__loading)}
+
+    def invalidate(self, name=None):
+        if name is None: self.__entries.clear()
+        else: self.__entries.pop(name, None)
+
+    def get(self, name, loader, refresh=False): # type: (str, callable, bool)->defer.Deferred
+        now = self.clock.seconds()
+        entry = self.__entries.get(name)
+        if entry and not refresh and entry[0] > now:
+            self.hits += 1
+            self.__entries.move_to_end(name)
+            return defer.succeed(entry[1])
+        self.misses += 1
+        waiter = defer.Deferred()
+        # concurrent callers of a section that is being profiled share one process
+        if name in self.__loading:
+            self.__loading[name].append(waiter)
+        else:
+            self.__loading[name] = [waiter]
+            defer.maybeDeferred(loader).addBoth(self.__loaded, name)
+        return waiter
+
+    def __loaded(self, result, name):
+        waiters = self.__loading.pop(name)
+        if not isinstance(result, defer.Failure): self.__store(name, result)
+        for waiter in waiters:
+            if isinstance(result, defer.Failure): waiter.errback(result)
+            else: waiter.callback(result)
+
+    def __store(self, name, result):
+        self.__entries[name] = (self.clock.seconds() + self.ttl.get(name, self.default_ttl), result)
+        self.__entries.move_to_end(name)
+        now = self.clock.seconds()
+        for key in [k for k, (expires, _) in self.__entries.items() if expires <= now]:
+            del self.__entries[key]
+            self.evictions += 1
+        while len(self.__entries) > self.capacity:
+            self.__entries.popitem(last=False)
+            self.evictions += 1
+
 class ClientSlaveConnection(TCP):
     def __init__(self, address, factory):
         super(ClientSlaveConnection, self).__init__(address)
         self.factory = factory # type: ClientSlaveConnectionFactory
+        self.features = {FEATURE_INVENTORY_DELTA, FEATURE_ARTIFACT_TRANSFER, FEATURE_ADMISSION}
+        self.transfers = TransferManager(self) # uploads only, the queen does not push files to slaves
         self.system_information = {}  # type: dict
         self.timestamp = 0.0
         self.heart_beat_interval = 10.0
+        self.rtt = None # type: float
         self.__missions = {} # type: dict[int, Mission]
         self.__mission_sequence = 0
+        self.__telemetry = None # type: task.LoopingCall
+        self.__telemetry_batch = 1
+        self.__samples = [] # type: list[list[float]]
+        self.__serve_call = None # type: IDelayedCall
+        self.__inventory_command = Commands.SYSTEM_INFORMATION_NOTIFY
 
     def register_mission(self, mission):
         self.__mission_sequence += 1
@@ -27,6 +118,14 @@ class ClientSlaveConnection(TCP):
         if sequence in self.__missions:
             del self.__missions[sequence]
 
+    def find_mission(self, sequence): # type: (int)->Mission
+        return self.__missions.get(sequence)
+
+    def cancel_missions(self, target): # type: (dict)->None
+        # another slave finished this task first
+        for mission in list(self.__missions.values()):
+            if all(mission.parameters.get(k) == target.get(k) for k in ('round', 'task')): mission.cancel()
+
     def update(self):
         timestamp = time.mktime(time.localtime())
         if timestamp - self.timestamp >= self.heart_beat_interval:
@@ -36,24 +135,121 @@ class ClientSlaveConnection(TCP):
             mission.update()
 
     def send_heartbeat(self):
-        self.send(command=Commands.HEARTBEAT_REQ, data={'ts': time.mktime(time.localtime())})
+        heartbeat = {'ts': time.time()}
+        if self.rtt is not None: heartbeat['rtt'] = self.rtt
+        # cache statistics ride along for the queen's stats endpoint instead of in every artifact
+        heartbeat['profiler_cache'] = self.factory.profiler_cache.stats()
+        self.send(command=Commands.HEARTBEAT_REQ, data=heartbeat)
 
     def connectionMade(self):
-        self.send(command=Commands.SERVE_AS_SLAVE_REQ)
-        self.send_system_information(command=Commands.SYSTEM_INFORMATION_NOTIFY)
+        self.negotiate()
         self.send_heartbeat()
 
-    def run_system_profiler(self, name):
-        text = os.popen('system_profiler {} 2>/dev/null'.format(name)).read()
-        return self.decode_system_information(text) if text else {}
+    def negotiated(self):
+        if FEATURE_ADMISSION not in self.peer_features:
+            self.serve()
+            self.send_system_information(command=Commands.SYSTEM_INFORMATION_NOTIFY)
+            return
+        # the queen paces handshakes, so ask once the inventory is at hand and an admitted handshake is over quickly
+        self.collect_system_information().addCallback(lambda _: self.serve())
+
+    def serve(self):
+        self.__serve_call = None
+        data = self.system_information
+        # the digest tells the queen whether it still holds this inventory and the handshake is a cheap one
+        self.send(command=Commands.SERVE_AS_SLAVE_REQ, data={'machine': machine_id(data), 'digest': digest(data)} if data else None)
+
+    def admitted(self, msg): # type: (dict)->None
+        payload = msg.get('data') or {}
+        if msg.get('retcode') == Exceptions.HANDSHAKE_DEFERRED:
+            delay = float(payload.get('retry_after') or 1.0)
+            self.log(INFO, 'queen busy, serve again in {:.3f}s', delay)
+            self.__serve_call = reactor.callLater(delay, self.serve)
+        elif FEATURE_ADMISSION in self.peer_features:
+            self.offer_inventory(command=Commands.SYSTEM_INFORMATION_NOTIFY, data=self.system_information)
+
+    def connectionLost(self, reason=connectionDone):
+        if self.__serve_call and self.__serve_call.active(): self.__serve_call.cancel()
+        self.__serve_call = None
+        self.stop_telemetry()
+        for _, mission in list(self.__missions.items()):
+            mission.cancel()
+        self.transfers.close()
+
+    def start_telemetry(self, interval, batch=1): # type: (float, int)->None
+        self.stop_telemetry()
+        if interval <= 0: return
+        self.__telemetry_batch = max(1, batch)
+        psutil.cpu_percent() # the first reading only sets the reference point
+        self.__telemetry = task.LoopingCall(self.sample_telemetry)
+        self.__telemetry.start(interval, now=False)
+
+    def stop_telemetry(self):
+        if self.__telemetry and self.__telemetry.running: self.__telemetry.stop()
+        self.__telemetry = None
+        self.__samples = []
+
+    def sample_telemetry(self):
+        load = os.getloadavg()[0] if hasattr(os, 'getloadavg') else 0.0
+        self.__samples.append([round(time.time(), 3), psutil.cpu_percent(), psutil.virtual_memory().percent, load])
+        # several samples share a frame, the queen only needs them once per batch
+        if len(self.__samples) >= self.__telemetry_batch:
+            self.send(command=Commands.TELEMETRY_NOTIFY, data={'fields': TELEMETRY_FIELDS, 'samples': self.__samples})
+            self.__samples = []
+
+    def run_system_profiler(self, name, refresh=False): # type: (str, bool)->defer.Deferred
+        def load():
+            deferred = self.factory.executor.spawn(self.factory.profiler + [name], timeout=self.factory.profiler_timeout)
+            deferred.addCallback(lambda text: self.decode_system_information(text) if text else {})
+            return deferred
+        return self.factory.profiler_cache.get(name, load, refresh=refresh)
+
+    def describe_host(self): # type: ()->dict
+        uname = os.uname()
+        return {'uname': ' '.join([uname.sysname, uname.nodename, uname.release, uname.version, uname.machine]),
+                'whoami': getpass.getuser(),
+                'osversion': local_os_version(),
+                'tags': self.factory.tags}
+
+    def collect_system_information(self, refresh=False): # type: (bool|list[str])->defer.Deferred
+        data = self.describe_host()
+        sections = [self.run_system_profiler(x, refresh=should_refresh(refresh, x)) for x in PROFILER_SECTIONS]
+        def collect(results):
+            for name, (success, result) in zip(PROFILER_SECTIONS, results):
+                data[name] = result if success else {}
+            self.system_information = data
+            return data
+        return defer.DeferredList(sections, consumeErrors=True).addCallback(collect)
 
     def send_system_information(self, command):
-        data = {'uname': os.popen('uname -a').read()[:-1],
-                'whoami': os.popen('whoami').read()[:-1]}
-        for name in 'SPHardwareDataType SPStorageDataType SPNetworkDataType SPDisplaysDataType SPUSBDataType'.split(' '):
-            data[name] = self.run_system_profiler(name)
-        self.system_information = data
-        self.send(command=command, data=self.system_information)
+        self.collect_system_information().addCallback(lambda data: self.offer_inventory(command, data))
+
+    def offer_inventory(self, command, data): # type: (int, dict)->None
+        if FEATURE_INVENTORY_DELTA not in self.peer_features:
+            self.send(command=command, data=data)
+            return
+        # the queen keeps a persisted copy, offer the hash first and only ship what it is missing
+        offer = {'machine': machine_id(data), 'digest': digest(data)}
+        self.__inventory_command = command
+        if command == Commands.SYSTEM_INFORMATION_RSP: self.send(command=command, data=offer) # the queen asked, answer in kind
+        else: self.send(command=Commands.INVENTORY_DIGEST_REQ, data=offer)
+
+    def send_inventory(self, payload): # type: (dict)->None
+        data = self.system_information
+        machine, data_digest = machine_id(data), digest(data)
+        inventory = self.factory.inventory
+        want = payload.get('want')
+        if want == 'diff':
+            entry = inventory.get(machine)
+            if entry and entry.get('digest') == payload.get('base'):
+                delta = diff(entry.get('data'), data)
+                self.send(command=self.__inventory_command, data={
+                    'machine': machine, 'base': payload.get('base'), 'digest': data_digest, 'delta': delta})
+            else: want = 'full'
+        if want == 'full':
+            self.send(command=self.__inventory_command, data=data)
+        inventory.put(machine, data, data_digest)
+        inventory.save()
 
     def dispatch_collaborate_mission(self, parameters):
         import client_mission
@@ -70,38 +266,65 @@ class ClientSlaveConnection(TCP):
         elif mission == CollaborateMissions.REPORT_SYSTEM_PROFILER:
             client_mission.\
                 ReportSystemProfilerMission(client=self, parameters=parameters).schedule()
+        elif mission == CollaborateMissions.RUN_COMMAND:
+            client_mission.\
+                RunCommandMission(client=self, parameters=parameters).schedule()
         else:
             client_mission.\
                 NotImplementedMission(client=self, parameters=parameters).schedule()
 
-    def packReceived(self, data):
-        msg = json.loads(data, encoding='utf-8')
+    def packReceived(self, msg):
         command = msg.get('command') # type: int
         payload = msg.get('data') # type: dict
-        if command not in self.factory.slient_commands:
-            self.print('>>> {} {}'.format(self.get_command_name(command), data.decode('utf-8')))
+        self.log_frame('>>>', msg)
         if command == Commands.SYSTEM_INFORMATION_REQ:
             self.send_system_information(command=Commands.SYSTEM_INFORMATION_RSP)
+        elif command == Commands.HEARTBEAT_RSP:
+            # the queen echoes our timestamp, report the round trip with the next heartbeat
+            if payload and payload.get('ts'): self.rtt = round(time.time() - float(payload['ts']), 6)
+        elif command == Commands.SERVE_AS_SLAVE_RSP:
+            self.admitted(msg)
+        elif command == Commands.INVENTORY_DIGEST_RSP:
+            self.send_inventory(payload or {})
+        elif command == Commands.TELEMETRY_SUBSCRIBE_REQ:
+            payload = payload or {}
+            self.start_telemetry(float(payload.get('interval') or 0), int(payload.get('batch') or 1))
+            self.send(command=Commands.TELEMETRY_SUBSCRIBE_RSP, data=payload)
         elif command == Commands.COLLABORATE_MISSION_REQ:
             respond = {'accepted': True}
             respond.update(payload)
             self.send(command=Commands.COLLABORATE_MISSION_RSP, data=respond)
             self.dispatch_collaborate_mission(parameters=payload)
+        elif command in ARTIFACT_COMMANDS:
+            self.transfers.handle(msg)
+        elif command == Commands.COLLABORATE_OUTPUT_RSP:
+            mission = self.find_mission(payload.get('stream_id')) if payload else None
+            if mission: mission.acknowledge(int(payload.get('bytes') or 0))
+        elif command == Commands.COLLABORATE_CANCEL_NOTIFY:
+            self.cancel_missions(payload or {})
         elif command == Commands.BROADCAST_NOTIFY:
             pass
 
 class ClientSlaveConnectionFactory(ReconnectingClientFactory):
-    def __init__(self):
+    def __init__(self, max_processes=4, max_commands=1):
         self.connection = None # type: ClientSlaveConnection
-        self.slient_commands = (
-            Commands.HEARTBEAT_REQ,
-            Commands.HEARTBEAT_RSP,
-        )
+        self.compress_threshold = COMPRESS_THRESHOLD
+        self.tags = [] # type: list[str]
+        self.profiler = ['system_profiler'] # type: list[str]
+        self.profiler_timeout = 60.0
+        self.profiler_cache = ProfilerCache()
+        self.inventory = InventoryStore() # snapshot last sent to the queen
+        self.executor = MissionExecutor(max_processes=max_processes, concurrency={
+            CollaborateMissions.REPORT_SYSTEM_PROFILER: 1,
+            CollaborateMissions.REPORT_SYSTEM_STATS: 2,
+            CollaborateMissions.RUN_COMMAND: max_commands,
+        })
 
     def buildProtocol(self, addr):
         self.resetDelay()
         ClientSlaveConnectionFactory.maxDelay = 300
         self.connection = ClientSlaveConnection(address=addr, factory=self)
+        self.connection.compress_threshold = self.compress_threshold
         return self.connection
 
     def update(self):
@@ -111,12 +334,12 @@ class ClientSlaveConnectionFactory(ReconnectingClientFactory):
         pass
 
     def clientConnectionFailed(self, connector, reason):
-        print('connection fail {}'.format(reason))
+        LOG.warning('connection fail {}', reason.getErrorMessage())
         super(ClientSlaveConnectionFactory, self).clientConnectionFailed(connector, reason)
         self.connection = None
 
     def clientConnectionLost(self, connector, reason):
-        print('connection lost {}'.format(reason))
+        LOG.warning('connection lost {}', reason.getErrorMessage())
         super(ClientSlaveConnectionFactory, self).clientConnectionLost(connector, reason)
         self.connection = None
 
@@ -126,9 +349,22 @@ def main():
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--server', '-s', default='localhost', type=str, help='server address')
     arguments.add_argument('--port', '-p', required=True, type=int, help='server port')
+    arguments.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD >> 10,
+                           help='compress frames from this size in KB, 0 to disable')
+    arguments.add_argument('--tag', '-t', action='append', default=[], help='tag used by collaborate selectors')
+    arguments.add_argument('--profiler', default='system_profiler', help='command that prints a system_profiler section')
+    arguments.add_argument('--max-processes', type=int, default=4, help='max concurrent profiler processes')
+    arguments.add_argument('--max-commands', type=int, default=1, help='max concurrent run command missions')
+    arguments.add_argument('--inventory', default='~/.codmci/slave-inventory.json', help='snapshot of the inventory last sent to the queen')
+    logger.add_arguments(arguments)
     options = arguments.parse_args(sys.argv[1:])
+    logger.configure(options)
 
-    factory = ClientSlaveConnectionFactory()
+    factory = ClientSlaveConnectionFactory(max_processes=options.max_processes, max_commands=options.max_commands)
+    factory.tags = options.tag
+    factory.profiler = shlex.split(options.profiler)
+    factory.inventory = InventoryStore(filename=os.path.expanduser(options.inventory)).load()
+    factory.compress_threshold = options.compress_threshold << 10
     t = task.LoopingCall(factory.update)
     t.start(1.0/5)
 
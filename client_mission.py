@@ -1,6 +1,10 @@
 from client import ClientSlaveConnection
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IProcessTransport
 from shared import *
-import datetime, psutil
+from executor import run_streaming_command
+from projection import Projection
+import datetime, psutil, shlex, codecs, time, os, glob, posixpath
 
 __author__ = 'larryhou'
 
@@ -8,10 +12,39 @@ class Mission(object):
     def __init__(self, client, parameters):
         self.client = client  # type: ClientSlaveConnection
         self.parameters = parameters  # type: dict
+        self.deferred = None # type: defer.Deferred
         self.__sequence = self.client.register_mission(mission=self)
 
+    @property
+    def sequence(self): return self.__sequence
+
+    def execute(self): # type: ()->dict|defer.Deferred
+        return {}
+
     def schedule(self):
-        pass
+        mission = self.parameters.get('mission', type(self).__name__)
+        self.deferred = self.client.factory.executor.submit(mission, self.execute)
+        timeout = float(self.parameters.get('mission_timeout') or 0)
+        if timeout > 0: self.deferred.addTimeout(timeout, reactor)
+        self.deferred.addCallbacks(self.complete, self.fail)
+        self.deferred.addBoth(lambda _: self.finish())
+        return self.deferred
+
+    def complete(self, respond): # type: (dict)->None
+        self.etime(self.parameters)
+        respond.update(self.parameters)
+        self.client.send(command=Commands.COLLABORATE_COMPLETE_REQ, data=respond)
+
+    def fail(self, failure):
+        self.etime(self.parameters)
+        if failure.check(defer.TimeoutError, defer.CancelledError):
+            retcode, info = Exceptions.COLLABORATE_TIMEOUT, 'mission cancelled or timed out'
+        else:
+            retcode, info = Exceptions.MISSION_FAILED, failure.getErrorMessage()
+        self.client.send(command=Commands.COLLABORATE_COMPLETE_REQ, retcode=retcode, data=self.parameters, info=info)
+
+    def cancel(self):
+        if self.deferred and not self.deferred.called: self.deferred.cancel()
 
     def update(self):
         pass
@@ -34,31 +67,53 @@ class NotImplementedMission(Mission):
 
 
 class ReportPerformanceStatsMission(Mission):
-    def schedule(self):
+    def execute(self):
         respond = {'cpu':psutil.cpu_percent()}
         memory = respond['mem'] = psutil.virtual_memory()._asdict()
         for k, v in memory.items():
             if v < 1024: continue
             memory[k] = float(v) / (1 << 20)
-        self.etime(self.parameters)
-        respond.update(self.parameters)
-        self.client.send(command=Commands.COLLABORATE_COMPLETE_REQ, data=respond)
-        self.finish()
+        return respond
 
 class ReportSystemProfilerMission(Mission):
-    def schedule(self):
-        import os, serialization
-        info = os.popen('system_profiler SPHardwareDataType SPStorageDataType SPNetworkDataType SPDisplaysDataType SPUSBDataType 2>/dev/null').read() # type: str
-        respond = serialization.decode_system_information(info)
-        self.etime(self.parameters)
-        respond.update(self.parameters)
-        self.client.send(command=Commands.COLLABORATE_COMPLETE_REQ, data=respond)
-        self.finish()
+    def execute(self):
+        from client import PROFILER_SECTIONS, PROFILER_SECTION_KEYS, should_refresh
+        refresh = self.parameters.get('refresh')
+        self.projection = Projection.parse(self.parameters.get('projection'))
+        # a section the projection drops entirely is never profiled
+        names = [x for x in PROFILER_SECTIONS if not self.projection or self.projection.wants(PROFILER_SECTION_KEYS[x])]
+        sections = [self.client.run_system_profiler(x, refresh=should_refresh(refresh, x)) for x in names]
+        deferred = defer.gatherResults(sections, consumeErrors=True)
+        deferred.addCallback(self.report)
+        return deferred
+
+    def report(self, sections): # type: (list[dict])->dict
+        respond = {}
+        for section in sections: respond.update(section)
+        return self.projection.apply(respond) if self.projection else respond
+
+# report keys filled from each system_profiler section
+STATS_SECTIONS = (('SPHardwareDataType', ('Hardware',)), ('SPStorageDataType', ('Storage',)),
+                  ('SPNetworkDataType', ('Network', 'Address')))
 
 class ReportSystemStatsMission(Mission):
-    def schedule(self):
-        respond = {'User': self.client.system_information.get('whoami')}
-        uname = self.client.system_information.get('uname')  # type: str
+    def execute(self):
+        from client import should_refresh
+        refresh = self.parameters.get('refresh')
+        self.projection = Projection.parse(self.parameters.get('projection'))
+        names = [name for name, keys in STATS_SECTIONS
+                 if not self.projection or any(self.projection.wants(x) for x in keys)]
+        sections = [self.client.run_system_profiler(x, refresh=should_refresh(refresh, x)) for x in names]
+        deferred = defer.gatherResults(sections, consumeErrors=True)
+        deferred.addCallback(lambda results: self.report(self.client.describe_host(), dict(zip(names, results))))
+        return deferred
+
+    def report(self, information, sections): # type: (dict, dict[str, dict])->dict
+        hardware = sections.get('SPHardwareDataType') or {}
+        storage = sections.get('SPStorageDataType') or {}
+        network = sections.get('SPNetworkDataType') or {}
+        respond = {'User': information.get('whoami')}
+        uname = information.get('uname')  # type: str
         beg = uname.find(' ')
         end = uname.find(' ', beg + 1)
         respond['Machine'] = uname[beg + 1:end]
@@ -68,18 +123,127 @@ class ReportSystemStatsMission(Mission):
             if v < 1024: continue
             memory[k] = float(v) / (1 << 20)
         memory['unit'] = 'MB'
-        hardware = self.client.system_information.get('SPHardwareDataType')
         respond.update(hardware)
-        storage = self.client.run_system_profiler('SPStorageDataType')
         respond.update(storage)
-        network = self.client.run_system_profiler('SPNetworkDataType')
-        for k, v in network['Network'].items():
+        for k, v in network.get('Network', {}).items():
             address = v.get('IPv4Addresses')
             if address:
                 respond['Network'] = v
                 respond['Address'] = address
                 break
-        self.etime(self.parameters)
-        respond.update(self.parameters)
-        self.client.send(command=Commands.COLLABORATE_COMPLETE_REQ, data=respond)
-        self.finish()
+        return self.projection.apply(respond) if self.projection else respond
+
+class RunCommandMission(Mission):
+    def __init__(self, client, parameters):
+        super(RunCommandMission, self).__init__(client, parameters)
+        self.chunk_size = max(1024, int(parameters.get('chunk_size') or COMMAND_CHUNK_SIZE))
+        self.window = max(self.chunk_size, int(parameters.get('window') or COMMAND_WINDOW))
+        self.flush_interval = float(parameters.get('flush_interval') or 0.2)
+        self.process = None # type: IProcessTransport
+        self.__buffers = {'stdout': bytearray(), 'stderr': bytearray()}
+        self.__decoders = {k: codecs.getincrementaldecoder('utf-8')(errors='replace') for k in self.__buffers}
+        self.__bytes = {k: 0 for k in self.__buffers}
+        self.__tail = bytearray()
+        self.__seq = 0
+        self.__unacked = 0
+        self.__paused = False
+        self.__closed = False
+        self.__flush_call = None
+        self.__started = 0.0
+
+    def execute(self):
+        command = self.parameters.get('command')
+        args = shlex.split(command) if isinstance(command, str) else [str(x) for x in command or ()]
+        if not args: raise ValueError('run command mission without command')
+        self.__started = time.time()
+        deferred, self.process = run_streaming_command(args, self.receive, cwd=self.parameters.get('cwd'),
+                                                       env=self.parameters.get('env'),
+                                                       kill_grace=float(self.parameters.get('kill_grace') or 5.0))
+        deferred.addCallback(self.report)
+        deferred.addCallback(self.upload_artifacts)
+        return deferred
+
+    def receive(self, name, data): # type: (str, bytes)->None
+        if self.__closed: return
+        self.__bytes[name] += len(data)
+        self.__tail += data
+        if len(self.__tail) > COMMAND_TAIL_SIZE: del self.__tail[:-COMMAND_TAIL_SIZE]
+        buffer = self.__buffers[name]
+        buffer += data
+        if len(buffer) >= self.chunk_size: self.flush(name)
+        elif self.__flush_call is None:
+            self.__flush_call = reactor.callLater(self.flush_interval, self.flush)
+
+    def flush(self, name=None, final=False):
+        if name is None:
+            if self.__flush_call and self.__flush_call.active(): self.__flush_call.cancel()
+            self.__flush_call = None
+        for stream in ([name] if name else list(self.__buffers)):
+            buffer = self.__buffers[stream]
+            while buffer or final:
+                chunk = bytes(buffer[:self.chunk_size])
+                del buffer[:self.chunk_size]
+                text = self.__decoders[stream].decode(chunk, final=final and not buffer)
+                if text or chunk: self.__send(stream, text, len(chunk))
+                if not buffer: break
+        # the queen acknowledges chunks once its observers took them, stop reading until it catches up
+        if self.__unacked >= self.window and not self.__paused and self.process:
+            self.__paused = True
+            self.process.pauseProducing()
+
+    def __send(self, stream, text, size):
+        self.__seq += 1
+        self.__unacked += size
+        output = {k: self.parameters[k] for k in ('id', 'round', 'mission', 'task') if k in self.parameters}
+        output.update(stream_id=self.sequence, seq=self.__seq, stream=stream, data=text, bytes=size)
+        self.client.send(command=Commands.COLLABORATE_OUTPUT_REQ, data=output)
+
+    def acknowledge(self, size): # type: (int)->None
+        self.__unacked = max(0, self.__unacked - size)
+        if self.__paused and self.__unacked <= self.window // 2:
+            self.__paused = False
+            if self.process and not self.__closed: self.process.resumeProducing()
+
+    def close(self):
+        if self.__closed: return
+        self.flush(final=True)
+        self.__closed = True
+
+    def report(self, status): # type: (tuple[int, int])->dict
+        self.close()
+        exit_code, signal = status
+        return {'exit_code': exit_code if exit_code is not None else -(signal or 0), 'signal': signal,
+                'stdout_bytes': self.__bytes['stdout'], 'stderr_bytes': self.__bytes['stderr'],
+                'tail': self.__tail.decode('utf-8', errors='replace'), 'duration': round(time.time() - self.__started, 3)}
+
+    def upload_artifacts(self, respond): # type: (dict)->dict|defer.Deferred
+        patterns = self.parameters.get('artifacts')
+        if not patterns: return respond
+        cwd = self.parameters.get('cwd') or os.getcwd()
+        if isinstance(patterns, str): patterns = [patterns]
+        paths = sorted({x for pattern in patterns for x in glob.glob(os.path.join(cwd, pattern)) if os.path.isfile(x)})
+        prefix = self.parameters.get('artifact_prefix') or posixpath.join(
+            'round-{}'.format(self.parameters.get('round', 0)),
+            'task-{}'.format(self.parameters['task']) if 'task' in self.parameters else os.uname().nodename)
+        names = []
+        for path in paths:
+            relative = os.path.relpath(path, cwd)
+            # files outside the working directory must not climb out of the prefix on the queen
+            if relative.startswith(os.pardir): relative = os.path.basename(path)
+            names.append(posixpath.join(prefix, relative.replace(os.sep, '/')))
+        uploads = [self.client.transfers.upload(x, name=name) for x, name in zip(paths, names)]
+        def collect(results):
+            respond['uploads'] = [value if success else {'name': name, 'error': value.getErrorMessage()}
+                                    for name, (success, value) in zip(names, results)]
+            return respond
+        return defer.DeferredList(uploads, consumeErrors=True).addCallback(collect)
+
+    def fail(self, failure):
+        self.close()
+        self.parameters.update(stdout_bytes=self.__bytes['stdout'], stderr_bytes=self.__bytes['stderr'],
+                               tail=self.__tail.decode('utf-8', errors='replace'))
+        super(RunCommandMission, self).fail(failure)
+
+    def cancel(self):
+        self.__closed = True # the queen is gone or took the result from elsewhere, nobody acknowledges output any more
+        super(RunCommandMission, self).cancel()
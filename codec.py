@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+import json, zlib
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+__author__ = 'larryhou'
+
+class JSONCodec(object):
+    name = 'json'
+    binary = False
+
+    @staticmethod
+    def encode(message): # type: (dict)->bytes
+        return json.dumps(message, ensure_ascii=False).encode('utf-8')
+
+    @staticmethod
+    def decode(data): # type: (memoryview)->dict
+        return json.loads(str(data, 'utf-8'))
+
+class MessagePackCodec(object):
+    name = 'msgpack'
+    binary = True
+
+    @staticmethod
+    def encode(message): # type: (dict)->bytes
+        return msgpack.packb(message, use_bin_type=True)
+
+    @staticmethod
+    def decode(data): # type: (memoryview)->dict
+        return msgpack.unpackb(data, raw=False, strict_map_key=False)
+
+# ordered by preference, json is always available as the fallback for old peers
+CODECS = [MessagePackCodec, JSONCodec] if msgpack else [JSONCodec]
+
+def find_codec(name):
+    for codec in CODECS:
+        if codec.name == name: return codec
+
+def negotiate_codec(names): # type: (list[str])->type
+    for name in names or ():
+        codec = find_codec(name)
+        if codec: return codec
+    return JSONCodec
+
+class ZlibCompression(object):
+    name = 'zlib'
+
+    def __init__(self, level=6):
+        self.level = level
+
+    def compress(self, data): # type: (bytes)->bytes
+        return zlib.compress(data, self.level)
+
+    @staticmethod
+    def decompress(data, max_length): # type: (memoryview, int)->bytes
+        decompressor = zlib.decompressobj()
+        result = decompressor.decompress(data, max_length)
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError('decompressed frame exceeds {} bytes or is truncated'.format(max_length))
+        return result
+
+COMPRESSIONS = [ZlibCompression]
+
+def negotiate_compression(names): # type: (list[str])->type
+    for compression in COMPRESSIONS:
+        if compression.name in (names or ()): return compression
@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+from twisted.internet import reactor, defer
+from twisted.internet.protocol import ProcessProtocol
+from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.interfaces import IProcessTransport
+import os, sys, signal
+
+__author__ = 'larryhou'
+
+class CommandProcess(ProcessProtocol):
+    def __init__(self, deferred):
+        self.deferred = deferred # type: defer.Deferred
+        self.chunks = [] # type: list[bytes]
+
+    def outReceived(self, data):
+        self.chunks.append(data)
+
+    def processEnded(self, reason):
+        if self.deferred.called: return
+        if reason.check(ProcessDone, ProcessTerminated):
+            self.deferred.callback(b''.join(self.chunks).decode('utf-8', errors='replace'))
+        else:
+            self.deferred.errback(reason)
+
+# puts the command in a session of its own so a timeout can take down everything it started
+SESSION_LAUNCHER = '''import os, sys
+os.setsid()
+try:
+    os.execvp(sys.argv[1], sys.argv[1:])
+except OSError as error:
+    sys.stderr.write('{}: {}\\n'.format(sys.argv[1], error.strerror))
+    os._exit(127)
+'''
+
+class StreamingProcess(ProcessProtocol):
+    # output is handed over as it is read, nothing is kept here however long the log gets
+    def __init__(self, deferred, receiver):
+        self.deferred = deferred # type: defer.Deferred
+        self.receiver = receiver # type: callable
+
+    def outReceived(self, data):
+        self.receiver('stdout', data)
+
+    def errReceived(self, data):
+        self.receiver('stderr', data)
+
+    def processEnded(self, reason):
+        if self.deferred.called: return
+        if reason.check(ProcessDone, ProcessTerminated):
+            self.deferred.callback((reason.value.exitCode, reason.value.signal))
+        else:
+            self.deferred.errback(reason)
+
+def signal_process_group(process, pid, signum): # type: (IProcessTransport, int, int)->bool
+    try:
+        os.killpg(pid, signum)
+        return True
+    except OSError: pass
+    # cancelled before the launcher got to setsid there is no group yet, the launcher itself still takes the signal
+    if process.pid != pid: return False
+    try:
+        os.kill(pid, signum)
+        return True
+    except OSError: return False
+
+def kill_process_group(process, grace=5.0, clock=reactor): # type: (IProcessTransport, float, any)->None
+    pid = process.pid
+    if not pid: return
+    if not signal_process_group(process, pid, signal.SIGTERM): return
+    clock.callLater(grace, signal_process_group, process, pid, signal.SIGKILL)
+    process.resumeProducing() # keep draining the pipes so the end of the process is noticed
+
+def run_streaming_command(args, receiver, cwd=None, env=None, kill_grace=5.0, clock=reactor):
+    # type: (list[str], callable, str, dict, float, any)->tuple[defer.Deferred, IProcessTransport]
+    deferred = defer.Deferred(canceller=lambda _: kill_process_group(process, kill_grace, clock))
+    environment = dict(os.environ, **(env or {}))
+    process = reactor.spawnProcess(StreamingProcess(deferred, receiver), sys.executable,
+                                   [sys.executable, '-c', SESSION_LAUNCHER] + list(args), env=environment, path=cwd)
+    return deferred, process
+
+def run_command(args, timeout=0, clock=reactor): # type: (list[str], float, any)->defer.Deferred
+    def cancel(_):
+        if process.pid: process.signalProcess('KILL')
+    deferred = defer.Deferred(canceller=cancel)
+    process = reactor.spawnProcess(CommandProcess(deferred), args[0], args, env=os.environ)
+    if timeout > 0: deferred.addTimeout(timeout, clock)
+    return deferred
+
+class MissionExecutor(object):
+    def __init__(self, max_processes=4, concurrency=None):
+        self.processes = defer.DeferredSemaphore(max_processes)
+        self.concurrency = concurrency or {} # type: dict[any, int]
+        self.default_concurrency = 4
+        self.__semaphores = {} # type: dict[any, defer.DeferredSemaphore]
+
+    def __semaphore(self, name):
+        if name not in self.__semaphores:
+            self.__semaphores[name] = defer.DeferredSemaphore(self.concurrency.get(name, self.default_concurrency))
+        return self.__semaphores[name]
+
+    def submit(self, name, func, *args, **kwargs): # type: (any, callable, ...)->defer.Deferred
+        return self.__semaphore(name).run(defer.maybeDeferred, func, *args, **kwargs)
+
+    def spawn(self, args, timeout=0): # type: (list[str], float)->defer.Deferred
+        return self.processes.run(run_command, args, timeout=timeout)
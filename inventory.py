@@ -0,0 +1,91 @@
+#!/usr/bin/env python3
+import json, hashlib, os
+from logger import LOG
+
+__author__ = 'larryhou'
+
+def digest(data): # type: (dict)->str
+    text = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+def machine_id(data): # type: (dict)->str
+    hardware = data.get('SPHardwareDataType') or {}
+    for _, section in hardware.items():
+        if not isinstance(section, dict): continue
+        for _, overview in section.items():
+            if isinstance(overview, dict) and overview.get('HardwareUUID'):
+                return overview.get('HardwareUUID')
+    uname = data.get('uname') or ''  # type: str
+    fields = uname.split(' ')
+    return fields[1] if len(fields) > 1 else uname
+
+def is_offer(payload): # type: (dict)->bool
+    # an offer names the inventory by its digest and carries neither the inventory nor a delta
+    return bool(payload) and set(payload) == {'machine', 'digest'}
+
+def diff(base, data, path=()): # type: (dict, dict, tuple)->dict
+    delta = {'set': [], 'unset': []}
+    for k, v in data.items():
+        if k not in base:
+            delta['set'].append([list(path) + [k], v])
+        elif isinstance(v, dict) and isinstance(base[k], dict):
+            child = diff(base[k], v, path + (k,))
+            delta['set'].extend(child['set'])
+            delta['unset'].extend(child['unset'])
+        elif v != base[k]:
+            delta['set'].append([list(path) + [k], v])
+    for k in base:
+        if k not in data: delta['unset'].append(list(path) + [k])
+    return delta
+
+def patch(base, delta): # type: (dict, dict)->dict
+    result = json.loads(json.dumps(base))
+    for path in delta.get('unset', []):
+        cursor = result
+        for k in path[:-1]: cursor = cursor.get(k, {})
+        cursor.pop(path[-1], None)
+    for path, value in delta.get('set', []):
+        cursor = result
+        for k in path[:-1]: cursor = cursor.setdefault(k, {})
+        cursor[path[-1]] = value
+    return result
+
+class InventoryStore(object):
+    def __init__(self, filename=None):
+        self.filename = filename # type: str
+        self.dirty = False
+        self.__entries = {} # type: dict[str, dict]
+
+    def __len__(self):
+        return len(self.__entries)
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename): return self
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fp:
+                self.__entries = json.load(fp)
+        except (IOError, ValueError) as error:
+            LOG.warning('-- inventory load failed {} {}', self.filename, error)
+        return self
+
+    def save(self):
+        if not self.filename or not self.dirty: return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory): os.makedirs(directory)
+        temp = self.filename + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as fp:
+            json.dump(self.__entries, fp, ensure_ascii=False)
+        os.replace(temp, self.filename)
+        self.dirty = False
+
+    def get(self, machine): # type: (str)->dict
+        entry = self.__entries.get(machine)
+        return entry if entry else None
+
+    def put(self, machine, data, data_digest=None): # type: (str, dict, str)->str
+        data_digest = data_digest or digest(data)
+        entry = self.__entries.get(machine)
+        if entry and entry.get('digest') == data_digest: return data_digest
+        self.__entries[machine] = {'digest': data_digest, 'data': data}
+        self.dirty = True
+        return data_digest
@@ -0,0 +1,436 @@
+#!/usr/bin/env python3
+from twisted.internet import reactor, defer, task
+from twisted.internet.endpoints import TCP4ClientEndpoint
+from twisted.internet.protocol import Factory, ReconnectingClientFactory
+from shared import *
+import client_mission # imports client on the way, the other order trips over their cycle
+from client import ClientSlaveConnection, ClientSlaveConnectionFactory
+from server import ClientConnectionFactory, RelayConnectionFactory
+from inventory import InventoryStore
+from state import QueenState
+from telemetry import percentile
+from benchmark import sample_hardware, sample_storage, sample_network, sample_usb
+import os, sys, json, time, signal, socket, subprocess, collections, psutil, tempfile, shutil
+
+__author__ = 'larryhou'
+
+SCENARIOS = ('heartbeat', 'broadcast', 'stats', 'reconnect', 'storm')
+
+class StubMemory(collections.namedtuple('StubMemory', 'total available percent used free')):
+    pass
+
+class StubPsutil(object):
+    @staticmethod
+    def cpu_percent(*args, **kwargs):
+        return 12.5
+
+    @staticmethod
+    def virtual_memory():
+        return StubMemory(total=103079215104, available=64206766080, percent=37.7, used=31583354880, free=2147483648)
+
+class SimulatedSlave(ClientSlaveConnection):
+    def __init__(self, address, factory, seed):
+        super(SimulatedSlave, self).__init__(address, factory)
+        self.seed = seed
+        self.verbose = False
+        self.features = set(factory.features)
+        self.information = {'uname': 'Darwin mac-{}.local 19.6.0 Darwin Kernel Version 19.6.0 x86_64'.format(seed),
+                            'whoami': 'larryhou', 'osversion': '10.15.7', 'tags': [],
+                            'SPHardwareDataType': sample_hardware(seed), 'SPStorageDataType': sample_storage(seed),
+                            'SPNetworkDataType': sample_network(seed), 'SPDisplaysDataType': {},
+                            'SPUSBDataType': sample_usb(seed, devices=8)}
+
+    def run_system_profiler(self, name, refresh=False):
+        return defer.succeed(self.information.get(name) or {})
+
+    def describe_host(self):
+        return self.information
+
+    def collect_system_information(self, refresh=False):
+        self.system_information = self.information
+        return defer.succeed(self.information)
+
+    def packReceived(self, msg):
+        super(SimulatedSlave, self).packReceived(msg)
+        self.factory.harness.received(self, msg)
+
+class SimulatedSlaveFactory(ClientSlaveConnectionFactory):
+    def __init__(self, harness, seed):
+        super(SimulatedSlaveFactory, self).__init__(max_processes=1)
+        self.harness = harness # type: FleetHarness
+        self.seed = seed
+        self.features = harness.features
+        self.initialDelay = 0.05
+        self.maxDelay = 2.0
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        self.connection = SimulatedSlave(address=addr, factory=self, seed=self.seed)
+        self.connection.compress_threshold = self.compress_threshold
+        return self.connection
+
+    def clientConnectionFailed(self, connector, reason):
+        self.connection = None
+        ReconnectingClientFactory.clientConnectionFailed(self, connector, reason)
+
+    def clientConnectionLost(self, connector, reason):
+        self.connection = None
+        ReconnectingClientFactory.clientConnectionLost(self, connector, reason)
+
+class Requester(TCP):
+    def __init__(self, address):
+        super(Requester, self).__init__(address=address, verbose=False)
+        self.ready = defer.Deferred()
+        self.__expect = None # type: int
+        self.__waiter = None # type: defer.Deferred
+
+    def connectionMade(self):
+        self.negotiate()
+
+    def negotiated(self):
+        if not self.ready.called: self.ready.callback(self)
+
+    def request(self, command, data, expect): # type: (int, dict, int)->defer.Deferred
+        self.__expect, self.__waiter = expect, defer.Deferred()
+        self.send(command=command, data=data)
+        return self.__waiter
+
+    def packReceived(self, msg):
+        if msg.get('command') != self.__expect or not self.__waiter: return
+        waiter, self.__waiter = self.__waiter, None
+        waiter.callback(msg)
+
+class InProcessQueen(object):
+    # a queen in the harness process that stands in for a server.py subprocess, its timers can run on a task.Clock
+    # so scenarios work as tests, but its cpu and rss are those of the harness too
+    def __init__(self, port, upstream=None, inventory=None, state=None, clock=None):
+        self.pid = os.getpid()
+        self.returncode = None
+        self.factory = factory = ClientConnectionFactory()
+        if clock: factory.clock = clock
+        factory.verbose = False
+        factory.telemetry_interval = 0
+        factory.suspect_after = factory.dead_after = 86400
+        factory.inventory = InventoryStore(filename=inventory).load()
+        if state: factory.restore(QueenState(filename=state).load())
+        self.port = reactor.listenTCP(port, factory, backlog=1024, interface='127.0.0.1')
+        self.upstream = None # type: RelayConnectionFactory
+        if upstream:
+            self.upstream = RelayConnectionFactory(queen=factory)
+            reactor.connectTCP('127.0.0.1', upstream, self.upstream)
+        self.__stopped = None # type: defer.Deferred
+
+    def poll(self):
+        return self.returncode
+
+    def __stop(self, clean):
+        if self.returncode is not None: return
+        self.returncode = 0 if clean else -signal.SIGKILL
+        # a clean stop writes the snapshot the way server.py does on shutdown, the stores are let go after that
+        # so the connections closing below cannot write over it
+        if clean: self.factory.flush_state()
+        self.factory.inventory, self.factory.state = InventoryStore(), QueenState()
+        if self.upstream:
+            self.upstream.stopTrying()
+            if self.upstream.connection: self.upstream.connection.transport.loseConnection()
+        self.__stopped = defer.maybeDeferred(self.port.stopListening)
+        for client in list(self.factory.clients.values()):
+            client.transport.loseConnection() if clean else client.transport.abortConnection()
+
+    def terminate(self): self.__stop(clean=True)
+    def kill(self): self.__stop(clean=False)
+
+    def wait(self): # type: ()->defer.Deferred
+        return self.__stopped
+
+class FleetHarness(object):
+    def __init__(self, options, clock=None):
+        self.options = options
+        self.clock = clock # type: task.Clock
+        self.features = {FEATURE_INVENTORY_DELTA, FEATURE_ADMISSION}
+        self.factories = [] # type: list[SimulatedSlaveFactory]
+        self.requesters = [] # type: list[Requester]
+        self.queen = None # type: subprocess.Popen|InProcessQueen
+        self.port = options.port or self.free_port()
+        self.relays = [] # type: list[tuple[subprocess.Popen|InProcessQueen, int]]
+        self.directory = tempfile.mkdtemp(prefix='loadgen-')
+        self.inventory = os.path.join(self.directory, 'inventory.json')
+        self.state = os.path.join(self.directory, 'queen-state.json')
+        self.__watches = {} # type: dict[int, list]
+
+    @staticmethod
+    def free_port():
+        with socket.socket() as sock:
+            sock.bind(('127.0.0.1', 0))
+            return sock.getsockname()[1]
+
+    @property
+    def slaves(self): # type: ()->list[SimulatedSlave]
+        return [x.connection for x in self.factories if x.connection]
+
+    def watch(self, command, count, callback=None): # type: (int, int, callable)->defer.Deferred
+        waiter = defer.Deferred()
+        self.__watches[command] = [count, waiter, callback]
+        if count <= 0: self.__fire(command)
+        return waiter
+
+    def unwatch(self, command):
+        self.__watches.pop(command, None)
+
+    def __fire(self, command):
+        _, waiter, _ = self.__watches.pop(command)
+        waiter.callback(None)
+
+    def received(self, slave, msg): # type: (SimulatedSlave, dict)->None
+        command = msg.get('command')
+        watch = self.__watches.get(command)
+        if not watch: return
+        if watch[2]: watch[2](slave, msg)
+        watch[0] -= 1
+        if watch[0] <= 0: self.__fire(command)
+
+    def spawn_queen(self, port, *extra): # type: (int, str)->subprocess.Popen
+        args = [sys.executable, os.path.join(os.path.dirname(os.path.abspath(__file__)), 'server.py'), '-p', str(port),
+                '--quiet', '--inventory', '', '--telemetry-interval', '0', '--suspect-after', '86400', '--dead-after', '86400']
+        process = subprocess.Popen(args + list(extra) + self.options.queen_args, stdout=subprocess.DEVNULL)
+        for _ in range(100):
+            try:
+                socket.create_connection(('127.0.0.1', port), timeout=0.1).close()
+                return process
+            except OSError: time.sleep(0.1)
+        raise RuntimeError('queen did not start on port {}'.format(port))
+
+    def launch_queen(self, port, upstream=None): # type: (int, int)->subprocess.Popen|InProcessQueen
+        # only the root queen keeps state, the storm scenario restarts it from there
+        if self.options.in_process:
+            if upstream: return InProcessQueen(port, upstream=upstream, clock=self.clock)
+            return InProcessQueen(port, inventory=self.inventory, state=self.state, clock=self.clock)
+        if upstream: return self.spawn_queen(port, '--upstream', '127.0.0.1:{}'.format(upstream))
+        return self.spawn_queen(port, '--inventory', self.inventory, '--state', self.state)
+
+    def start_queen(self):
+        self.queen = self.launch_queen(self.port)
+        for _ in range(self.options.relays):
+            port = self.free_port()
+            self.relays.append((self.launch_queen(port, upstream=self.port), port))
+
+    @defer.inlineCallbacks
+    def stop_queen(self):
+        for process in [self.queen] + [x for x, _ in self.relays]:
+            if process and process.poll() is None:
+                process.terminate()
+                yield process.wait()
+        shutil.rmtree(self.directory, ignore_errors=True)
+
+    def queen_usage(self): # type: ()->tuple[float, int]
+        process = psutil.Process(self.queen.pid)
+        times = process.cpu_times()
+        return times.user + times.system, process.memory_info().rss
+
+    @defer.inlineCallbacks
+    def connect(self):
+        ready = self.watch(Commands.INVENTORY_DIGEST_RSP, self.options.slaves)
+        # with relays the slaves are spread over them and only requesters talk to the root queen
+        ports = [x for _, x in self.relays] or [self.port]
+        for n in range(self.options.slaves):
+            factory = SimulatedSlaveFactory(harness=self, seed=n)
+            self.factories.append(factory)
+            reactor.connectTCP('127.0.0.1', ports[n % len(ports)], factory)
+            if n % 100 == 99: yield task.deferLater(reactor, 0, lambda: None) # let the queen accept in batches
+        yield ready.addTimeout(self.options.timeout, reactor)
+        yield self.connect_requesters()
+
+    @defer.inlineCallbacks
+    def connect_requesters(self):
+        self.requesters = []
+        endpoint = TCP4ClientEndpoint(reactor, '127.0.0.1', self.port)
+        for _ in range(self.options.requesters):
+            requester = yield endpoint.connect(Factory.forProtocol(lambda: Requester(address=None)))
+            self.requesters.append((yield requester.ready))
+
+    @defer.inlineCallbacks
+    def run(self, name):
+        scenario = getattr(self, 'scenario_{}'.format(name))
+        queen, (cpu, _) = self.queen, self.queen_usage()
+        elapse = time.perf_counter()
+        try:
+            report = yield scenario()
+        except defer.TimeoutError:
+            report = {'error': 'timeout after {}s'.format(self.options.timeout)}
+        elapse = time.perf_counter() - elapse
+        usage, rss = self.queen_usage()
+        if self.queen.pid != queen.pid: cpu = 0.0 # restarted by the scenario, the new queen counts from its start
+        if self.options.in_process: report['in_process'] = True # the queen figures include the harness
+        report.update(scenario=name, slaves=self.options.slaves, requesters=len(self.requesters), seconds=round(elapse, 3),
+                      queen={'cpu_seconds': round(usage - cpu, 3), 'cpu_ms_per_connection': round((usage - cpu) * 1e3 / self.options.slaves, 3),
+                             'rss_mb': round(rss / (1 << 20), 2), 'rss_kb_per_connection': round(rss / 1024.0 / self.options.slaves, 2)})
+        if 'messages' in report: report['messages_per_second'] = round(report['messages'] / elapse)
+        return report
+
+    @staticmethod
+    def latency(samples): # type: (list[float])->dict
+        samples = sorted(samples)
+        return {'p50_ms': round(percentile(samples, 50) * 1e3, 3) if samples else None,
+                'p99_ms': round(percentile(samples, 99) * 1e3, 3) if samples else None,
+                'max_ms': round(samples[-1] * 1e3, 3) if samples else None}
+
+    @defer.inlineCallbacks
+    def scenario_heartbeat(self):
+        slaves, rounds, latencies = self.slaves, self.options.rounds, []
+        done = self.watch(Commands.HEARTBEAT_RSP, len(slaves) * rounds,
+                          lambda slave, msg: latencies.append(time.time() - msg['data']['ts']))
+        for _ in range(rounds):
+            for slave in slaves: slave.send_heartbeat()
+        yield done.addTimeout(self.options.timeout, reactor)
+        return {'messages': 2 * len(slaves) * rounds, 'latency': self.latency(latencies)}
+
+    @defer.inlineCallbacks
+    def scenario_broadcast(self):
+        slaves, latencies, sequence = self.slaves, [], [0]
+        def chat(requester):
+            for _ in range(self.options.rounds):
+                sequence[0] += 1
+                stime = time.time()
+                # the queen answers the sender before it fans out, wait for every slave to get the chat
+                delivered = self.watch(Commands.BROADCAST_NOTIFY, len(slaves))
+                yield requester.request(Commands.BROADCAST_REQ, {'msg': 'Hi~', 'type': Broadcasts.CHAT, 'seq': sequence[0]},
+                                        expect=Commands.BROADCAST_RSP)
+                yield delivered
+                latencies.append(time.time() - stime)
+        # chats from several requesters would share the notify watch, so they take turns
+        for requester in self.requesters:
+            yield defer.inlineCallbacks(chat)(requester).addTimeout(self.options.timeout, reactor)
+        count = len(latencies)
+        return {'rounds': count, 'messages': count * (len(slaves) + 2), 'latency': self.latency(latencies)}
+
+    @defer.inlineCallbacks
+    def scenario_stats(self):
+        latencies, artifacts = [], []
+        @defer.inlineCallbacks
+        def collaborate(requester):
+            for _ in range(self.options.rounds):
+                stime = time.time()
+                notify = yield requester.request(Commands.COLLABORATE_REQ, {'mission': CollaborateMissions.REPORT_SYSTEM_STATS,
+                                                                           'mission_timeout': self.options.timeout},
+                                                 expect=Commands.COLLABORATE_NOTIFY)
+                latencies.append(time.time() - stime)
+                artifacts.append(len(notify.get('data') or ()))
+        yield defer.gatherResults([collaborate(x) for x in self.requesters]).addTimeout(self.options.timeout * self.options.rounds, reactor)
+        # an artifact costs mission req/rsp and complete req/rsp, requests merged into a running round share them
+        return {'rounds': len(latencies), 'artifacts': sum(artifacts), 'messages': sum(artifacts) * 4 + len(latencies) * 3,
+                'latency': self.latency(latencies)}
+
+    @defer.inlineCallbacks
+    def scenario_reconnect(self):
+        slaves, dropped, latencies = self.slaves, {}, []
+        done = self.watch(Commands.INVENTORY_DIGEST_RSP, len(slaves),
+                          lambda slave, msg: latencies.append(time.time() - dropped[slave.seed]))
+        for slave in slaves:
+            dropped[slave.seed] = time.time()
+            slave.transport.loseConnection()
+        yield done.addTimeout(self.options.timeout, reactor)
+        # negotiate, serve as slave, heartbeat and inventory digest, each answered by the queen
+        return {'messages': len(slaves) * 8, 'latency': self.latency(latencies)}
+
+    @defer.inlineCallbacks
+    def scenario_storm(self):
+        # the queen restarts under the whole fleet, first warm from its snapshot and then cold without one
+        if self.relays: return {'error': 'storm restarts the queen the slaves are connected to, run it without relays'}
+        report = {}
+        for warm in (True, False): report['warm' if warm else 'cold'] = yield self.restart_storm(warm)
+        yield self.connect_requesters()
+        report['messages'] = sum(x['messages'] for x in report.values())
+        return report
+
+    @defer.inlineCallbacks
+    def restart_storm(self, warm): # type: (bool)->dict
+        count, serving, counters = len(self.factories), {}, collections.Counter()
+        done = defer.Deferred()
+        def served(slave):
+            if slave.seed in serving: return
+            serving[slave.seed] = time.time() - start
+            if len(serving) == count: done.callback(None)
+        def admitted(slave, msg):
+            counters['deferred' if msg.get('retcode') == Exceptions.HANDSHAKE_DEFERRED else 'admitted'] += 1
+        def digested(slave, msg):
+            want = (msg.get('data') or {}).get('want')
+            counters[want] += 1
+            if want == 'none': served(slave)
+        def acknowledged(slave, msg):
+            if str(msg.get('data')).startswith(':{} '.format(Commands.SYSTEM_INFORMATION_NOTIFY)): served(slave)
+        watches = {Commands.SERVE_AS_SLAVE_RSP: admitted, Commands.INVENTORY_DIGEST_RSP: digested, Commands.ACKNOWLEDGE: acknowledged}
+        if warm: self.queen.terminate() # a clean stop writes the snapshot on the way out
+        else: self.queen.kill()
+        yield self.queen.wait()
+        if not warm:
+            for filename in (self.inventory, self.state):
+                if os.path.exists(filename): os.remove(filename)
+        # a subprocess queen blocks the reactor until it listens, so every slave sees the drop and storms it at once
+        self.queen = self.launch_queen(self.port)
+        start = time.time()
+        for command, callback in watches.items(): self.watch(command, count * 100, callback)
+        try:
+            yield done.addTimeout(self.options.timeout, reactor)
+        finally:
+            for command in watches: self.unwatch(command)
+        usage, rss = self.queen_usage()
+        latencies = list(serving.values())
+        # negotiate, heartbeat, serve as slave with every deferral and the inventory exchange, each answered
+        messages = count * 6 + counters['deferred'] * 2 + (counters['full'] + counters['diff']) * 2
+        return {'serving_seconds': round(max(latencies), 3), 'latency': self.latency(latencies), 'messages': messages,
+                'handshakes': dict(counters), 'queen': {'cpu_seconds': round(usage, 3), 'rss_mb': round(rss / (1 << 20), 2)}}
+
+def git_revision():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode('utf-8').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+@defer.inlineCallbacks
+def run_fleet(options):
+    harness = FleetHarness(options)
+    result = {'revision': git_revision(), 'slaves': options.slaves, 'relays': options.relays, 'requesters': options.requesters,
+              'rounds': options.rounds, 'scenarios': []}
+    try:
+        harness.start_queen()
+        elapse = time.perf_counter()
+        yield harness.connect()
+        result['connect_seconds'] = round(time.perf_counter() - elapse, 3)
+        for name in options.scenarios:
+            print('-- scenario {}'.format(name), file=sys.stderr)
+            result['scenarios'].append((yield harness.run(name)))
+    except Exception as error:
+        result['error'] = repr(error)
+    finally:
+        for factory in harness.factories: factory.stopTrying()
+        yield harness.stop_queen()
+    output = json.dumps(result, indent=4)
+    if options.output:
+        with open(options.output, 'w') as fp: fp.write(output)
+    print(output)
+
+def main():
+    import argparse
+    arguments = argparse.ArgumentParser(description='run simulated slaves against a local queen and report JSON')
+    arguments.add_argument('--slaves', type=int, default=1000)
+    arguments.add_argument('--requesters', type=int, default=4, help='concurrent check.py style clients')
+    arguments.add_argument('--rounds', type=int, default=5, help='rounds per requester in each scenario')
+    arguments.add_argument('--scenarios', nargs='+', choices=SCENARIOS, default=list(SCENARIOS))
+    arguments.add_argument('--timeout', type=float, default=60, help='seconds a single scenario step may take')
+    arguments.add_argument('--port', type=int, default=0, help='queen port, a free one by default')
+    arguments.add_argument('--relays', type=int, default=0, help='relays between the queen and the slaves')
+    arguments.add_argument('--in-process', action='store_true',
+                           help='run the queens in this process instead of server.py subprocesses, their cpu and rss include the harness')
+    arguments.add_argument('--queen-args', nargs=argparse.REMAINDER, default=[], help='extra server.py arguments, not for --in-process')
+    arguments.add_argument('--output', '-o', help='also write the JSON report to this file')
+    options = arguments.parse_args(sys.argv[1:])
+    # missions report canned numbers so the harness measures the queen and not psutil
+    client_mission.psutil = StubPsutil
+    # the report goes to stdout, in process queens log nowhere like the subprocess ones
+    if options.in_process: LOG.configure(filename=os.devnull, max_bytes=0)
+    run_fleet(options).addBoth(lambda _: reactor.stop())
+    reactor.run()
+
+if __name__ == '__main__':
+    main()
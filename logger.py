@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+import os, sys, json, time, queue, datetime, threading, atexit
+
+__author__ = 'larryhou'
+
+DEBUG = 10
+INFO = 20
+WARNING = 30
+ERROR = 40
+
+LEVEL_NAMES = {DEBUG: 'DEBUG', INFO: 'INFO', WARNING: 'WARNING', ERROR: 'ERROR'}
+
+def parse_level(name): # type: (str|int)->int
+    if isinstance(name, int): return name
+    for level, text in LEVEL_NAMES.items():
+        if text == str(name).upper(): return level
+    raise ValueError('unknown log level {!r}'.format(name))
+
+def truncate(value, limit): # type: (any, int)->str
+    if isinstance(value, str):
+        text = value
+    else:
+        # iterencode lets a huge payload stop after the first chunks instead of being dumped whole
+        chunks, size = [], 0
+        for chunk in json.JSONEncoder(ensure_ascii=False, default=str).iterencode(value):
+            chunks.append(chunk)
+            size += len(chunk)
+            if size > limit: break
+        text = ''.join(chunks)
+    if len(text) > limit: text = '{}...<truncated>'.format(text[:limit])
+    return text
+
+class RotatingWriter(object):
+    def __init__(self, filename=None, max_bytes=64 << 20, backups=5):
+        self.filename = filename # type: str
+        self.max_bytes = max_bytes
+        self.backups = backups
+        self.__stream = None
+        self.__size = 0
+
+    def __open(self):
+        if not self.filename: return sys.stdout
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory): os.makedirs(directory)
+        stream = open(self.filename, 'a', encoding='utf-8')
+        self.__size = stream.tell()
+        return stream
+
+    def __rotate(self):
+        self.__stream.close()
+        for n in range(self.backups - 1, 0, -1):
+            source = '{}.{}'.format(self.filename, n)
+            if os.path.exists(source): os.replace(source, '{}.{}'.format(self.filename, n + 1))
+        if self.backups > 0: os.replace(self.filename, self.filename + '.1')
+        else: os.remove(self.filename)
+        self.__stream = self.__open()
+
+    def write(self, line): # type: (str)->None
+        if self.__stream is None: self.__stream = self.__open()
+        self.__stream.write(line)
+        if not self.filename: return
+        self.__size += len(line)
+        if 0 < self.max_bytes <= self.__size: self.__rotate()
+
+    def flush(self):
+        if self.__stream: self.__stream.flush()
+
+    def close(self):
+        if self.__stream and self.filename: self.__stream.close()
+        self.__stream = None
+
+class AsyncLogger(object):
+    def __init__(self, level=INFO, capacity=10000, max_field=2048):
+        self.level = level
+        self.max_field = max_field
+        self.structured = False
+        self.sample_rates = {} # type: dict[any, int]
+        self.dropped = 0
+        self.writer = RotatingWriter()
+        self.__samples = {} # type: dict[any, int]
+        self.__queue = queue.Queue(maxsize=capacity)
+        self.__thread = None # type: threading.Thread
+
+    def configure(self, level=None, filename=None, max_bytes=None, backups=None, capacity=None, sample_rates=None, structured=None):
+        self.close()
+        if level is not None: self.level = parse_level(level)
+        if filename is not None: self.writer = RotatingWriter(filename=filename or None,
+                                                              max_bytes=self.writer.max_bytes, backups=self.writer.backups)
+        if max_bytes is not None: self.writer.max_bytes = max_bytes
+        if backups is not None: self.writer.backups = backups
+        if capacity is not None: self.__queue = queue.Queue(maxsize=capacity)
+        if sample_rates is not None: self.sample_rates = dict(sample_rates)
+        if structured is not None: self.structured = structured
+
+    def enabled(self, level): # type: (int)->bool
+        return level >= self.level
+
+    def sampled(self, key): # type: (any)->bool
+        rate = self.sample_rates.get(key, 1)
+        if rate == 1: return True
+        if rate <= 0: return False
+        count = self.__samples[key] = self.__samples.get(key, 0) + 1
+        return count % rate == 1
+
+    def log(self, level, message, *args, **fields):
+        if level < self.level: return
+        if self.__thread is None: self.__start()
+        # payloads are still the caller's to mutate, only an immutable truncated copy crosses to the writer thread
+        fields = {k: truncate(v, self.max_field) for k, v in fields.items()}
+        try:
+            # the rest of the formatting is deferred to the writer thread
+            self.__queue.put_nowait((time.time(), level, message, args, fields))
+        except queue.Full:
+            self.dropped += 1
+
+    def debug(self, message, *args, **fields): self.log(DEBUG, message, *args, **fields)
+    def info(self, message, *args, **fields): self.log(INFO, message, *args, **fields)
+    def warning(self, message, *args, **fields): self.log(WARNING, message, *args, **fields)
+    def error(self, message, *args, **fields): self.log(ERROR, message, *args, **fields)
+
+    def __start(self):
+        self.__thread = threading.Thread(target=self.__run, name='logger', daemon=True)
+        self.__thread.start()
+
+    def format(self, record): # type: (tuple)->str
+        ts, level, message, args, fields = record
+        try:
+            text = message.format(*args) if args else message
+        except Exception as error:
+            text = '{} <format error {!r}>'.format(message, error)
+        stamp = datetime.datetime.fromtimestamp(ts).isoformat()
+        if self.structured:
+            return json.dumps(dict(fields, ts=stamp, level=LEVEL_NAMES.get(level, level), msg=text), ensure_ascii=False) + '\n'
+        pairs = ''.join(' {}={}'.format(k, v) for k, v in fields.items())
+        return '[{}] {} {}{}\n'.format(stamp, LEVEL_NAMES.get(level, level), text, pairs)
+
+    def __run(self):
+        reported = 0
+        while True:
+            record = self.__queue.get()
+            if record is not None: self.writer.write(self.format(record))
+            if record is None or self.__queue.empty():
+                if self.dropped > reported:
+                    self.writer.write(self.format((time.time(), WARNING, 'dropped {} log records, queue is full', (self.dropped - reported,), {})))
+                    reported = self.dropped
+                self.writer.flush()
+            if record is None: break
+
+    def close(self, timeout=5.0):
+        if self.__thread is None: return
+        try:
+            self.__queue.put(None, timeout=timeout)
+        except queue.Full: pass
+        self.__thread.join(timeout)
+        self.__thread = None
+        self.writer.close()
+
+LOG = AsyncLogger()
+atexit.register(LOG.close)
+
+def add_arguments(arguments): # type: (argparse.ArgumentParser)->None
+    arguments.add_argument('--log-level', default='info', help='debug, info, warning or error')
+    arguments.add_argument('--log-file', help='write logs here with rotation instead of stdout')
+    arguments.add_argument('--log-max-size', type=int, default=64, help='rotate the log file at this size in MB')
+    arguments.add_argument('--log-backups', type=int, default=5, help='rotated log files to keep')
+    arguments.add_argument('--log-sample', action='append', default=[], metavar='COMMAND=N',
+                           help='log one in N frames of a command, e.g. CollaborateCompleteReq=10, 0 to mute')
+    arguments.add_argument('--log-json', action='store_true', help='write one JSON object per line')
+
+def configure(options):
+    sample_rates = {}
+    for item in options.log_sample:
+        name, _, rate = item.partition('=')
+        sample_rates[name.strip()] = int(rate or 0)
+    LOG.configure(level=options.log_level, filename=os.path.expanduser(options.log_file) if options.log_file else '',
+                  max_bytes=options.log_max_size << 20, backups=options.log_backups,
+                  sample_rates=sample_rates, structured=options.log_json)
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+from fnmatch import fnmatchcase
+import json
+
+__author__ = 'larryhou'
+
+class Projection(object):
+    # key paths like "MEM.percent" or "Storage.*.Capacity", every segment is a glob matched against one level of keys,
+    # an include keeps the whole subtree under the path and an exclude drops it
+    def __init__(self, include=None, exclude=None):
+        self.include = sorted(set(include)) if include else None # type: list[str]
+        self.exclude = sorted(set(exclude or ())) # type: list[str]
+        self.__include = [tuple(x.split('.')) for x in self.include] if self.include else None
+        self.__exclude = [tuple(x.split('.')) for x in self.exclude]
+
+    @classmethod
+    def parse(cls, spec): # type: (list|dict|str)->Projection
+        if not spec: return None
+        if isinstance(spec, str): spec = [spec]
+        if isinstance(spec, (list, tuple)): spec = {'include': spec}
+        if not isinstance(spec, dict) or set(spec) - {'include', 'exclude'}:
+            raise ValueError('projection must be a list of key paths or an include/exclude object')
+        paths = {}
+        for name in ('include', 'exclude'):
+            value = spec.get(name) or []
+            if isinstance(value, str): value = [value]
+            if not isinstance(value, (list, tuple)) or not all(isinstance(x, str) and x and '' not in x.split('.') for x in value):
+                raise ValueError('bad projection {} paths {!r}'.format(name, value))
+            paths[name] = value
+        if not paths['include'] and not paths['exclude']: return None
+        return cls(include=paths['include'], exclude=paths['exclude'])
+
+    @property
+    def key(self): # type: ()->str
+        return json.dumps(self.describe(), sort_keys=True, separators=(',', ':'))
+
+    def describe(self): # type: ()->dict
+        spec = {'exclude': self.exclude} if self.exclude else {}
+        if self.include: spec['include'] = self.include
+        return spec
+
+    def wants(self, name): # type: (str)->bool
+        # whether anything below a top level key can survive, so producers can skip the work for it
+        if any(len(x) == 1 and fnmatchcase(name, x[0]) for x in self.__exclude): return False
+        return self.__include is None or any(fnmatchcase(name, x[0]) for x in self.__include)
+
+    def apply(self, data): # type: (dict)->dict
+        return self.__project(data, self.__include, self.__exclude)
+
+    def __project(self, data, include, exclude): # type: (dict, list[tuple], list[tuple])->dict
+        result = {}
+        for k, v in data.items():
+            excluded = [x[1:] for x in exclude if fnmatchcase(k, x[0])]
+            if any(not x for x in excluded): continue
+            included = None
+            if include is not None:
+                included = [x[1:] for x in include if fnmatchcase(k, x[0])]
+                if not included: continue
+                if any(not x for x in included): included = None
+            if isinstance(v, dict) and (included is not None or excluded):
+                v = self.__project(v, included, excluded)
+            result[k] = v
+        return result
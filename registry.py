@@ -0,0 +1,196 @@
+#!/usr/bin/env python3
+import re, fnmatch, platform
+
+__author__ = 'larryhou'
+
+ATTRIBUTE_ALIASES = {
+    'model': 'modelidentifier',
+    'cpu': 'totalnumberofcores',
+    'cpus': 'totalnumberofcores',
+    'cores': 'totalnumberofcores',
+    'mem': 'memory',
+    'os': 'osversion',
+    'user': 'whoami',
+    'tag': 'tags',
+}
+
+SIZE_UNITS = {'kb': 1.0 / (1 << 20), 'mb': 1.0 / (1 << 10), 'gb': 1.0, 'tb': float(1 << 10)}
+
+SIZE_PATTERN = re.compile(r'^([\d.]+)\s*(kb|mb|gb|tb)$')
+NUMBER_PATTERN = re.compile(r'^(\d+(?:\.\d+)*)(\s*[kmg]?hz|\s.*)?$')
+CLAUSE_PATTERN = re.compile(r'^(.+?)\s*(>=|<=|!=|==|=|>|<|~)\s*(.+)$')
+LIMIT_PATTERN = re.compile(r'^any\s+(\d+)\b\s*')
+
+def normalize_attribute(name): # type: (str)->str
+    name = re.sub(r'[^a-z0-9]', '', name.lower())
+    return ATTRIBUTE_ALIASES.get(name, name)
+
+def parse_value(text): # type: (str)->any
+    # sizes come out in GB, dotted numbers as version tuples whatever unit follows them, other numbers as floats
+    text = str(text).strip().lower()
+    match = SIZE_PATTERN.match(text)
+    if match:
+        try:
+            return float(match.group(1)) * SIZE_UNITS[match.group(2)]
+        except ValueError: pass
+    match = NUMBER_PATTERN.match(text)
+    if match:
+        number = match.group(1)
+        return tuple(int(x) for x in number.split('.')) if '.' in number else float(number)
+    return text
+
+def promote_version(value): # type: (float)->tuple
+    if value.is_integer(): return int(value),
+    return tuple(int(x) for x in ('%f' % value).rstrip('0').split('.'))
+
+def coerce_values(a, b): # type: (any, any)->tuple
+    # a number against a version compares as a version, versions compare as if padded with zeros
+    if isinstance(a, float) and isinstance(b, tuple): a = promote_version(a)
+    elif isinstance(a, tuple) and isinstance(b, float): b = promote_version(b)
+    if isinstance(a, tuple) and isinstance(b, tuple) and len(a) != len(b):
+        size = max(len(a), len(b))
+        a, b = a + (0,) * (size - len(a)), b + (0,) * (size - len(b))
+    return a, b
+
+def index_key(value): # type: (any)->any
+    # values that compare equal once coerced share a key in the equality index
+    if isinstance(value, float): value = promote_version(value)
+    if not isinstance(value, tuple): return value
+    while len(value) > 1 and not value[-1]: value = value[:-1]
+    return value
+
+def extract_attributes(ifconfig): # type: (dict)->dict
+    attributes = {}
+    if not isinstance(ifconfig, dict): return attributes
+    hardware = ifconfig.get('SPHardwareDataType') or {}
+    for _, section in hardware.items():
+        if not isinstance(section, dict): continue
+        for _, overview in section.items():
+            if not isinstance(overview, dict): continue
+            for k, v in overview.items():
+                if isinstance(v, str): attributes[normalize_attribute(k)] = parse_value(v)
+    for name in ('whoami', 'hostname', 'osversion'):
+        if ifconfig.get(name): attributes[name] = parse_value(ifconfig.get(name))
+    uname = ifconfig.get('uname')  # type: str
+    if uname:
+        fields = uname.split(' ')
+        if len(fields) > 2:
+            attributes.setdefault('hostname', parse_value(fields[1]))
+            attributes['kernel'] = parse_value(fields[2])
+    attributes['tags'] = set(str(x).lower() for x in ifconfig.get('tags') or ())
+    return attributes
+
+def local_os_version():
+    return platform.mac_ver()[0] or platform.release()
+
+class Clause(object):
+    def __init__(self, attribute, operator, value):
+        self.attribute = normalize_attribute(attribute)
+        self.operator = '=' if operator == '==' else operator
+        self.text = value.strip()
+        self.value = parse_value(value)
+
+    def match(self, attributes): # type: (dict)->bool
+        if self.attribute == 'tags':
+            tags = attributes.get('tags') or ()
+            found = any(fnmatch.fnmatchcase(x, self.text.lower()) for x in tags)
+            return not found if self.operator == '!=' else found
+        if self.attribute not in attributes: return self.operator == '!='
+        value = attributes[self.attribute]
+        if self.operator == '~':
+            return fnmatch.fnmatchcase(str(value), self.text.lower())
+        value, expected = coerce_values(value, self.value)
+        if self.operator == '=': return value == expected
+        if self.operator == '!=': return value != expected
+        if type(value) != type(expected): return False
+        if self.operator == '>=': return value >= expected
+        if self.operator == '<=': return value <= expected
+        if self.operator == '>': return value > expected
+        return value < expected
+
+class Selector(object):
+    def __init__(self, text): # type: (str)->None
+        self.text = text or ''
+        self.limit = 0
+        self.idle = False
+        self.clauses = [] # type: list[Clause]
+        self.__parse(self.text.strip().lower() if self.text else '')
+
+    def __parse(self, text):
+        text = re.sub(r'\s+slaves?$', '', text)
+        match = LIMIT_PATTERN.match(text)
+        if match:
+            self.limit = int(match.group(1))
+            text = text[match.end():]
+        for term in re.split(r'\s+and\s+', text):
+            term = term.strip()
+            if not term or term in ('all', 'slaves', 'slave'): continue
+            if term.startswith('idle'):
+                self.idle = True
+                term = term[4:].strip()
+                if not term or term in ('slaves', 'slave'): continue
+            match = CLAUSE_PATTERN.match(term)
+            if not match: raise ValueError('invalid selector clause: {!r}'.format(term))
+            self.clauses.append(Clause(*match.groups()))
+
+    def limited(self, limit): # type: (int)->str
+        # the same selector with a different 'any N', for a subtree that may only add this many slaves
+        return 'any {} {}'.format(limit, LIMIT_PATTERN.sub('', self.text.strip().lower(), count=1)).strip()
+
+    def __repr__(self):
+        return 'Selector({!r})'.format(self.text)
+
+class SlaveRegistry(object):
+    def __init__(self):
+        self.__attributes = {} # type: dict[any, dict]
+        self.__index = {} # type: dict[str, dict[any, set]]
+
+    def __len__(self):
+        return len(self.__attributes)
+
+    def __contains__(self, key):
+        return key in self.__attributes
+
+    def attributes(self, key): # type: (any)->dict
+        return self.__attributes.get(key) or {}
+
+    def update(self, key, ifconfig): # type: (any, dict)->None
+        self.remove(key)
+        attributes = self.__attributes[key] = extract_attributes(ifconfig)
+        for name, value in attributes.items():
+            for item in (value if isinstance(value, set) else (value,)):
+                self.__index.setdefault(name, {}).setdefault(index_key(item), set()).add(key)
+
+    def add(self, key):
+        if key not in self.__attributes: self.update(key, {})
+
+    def remove(self, key):
+        attributes = self.__attributes.pop(key, None)
+        if not attributes: return
+        for name, value in attributes.items():
+            index = self.__index.get(name)
+            for item in (value if isinstance(value, set) else (value,)):
+                item = index_key(item)
+                keys = index.get(item)
+                keys.discard(key)
+                if not keys: del index[item]
+
+    def lookup(self, attribute, value): # type: (str, any)->set
+        return self.__index.get(normalize_attribute(attribute), {}).get(index_key(parse_value(value)), set())
+
+    def select(self, selector, busy=(), exclude=()): # type: (Selector, set, set)->list
+        candidates = None
+        for clause in selector.clauses:
+            # narrow down with the equality index before scanning the remaining clauses
+            if clause.operator == '=' and clause.attribute != 'tags':
+                keys = self.__index.get(clause.attribute, {}).get(index_key(clause.value), set())
+                candidates = keys if candidates is None else candidates & keys
+        if candidates is None: candidates = self.__attributes.keys()
+        result = []
+        for key in candidates:
+            if key in exclude or selector.idle and key in busy: continue
+            attributes = self.__attributes[key]
+            if all(x.match(attributes) for x in selector.clauses):
+                result.append(key)
+                if 0 < selector.limit <= len(result): break
+        return result
@@ -4,45 +4,60 @@ import io
 
 __author__ = 'larryhou'
 
-def decode_system_information(text):
-    string = io.StringIO(text)
-    cursor = result = {}
-    stack = [result]
-    depth = {}
-    indent = 0
-    entity = None
-    entity_name = ''
-    for line in string.readlines():
-        line = line[:-1].rstrip()
-        if not line: continue
-        padding = 0
-        for n in range(len(line)):
-            if line[n] != ' ':
-                padding = n
-                break
-        sep = line.find(':')
-        if indent != padding:
-            if indent < padding:
-                stack.append(cursor)
-                depth[padding] = len(stack)
-                if not isinstance(entity, dict):
-                    entity = cursor[entity_name] = {}
-                cursor = entity  # type: dict[str, any]
-            else:
-                shift = (len(stack) - depth[padding]) if padding in depth else len(stack) - 1
-                while shift > 0:
-                    cursor = stack.pop()
-                    shift -= 1
-            indent = padding
-        entity_name = line[padding:sep].replace(' ', '')  # type: str
-        entity = line[sep + 1:].lstrip()
-        if not entity: entity = {}
-        cursor[entity_name] = entity
+def iterate_lines(source): # type: (str|bytes|io.IOBase|iter)->iter
+    if isinstance(source, bytes): source = source.decode('utf-8', errors='replace')
+    if isinstance(source, str): return io.StringIO(source)
+    return source
+
+# yields (name, tree) for each top-level section as soon as its last line has been read
+def iterate_system_information(source, sections=None):
+    wanted = set(x.replace(' ', '') for x in sections) if sections else None
+    root = {}
+    stack = [(-1, root)] # (indent of the owning entry, children)
+    previous = None # (indent, container, name)
+    section, skipping = None, None
+    for line in iterate_lines(source):
+        if isinstance(line, bytes): line = line.decode('utf-8', errors='replace')
+        text = line.strip()
+        if not text: continue
+        padding = len(line) - len(line.lstrip())
+        if skipping is not None:
+            if padding > skipping: continue
+            skipping = None
+        if previous and padding > previous[0]:
+            indent, container, name = previous
+            entity = container.get(name)
+            if not isinstance(entity, dict):
+                entity = container[name] = {}
+            stack.append((indent, entity))
+        else:
+            while len(stack) > 1 and stack[-1][0] >= padding:
+                stack.pop()
+        sep = text.find(':')
+        name = (text[:sep] if sep >= 0 else text).replace(' ', '')
+        entity = text[sep + 1:].lstrip() if sep >= 0 else ''
+        if len(stack) == 1:
+            if section is not None: yield section, root.pop(section)
+            section = None
+            if wanted is not None and name not in wanted:
+                skipping, previous = padding, None
+                continue
+            section = name
+        cursor = stack[-1][1]
+        cursor[name] = entity if entity else {}
+        previous = padding, cursor, name
+    if section is not None: yield section, root.pop(section)
+
+def decode_system_information(source, sections=None): # type: (str|bytes|io.IOBase, list[str])->dict
+    result = {}
+    for name, entity in iterate_system_information(source, sections=sections):
+        result[name] = entity
     return result
 
 def main():
     import sys, json
-    result = decode_system_information(open(sys.argv[1], 'rb').read().decode('utf-8'))
+    with open(sys.argv[1], 'r', encoding='utf-8', errors='replace') as fp:
+        result = decode_system_information(fp, sections=sys.argv[2:] or None)
     print(json.dumps(result, ensure_ascii=False, indent=4))
 
 if __name__ == '__main__':
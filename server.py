@@ -1,97 +1,565 @@
 #!/usr/bin/env python3
-from twisted.internet import reactor, task
-from twisted.internet.protocol import Factory, connectionDone
+from twisted.internet import reactor, task, defer
+from twisted.internet.interfaces import IReactorTime, IDelayedCall
+from twisted.internet.protocol import Factory, ReconnectingClientFactory, connectionDone
 from twisted.internet.endpoints import IPv4Address
+from twisted.web.resource import Resource
+from twisted.web.server import Site
 from shared import *
-import json, time, datetime
+from registry import *
+import logger
+from inventory import InventoryStore, digest, machine_id, patch, is_offer
+from telemetry import TelemetryStore
+from transfer import TransferManager
+from projection import Projection
+from admission import AdmissionControl, ADMISSION_RATE, ADMISSION_BURST, MAX_HANDSHAKES
+from state import QueenState
+import os, json, time, datetime, collections
 
 __author__ = 'larryhou'
 
+SLAVE_ALIVE = 'alive'
+SLAVE_SUSPECT = 'suspect'
+SLAVE_DEAD = 'dead'
+SLAVE_RESTORING = 'restoring' # served before the queen restarted and not back yet
+# a relay gives up on its subtree this much earlier than its parent so partial results still make it up
+RELAY_TIMEOUT_RATIO = 0.9
+LOAD_SATURATED = 0.9 # share of cpu or memory in use past which a slave takes no job tasks while others have room
+
+def exit_status(item): # type: (dict)->str
+    if item.get('exit_code') is not None: return str(item['exit_code'])
+    error = item.get('error') or {}
+    return Exceptions.name(error.get('code')) if error else None
+
+class ResultCache(object):
+    def __init__(self, clock, ttl=3600.0):
+        self.clock = clock # type: IReactorTime
+        self.ttl = ttl
+        self.__entries = {} # type: dict[int, dict[IPv4Address, tuple[float, dict]]]
+
+    def put(self, mission, addr, item): # type: (int|tuple, IPv4Address, dict)->None
+        if self.ttl <= 0: return
+        self.__entries.setdefault(mission, {})[addr] = (self.clock.seconds(), item)
+
+    def get(self, mission, addr, max_staleness=None): # type: (int|tuple, IPv4Address, float)->dict
+        entry = self.__entries.get(mission, {}).get(addr)
+        if entry is None: return None
+        age = self.clock.seconds() - entry[0]
+        if age > self.ttl:
+            del self.__entries[mission][addr]
+            return None
+        if max_staleness is not None and age > max_staleness: return None
+        return dict(entry[1], cached=True, age=age)
+
+    def remove(self, addr): # type: (IPv4Address)->None
+        for entries in self.__entries.values():
+            entries.pop(addr, None)
+
+# parameters that only say how a request is delivered, the rest decides what the artifacts hold
+DELIVERY_PARAMETERS = ('id', 'round', 'stime', 'stream', 'mission', 'selector', 'projection', 'refresh',
+                       'max_staleness', 'mission_timeout', 'timeout_allowed')
+
+def request_key(parameters): # type: (dict)->str
+    return json.dumps({k: v for k, v in (parameters or {}).items() if k not in DELIVERY_PARAMETERS}, sort_keys=True, default=str)
+
+def forward_output(addr, payload, observers, listeners): # type: (IPv4Address, dict, list[TCP], list[callable])->list[defer.Deferred]
+    # what the chunk's ack waits on: observer queues draining and whatever the listeners hand back
+    item = dict(payload)
+    if 'client' in item: item.setdefault('relay', {'address': addr.host, 'port': addr.port})
+    else: item['client'] = {'address': addr.host, 'port': addr.port}
+    fanout(observers, command=Commands.COLLABORATE_OUTPUT_NOTIFY, data=item)
+    return [x.send_queue.drained() for x in observers] + [x for x in (listener(item) for listener in listeners) if x]
+
 class CollaborateScheduler(object):
-    def __init__(self, factory, mission):
+    def __init__(self, factory, mission, selector=None, round=0):
         self.factory = factory # type: ClientConnectionFactory
         self.mission = mission # type: int
+        self.selector = selector # type: Selector
+        self.round = round # type: int
+        self.key = None # type: tuple
         self.__obserers = {}
         self.__waitings = {}
         self.__received = {}
+        self.__delivered = []
+        self.__dispatched = 0
+        self.__completed = 0
+        self.__cached = 0
+        self.__remote_missing = [] # type: list[dict]
+        self.__exit_codes = collections.Counter()
+        self.__limit = 0
+        self.__trimmed = 0
+        self.__listeners = [] # type: list[callable]
+        self.__output_listeners = [] # type: list[callable]
         self.__timestamp = 0
         self.__running = False
+        self.__timeout_call = None # type: IDelayedCall
         self.mission_timeout = 10.0
         self.timeout_allowed = True
+        self.projection = None # type: Projection
+        self.request_key = request_key(None)
+
+    @property
+    def cache_key(self): # type: ()->tuple
+        # a cached artifact only stands in for requests asking the same of the slave with the same projection
+        return self.mission, self.request_key, self.projection.key if self.projection else None
+
+    @property
+    def cacheable(self): # type: ()->bool
+        return int(self.mission or 0) != CollaborateMissions.RUN_COMMAND
 
     @property
     def running(self): return self.__running
 
-    def update(self):
-        if self.__running > 0:
-            timestamp = datetime.datetime.now().timestamp()
-            if len(self.__waitings) == 0:
-                self.__broadcast()
-            elif 0 < self.mission_timeout <= (timestamp - self.__timestamp):
-                self.__broadcast() if self.timeout_allowed else self.__abort(error=Exceptions.COLLABORATE_TIMEOUT)
+    @property
+    def joinable(self): # type: ()->bool
+        # a late request only merges while every artifact it missed can still be handed to it
+        return not self.__running or all(self.__recall(addr) is not None for addr in self.__delivered)
 
-    def __abort(self, error):
-        for addr, _ in self.__obserers.items():
+    def __timeout(self):
+        self.__timeout_call = None
+        LOG.warning('-- collaborate timeout mission={} waitings={}', self.mission, len(self.__waitings))
+        self.__broadcast() if self.timeout_allowed else self.__abort(error=Exceptions.COLLABORATE_TIMEOUT)
+
+    def __observers(self, stream=None):
+        for addr, streaming in self.__obserers.items():
+            if stream is not None and streaming != stream: continue
             client = self.factory.clients.get(addr)  # type: ClientConnection
-            if client: client.send(command=Commands.COLLABORATE_NOTIFY, retcode=error)
+            if client: yield client
+
+    @staticmethod
+    def __artifact(addr, rsp): # type: (IPv4Address, dict)->dict
+        item = {'client': {'address':addr.host, 'port':addr.port}}
+        item.update(rsp.get('data'))
+        return item
+
+    def add_listener(self, listener, output=None): # type: (callable, callable)->None
+        # listener(results, summary, retcode) is called once when the round ends, output(item) for every
+        # command output chunk and returns the connection it was written to
+        self.__listeners.append(listener)
+        if output: self.__output_listeners.append(output)
+
+    def output(self, addr, payload): # type: (IPv4Address, dict)->list[defer.Deferred]
+        if addr not in self.__waitings: return []
+        return forward_output(addr, payload, list(self.__observers()), self.__output_listeners)
+
+    def __abort(self, error):
+        fanout(self.__observers(), command=Commands.COLLABORATE_NOTIFY, retcode=error)
+        for listener in self.__listeners: listener(None, None, error)
         self.__reset()
 
     def __reset(self):
-        self.__init__(self.factory, mission=self.mission)
+        if self.__timeout_call and self.__timeout_call.active():
+            self.__timeout_call.cancel()
+        self.factory.release(self)
+        self.__init__(self.factory, mission=self.mission, selector=self.selector, round=self.round)
 
     def __broadcast(self):
-        notify = []
-        for addr, rsp in self.__received.items(): # type: IPv4Address, dict
-            data = rsp.get('data')
-            item = {'client': {'address':addr.host, 'port':addr.port}}
-            item.update(data)
-            notify.append(item)
-        for addr, _ in self.__obserers.items():
-            client = self.factory.clients[addr] # type: ClientConnection
-            client.send(command=Commands.COLLABORATE_NOTIFY, data=notify)
+        notify = [x for x in (self.__recall(addr) for addr in self.__delivered) if x is not None]
+        fanout(self.__observers(stream=False), command=Commands.COLLABORATE_NOTIFY, data=notify)
+        summary = {'mission': self.mission, 'dispatched': self.__dispatched, 'completed': self.__completed, 'cached': self.__cached,
+                   'missing': [{'address':addr.host, 'port':addr.port} for addr in self.__waitings] + self.__remote_missing,
+                   'elapse': datetime.datetime.now().timestamp() - self.__timestamp if self.__running else 0}
+        if self.__exit_codes: summary['exit_codes'] = dict(self.__exit_codes)
+        if self.__trimmed: summary['trimmed'] = self.__trimmed
+        if self.__running: METRICS.observe('collaborate_round_us', summary['elapse'] * 1e6, label=str(self.mission))
+        fanout(self.__observers(stream=True), command=Commands.COLLABORATE_NOTIFY, data={'summary': summary})
+        for listener in self.__listeners: listener(notify, summary, 0)
         self.__reset()
 
     def dispatch_missions(self, sender, parameters):
         if not parameters: parameters = {}
+        stream = bool(parameters.get('stream'))
+        joined = self.__running and sender not in self.__obserers
+        if sender is not None: self.__register_observer(sender, stream=stream)
+        LOG.info('++ dispatch missions sender={} running={} mission_timeout={} timeout_allowed={}',
+                 sender, self.running, self.mission_timeout, self.timeout_allowed, parameters=parameters)
+        if self.__running:
+            # identical requests merge into the round in flight, replay what a late streaming observer missed
+            if joined and stream: self.__replay(sender)
+            return
+        # a request that joins late leaves the round's timeout alone
         if 'mission_timeout' in parameters:
             self.mission_timeout = float(parameters['mission_timeout'])
         if 'timeout_allowed' in parameters:
             self.timeout_allowed = parameters['timeout_allowed']
-        self.__register_observer(sender)
-        if self.factory.slave_count == 0:
-            self.__broadcast()
-            return
-        print('++ dispatch missions sender={} parameters={} running={} mission_timeout={} timeout_allowed={}'
-              .format(sender, parameters, self.running, self.mission_timeout, self.timeout_allowed))
-        if self.__running: return
         self.__running = True
         self.__timestamp = datetime.datetime.now().timestamp()
-        for _, client in self.factory.clients.items(): # type: IPv4Address, ClientConnection
-            if not client.is_slave: continue
-            client.dispatch_collaborate_mission(parameters)
-            print('## dispatch mission #{}'.format(client.uuid), client.address)
+        targets = self.factory.select(self.selector)
+        relays = [x for x in targets if x.relay]
+        if relays and self.selector and self.selector.limit:
+            # 'any N' holds across the tree, relays share what the local picks left and extras are trimmed on arrival
+            self.__limit = self.selector.limit
+            remaining = self.__limit - (len(targets) - len(relays))
+            targets = [x for x in targets if not x.relay] + (relays if remaining > 0 else [])
+            relay_parameters = dict(parameters, round=self.round, selector=self.selector.limited(remaining))
+        else: relay_parameters = None
+        max_staleness = float(parameters.get('max_staleness') or 0)
+        if max_staleness > 0 and self.cacheable:
+            stale = []
+            for client in targets: # type: ClientConnection
+                item = self.factory.results.get(self.cache_key, client.address, max_staleness)
+                if item is None: stale.append(client)
+                else:
+                    self.__cached += 1
+                    self.__deliver(client.address, item)
+            targets = stale
+        if not targets:
+            self.__broadcast()
+            return
+        parameters = dict(parameters, round=self.round)
+        for client in targets: # type: ClientConnection
+            client.dispatch_collaborate_mission(relay_parameters if client.relay and relay_parameters else parameters)
+            LOG.debug('## dispatch mission #{} {}', client.uuid, client.address)
             self.__waitings[client.address] = True
+        self.__dispatched = len(self.__waitings)
+        if self.mission_timeout > 0:
+            self.__timeout_call = self.factory.clock.callLater(self.mission_timeout, self.__timeout)
+
+    def pending(self):
+        return self.__waitings.keys()
 
     def finish(self, addr):
+        if addr not in self.__waitings: return
         del self.__waitings[addr]
         if len(self.__waitings) == 0:
             self.__broadcast()
 
     def receive(self, addr, rsp): # type: (IPv4Address, dict)->None
-        self.__received[addr] = rsp
-        print('>> receive mission artifact', addr)
+        if addr not in self.__waitings: return
+        if 'relay' in (rsp.get('data') or {}):
+            self.__receive_relay(addr, rsp)
+            return
+        self.__completed += 1
+        item = self.__artifact(addr, rsp)
+        if not rsp.get('retcode') and self.cacheable: self.factory.results.put(self.cache_key, addr, item)
+        self.__deliver(addr, item)
+        LOG.debug('>> receive mission artifact {}', addr)
+        self.finish(addr)
+
+    def __receive_relay(self, addr, rsp): # type: (IPv4Address, dict)->None
+        data = rsp.get('data')
+        summary = data.get('relay') or {}
+        # the relay stood in for its subtree, count what it dispatched instead of the relay itself
+        self.__dispatched += summary.get('dispatched', 1) - 1
+        self.__completed += summary.get('completed', 0)
+        self.__cached += summary.get('cached', 0)
+        relay = {'address': addr.host, 'port': addr.port}
+        for item in summary.get('missing') or ():
+            self.__remote_missing.append(dict(item, relay=item.get('relay') or relay))
+        for item in data.get('artifacts') or ():
+            client, origin = item.get('client') or {}, item.get('relay') or relay
+            # slave addresses are only unique behind the relay that saw them
+            key = (addr, origin.get('address'), origin.get('port'), client.get('address'), client.get('port'))
+            if 0 < self.__limit <= len(self.__delivered):
+                self.__trimmed += 1
+                continue
+            self.__deliver(key, dict(item, relay=origin))
+        LOG.debug('>> receive relay artifacts={} {}', len(data.get('artifacts') or ()), addr)
+        if rsp.get('retcode') == Exceptions.COLLABORATE_TIMEOUT and not self.timeout_allowed:
+            self.__abort(error=Exceptions.COLLABORATE_TIMEOUT)
+            return
         self.finish(addr)
 
-    def __register_observer(self, addr):
-        self.__obserers[addr] = True
+    def __deliver(self, addr, item): # type: (IPv4Address|tuple, dict)->None
+        self.__delivered.append(addr)
+        if self.mission == CollaborateMissions.RUN_COMMAND: self.__exit_codes[exit_status(item)] += 1
+        # only held while someone waits for the whole round, streaming observers take them as they come
+        if self.__listeners or not all(self.__obserers.values()): self.__received[addr] = item
+        fanout(self.__observers(stream=True), command=Commands.COLLABORATE_ARTIFACT_NOTIFY, data=item)
+
+    def __recall(self, addr): # type: (IPv4Address|tuple)->dict
+        item = self.__received.get(addr)
+        if item is None and self.cacheable and isinstance(addr, IPv4Address):
+            item = self.factory.results.get(self.cache_key, addr)
+        return item
+
+    def __replay(self, sender):
+        client = self.factory.clients.get(sender)  # type: ClientConnection
+        if not client: return
+        for addr in self.__delivered:
+            item = self.__recall(addr)
+            if item is not None: client.send(command=Commands.COLLABORATE_ARTIFACT_NOTIFY, data=item)
+
+    def __register_observer(self, addr, stream=False):
+        self.__obserers[addr] = stream
+
+class JobQueueScheduler(object):
+    def __init__(self, factory, mission, selector=None, round=0):
+        self.factory = factory # type: ClientConnectionFactory
+        self.mission = mission # type: int
+        self.selector = selector # type: Selector
+        self.round = round # type: int
+        self.key = None # type: tuple
+        self.projection = None # type: Projection
+        self.__obserers = {}
+        self.__tasks = [] # type: list[dict]
+        self.__queue = collections.deque() # type: deque[int]
+        self.__running_tasks = {} # type: dict[int, dict[IPv4Address, float]]
+        self.__assignments = {} # type: dict[IPv4Address, set[int]]
+        self.__slots = {} # type: dict[IPv4Address, int]
+        self.__results = {} # type: dict[int, dict]
+        self.__attempts = {} # type: dict[int, int]
+        self.__failures = {} # type: dict[int, str]
+        self.__task_calls = {} # type: dict[tuple, IDelayedCall]
+        self.__timeout_call = None # type: IDelayedCall
+        self.__steal_call = None # type: IDelayedCall
+        self.__listeners = [] # type: list[callable]
+        self.__output_listeners = [] # type: list[callable]
+        self.__timestamp = 0
+        self.__running = False
+        self.mission_timeout = 0
+        self.task_timeout = 0
+        self.max_attempts = 3
+        self.slots_per_slave = 1
+        self.steal_after = 1.0
+
+    @property
+    def running(self): return self.__running
+
+    def pending(self):
+        return [x for x, tasks in self.__assignments.items() if tasks]
+
+    def __observers(self, stream=None):
+        for addr, streaming in self.__obserers.items():
+            if stream is not None and streaming != stream: continue
+            client = self.factory.clients.get(addr)  # type: ClientConnection
+            if client: yield client
+
+    def add_listener(self, listener, output=None): # type: (callable, callable)->None
+        self.__listeners.append(listener)
+        if output: self.__output_listeners.append(output)
+
+    def output(self, addr, payload): # type: (IPv4Address, dict)->list[defer.Deferred]
+        if addr not in self.__running_tasks.get(payload.get('task'), ()): return []
+        return forward_output(addr, payload, list(self.__observers()), self.__output_listeners)
+
+    @staticmethod
+    def __usage(client): # type: (ClientConnection)->float
+        load = None if client.relay else client.load
+        return min(max(load.get('cpu', 0), load.get('mem', 0)) / 100.0, 1.0) if load else 0.0
+
+    def __weight(self, client): # type: (ClientConnection)->int
+        if client.relay: return self.slots_per_slave * max(1, client.capacity)
+        usage = self.__usage(client)
+        # with one slot per slave scaling alone changes nothing, a saturated slave is left out instead
+        if usage >= LOAD_SATURATED: return 0
+        return max(1, int(round(self.slots_per_slave * (1 - usage))))
+
+    def dispatch_missions(self, sender, parameters):
+        if sender is not None: self.__obserers[sender] = bool(parameters.get('stream'))
+        if self.__running: return
+        self.mission_timeout = float(parameters.get('mission_timeout', self.mission_timeout))
+        self.task_timeout = float(parameters.get('task_timeout', self.task_timeout))
+        self.max_attempts = int(parameters.get('max_attempts', self.max_attempts))
+        self.slots_per_slave = max(1, int(parameters.get('slots_per_slave', self.slots_per_slave)))
+        self.steal_after = float(parameters.get('steal_after', self.steal_after))
+        common = {k: v for k, v in parameters.items() if k not in ('tasks', 'stream', 'selector')}
+        for n, task in enumerate(parameters.get('tasks') or []):
+            item = dict(common)
+            item.update(task if isinstance(task, dict) else {'argument': task})
+            item.update(round=self.round, task=n)
+            self.__tasks.append(item)
+            self.__queue.append(n)
+        # least loaded slaves get first pick of the queue, idle ones before those busy with other rounds
+        busy = self.factory.busy_slaves()
+        targets = sorted(self.factory.select(self.selector), key=lambda x: (-self.__weight(x), self.__usage(x), x.address in busy))
+        slots = {x.address: self.__weight(x) for x in targets}
+        # every slave saturated, the job still runs one task a slave
+        if not any(slots.values()): slots = dict.fromkeys(slots, 1)
+        LOG.info('++ dispatch job sender={} tasks={} slaves={}', sender, len(self.__tasks), len(targets))
+        self.__running = True
+        self.__timestamp = self.factory.clock.seconds()
+        for client in targets:
+            self.__slots[client.address] = slots[client.address]
+            self.__assignments[client.address] = set()
+        if self.mission_timeout > 0:
+            self.__timeout_call = self.factory.clock.callLater(self.mission_timeout, self.__timeout)
+        for client in targets: self.__schedule(client.address)
+        self.__check()
+
+    def __schedule(self, addr):
+        client = self.factory.clients.get(addr)  # type: ClientConnection
+        assignments = self.__assignments.get(addr)
+        if client is None or assignments is None: return
+        while len(assignments) < self.__slots[addr]:
+            index = self.__queue.popleft() if self.__queue else self.__steal(addr)
+            if index is None: break
+            self.__assign(client, index)
+        self.__arm_steal()
+
+    def __steal(self, addr):
+        now = self.factory.clock.seconds()
+        candidates = []
+        for index, owners in self.__running_tasks.items():
+            if addr in owners or len(owners) > 1: continue
+            started = min(owners.values())
+            if started + self.steal_after <= now: candidates.append((started, index))
+        return min(candidates)[1] if candidates else None
+
+    def __arm_steal(self):
+        # idle slaves would otherwise only steal when some other event comes in, wake up when the first task they could take is due
+        if not self.__running: return
+        due = []
+        for addr, assignments in self.__assignments.items():
+            if len(assignments) >= self.__slots.get(addr, 0) or addr not in self.factory.clients: continue
+            due.extend(min(x.values()) + self.steal_after for x in self.__running_tasks.values() if len(x) == 1 and addr not in x)
+        if not due: return
+        if self.__steal_call and self.__steal_call.active():
+            if self.__steal_call.getTime() <= min(due): return
+            self.__steal_call.cancel()
+        self.__steal_call = self.factory.clock.callLater(max(0.0, min(due) - self.factory.clock.seconds()), self.__steal_due)
+
+    def __steal_due(self):
+        self.__steal_call = None
+        self.__reschedule()
+
+    def __cancel(self, index, addr):
+        # the slave stops working on a task that was finished elsewhere, relays let their copy run out
+        client = self.factory.clients.get(addr)  # type: ClientConnection
+        if client and not client.relay:
+            client.send(command=Commands.COLLABORATE_CANCEL_NOTIFY, data={'round': self.round, 'task': index})
+
+    def __assign(self, client, index): # type: (ClientConnection, int)->None
+        self.__assignments[client.address].add(index)
+        self.__running_tasks.setdefault(index, {})[client.address] = self.factory.clock.seconds()
+        if self.task_timeout > 0:
+            self.__task_calls[(index, client.address)] = \
+                self.factory.clock.callLater(self.task_timeout, self.__task_timeout, index, client.address)
+        client.dispatch_collaborate_mission(self.__tasks[index])
+        LOG.debug('## dispatch task #{} mission #{} {}', index, client.uuid, client.address)
+
+    def __release(self, index, addr):
+        call = self.__task_calls.pop((index, addr), None)
+        if call and call.active(): call.cancel()
+        self.__assignments.get(addr, set()).discard(index)
+        owners = self.__running_tasks.get(index)
+        if owners is not None:
+            owners.pop(addr, None)
+            if not owners: del self.__running_tasks[index]
+
+    def __requeue(self, index, reason):
+        if index in self.__results or index in self.__running_tasks: return
+        attempts = self.__attempts[index] = self.__attempts.get(index, 0) + 1
+        if attempts >= self.max_attempts:
+            self.__failures[index] = reason
+            return
+        self.__queue.appendleft(index)
+
+    def __task_timeout(self, index, addr):
+        self.__task_calls.pop((index, addr), None)
+        LOG.warning('-- task #{} timeout {}', index, addr)
+        self.__release(index, addr)
+        # a slave that timed out is not trusted with more work in this job
+        self.__slots[addr] = 0
+        self.__requeue(index, reason='timeout')
+        self.__reschedule()
+
+    def __reschedule(self):
+        for addr in list(self.__assignments.keys()): self.__schedule(addr)
+        self.__check()
+
+    def finish(self, addr):
+        if addr not in self.__assignments: return
+        LOG.warning('-- slave left job {}', addr)
+        for index in list(self.__assignments[addr]):
+            self.__release(index, addr)
+            self.__requeue(index, reason='slave lost')
+        del self.__assignments[addr]
+        self.__reschedule()
+
+    def receive(self, addr, rsp): # type: (IPv4Address, dict)->None
+        data = rsp.get('data') or {}
+        index = data.get('task')
+        if index is None or index not in self.__running_tasks or addr not in self.__running_tasks[index]: return
+        self.__release(index, addr)
+        if index not in self.__results:
+            item = {'client': {'address':addr.host, 'port':addr.port}}
+            item.update(data)
+            self.__results[index] = item
+            fanout(self.__observers(stream=True), command=Commands.COLLABORATE_ARTIFACT_NOTIFY, data=item)
+            # a stolen copy still running elsewhere is no longer needed
+            for owner in list(self.__running_tasks.get(index, {}).keys()):
+                self.__release(index, owner)
+                self.__cancel(index, owner)
+                self.__schedule(owner)
+        LOG.debug('>> receive task #{} artifact {}', index, addr)
+        self.__schedule(addr)
+        self.__check()
+
+    def __check(self):
+        if not self.__running: return
+        if self.__queue and any(self.__slots.get(x) for x in self.__assignments): return
+        if self.__running_tasks: return
+        for index in self.__queue: self.__failures.setdefault(index, 'no slave available')
+        self.__queue.clear()
+        self.__broadcast()
+
+    def __timeout(self):
+        self.__timeout_call = None
+        LOG.warning('-- job timeout mission={} running={} queued={}', self.mission, len(self.__running_tasks), len(self.__queue))
+        for index in list(self.__running_tasks.keys()) + list(self.__queue):
+            self.__failures.setdefault(index, 'timeout')
+        self.__broadcast()
+
+    def __broadcast(self):
+        results = [self.__results[x] for x in sorted(self.__results)]
+        fanout(self.__observers(stream=False), command=Commands.COLLABORATE_NOTIFY, data=results)
+        summary = {'mission': self.mission, 'tasks': len(self.__tasks), 'completed': len(self.__results),
+                   'failed': [{'task': x, 'reason': self.__failures[x]} for x in sorted(self.__failures)],
+                   'elapse': self.factory.clock.seconds() - self.__timestamp}
+        if self.mission == CollaborateMissions.RUN_COMMAND:
+            summary['exit_codes'] = dict(collections.Counter(exit_status(x) for x in results))
+        METRICS.observe('collaborate_round_us', summary['elapse'] * 1e6, label=str(self.mission))
+        fanout(self.__observers(stream=True), command=Commands.COLLABORATE_NOTIFY, data={'summary': summary})
+        for listener in self.__listeners: listener(results, summary, 0)
+        self.__running = False
+        for call in list(self.__task_calls.values()) + [self.__timeout_call, self.__steal_call]:
+            if call and call.active(): call.cancel()
+        self.__task_calls.clear()
+        self.__assignments.clear()
+        self.__running_tasks.clear()
+        self.factory.release(self)
 
 class ClientConnection(TCP):
     def __init__(self, factory, addr):
         super(ClientConnection, self).__init__(address=addr)
         self.factory = factory # type: ClientConnectionFactory
+        self.features = {FEATURE_INVENTORY_DELTA, FEATURE_ADMISSION}
+        if factory.artifact_dir: self.features.add(FEATURE_ARTIFACT_TRANSFER)
+        self.transfers = TransferManager(self, directory=factory.artifact_dir)
         self.uuid = -1
         self.ifconfig = ''
+        self.machine = None # type: str
+        self.status = SLAVE_ALIVE
+        self.last_seen = 0.0
+        self.rtt = None # type: float
+        self.mission_latency = Histogram()
+        self.__liveness_call = None # type: IDelayedCall
         self.is_slave = False
+        self.relay = False
+        self.capacity = 1
+        self.load = None # type: dict
+        self.profiler_cache = None # type: dict
+
+    def update_load(self, data): # type: (dict)->None
+        cpu, mem = data.get('cpu', data.get('CPU')), data.get('mem', data.get('MEM'))
+        if cpu is None or not isinstance(mem, dict): return
+        self.load = {'cpu': float(cpu), 'mem': float(mem.get('percent', 0)), 'ts': datetime.datetime.now().timestamp()}
+
+    def record_mission_latency(self, data): # type: (dict)->None
+        if not data.get('stime') or not data.get('etime'): return
+        latency = (float(data['etime']) - float(data['stime'])) * 1e6
+        self.mission_latency.record(latency)
+        METRICS.observe('mission_latency_us', latency, label=str(data.get('mission')))
+
+    def describe_traffic(self): # type: ()->dict
+        traffic = {'address': self.address.host, 'port': self.address.port, 'uuid': self.uuid, 'slave': self.is_slave}
+        traffic.update(self.traffic())
+        transfers = self.transfers.describe()
+        if transfers['sending'] or transfers['receiving']: traffic['transfers'] = transfers
+        if self.mission_latency.count: traffic['mission_latency_us'] = self.mission_latency.summary()
+        if self.profiler_cache: traffic['profiler_cache'] = self.profiler_cache
+        return traffic
 
     def dispatch_collaborate_mission(self, parameters):
         mission = {'id': self.uuid}
@@ -100,87 +568,627 @@ class ClientConnection(TCP):
 
     def connectionMade(self):
         self.factory.clients[self.address] = self
-        self.print('new connection #total={} #slaves={}'.format(len(self.factory.clients), self.factory.slave_count))
+        self.log(INFO, 'new connection #total={} #slaves={}', len(self.factory.clients), self.factory.slave_count)
+
+    @property
+    def alive(self):
+        return self.status == SLAVE_ALIVE
+
+    def touch(self):
+        self.last_seen = self.factory.clock.seconds()
+        if self.status != SLAVE_ALIVE:
+            self.status = SLAVE_ALIVE
+            self.log(INFO, 'slave alive again')
+        # one timer per slave pushed back on every frame, it only fires for silent slaves
+        call = self.__liveness_call
+        if call and call.active(): call.reset(self.factory.suspect_after)
+        else: self.__liveness_call = self.factory.clock.callLater(self.factory.suspect_after, self.__silent)
+
+    def __silent(self):
+        self.__liveness_call = None
+        silence = self.factory.clock.seconds() - self.last_seen
+        if self.status == SLAVE_ALIVE and self.factory.dead_after > silence:
+            self.status = SLAVE_SUSPECT
+            self.log(WARNING, 'slave suspect silence={:.1f}s', silence)
+            self.__liveness_call = self.factory.clock.callLater(self.factory.dead_after - silence, self.__silent)
+            return
+        self.status = SLAVE_DEAD
+        self.log(WARNING, 'slave dead silence={:.1f}s', silence)
+        self.transport.abortConnection()
+
+    def describe(self): # type: ()->dict
+        description = {'address': self.address.host, 'port': self.address.port, 'uuid': self.uuid, 'machine': self.machine,
+                       'status': self.status, 'silence': round(self.factory.clock.seconds() - self.last_seen, 3),
+                       'rtt': self.rtt, 'load': self.load}
+        if self.relay: description.update(relay=True, capacity=self.capacity)
+        return description
+
+    def snapshot(self): # type: ()->dict
+        entry = self.factory.inventory.get(self.machine) or {}
+        return {'address': self.address.host, 'connected': True, 'seen': round(time.time(), 3), 'digest': entry.get('digest'),
+                'load': self.load, 'rtt': self.rtt}
+
+    def admit(self, payload): # type: (dict)->bool
+        if payload.get('relay'): return True # relays bring no inventory along
+        admission = self.factory.admission
+        if FEATURE_ADMISSION not in self.peer_features:
+            admission.begin(self.address) # older slaves cannot be asked to wait
+            return True
+        # a slave whose inventory is already here only trades digests, it does not need a token
+        entry = self.factory.inventory.get(payload.get('machine'))
+        delay = admission.admit(self.address, cheap=bool(entry) and entry.get('digest') == payload.get('digest'))
+        if delay <= 0: return True
+        self.log(DEBUG, 'handshake deferred retry_after={}', delay)
+        self.send(command=Commands.SERVE_AS_SLAVE_RSP, data={'retry_after': delay},
+                  retcode=Exceptions.HANDSHAKE_DEFERRED, info='queen busy, retry later')
+        return False
+
+    @property
+    def telemetry_key(self): # samples are kept per machine so a reconnect continues the same series
+        return self.machine or self.address.host
+
+    def query_telemetry(self, payload): # type: (dict)->None
+        try:
+            selector = Selector(payload['selector']) if payload.get('selector') else None
+            end = float(payload.get('end') or self.factory.clock.seconds())
+            start = float(payload.get('start') or end - float(payload.get('last') or 300))
+            keys = [x.telemetry_key for x in self.factory.select(selector)] if selector else None
+            result = self.factory.telemetry.query(payload.get('metric') or 'cpu', start, end, keys=keys,
+                                                  resolution=payload.get('resolution'), series=bool(payload.get('series')))
+        except ValueError as error:
+            self.send(command=Commands.TELEMETRY_QUERY_RSP, data={'msg': 'invalid telemetry query'},
+                      retcode=Exceptions.ERROR_FORMAT, info=str(error))
+            return
+        self.send(command=Commands.TELEMETRY_QUERY_RSP, data=result)
+
+    def receive_output(self, payload): # type: (dict)->None
+        collaborate = self.factory.find(payload)
+        waiting = collaborate.output(self.address, payload) if collaborate else []
+        ack = {'stream_id': payload.get('stream_id'), 'seq': payload.get('seq'), 'bytes': payload.get('bytes') or 0}
+        if 'relay_seq' in payload: ack['relay_seq'] = payload['relay_seq']
+        # the slave stops reading its process until chunks are acknowledged, so hold the ack while any
+        # observer is backed up, or a relay above has not had the chunk acked, and memory stays at one window per command
+        defer.gatherResults(waiting).addCallback(lambda _: self.send(command=Commands.COLLABORATE_OUTPUT_RSP, data=ack))
 
     def dump_json(self, info):
-        print(json.dumps(info, ensure_ascii=False, indent=4))
+        self.log(DEBUG, 'hardware', hardware=info)
 
-    def packReceived(self, data):
-        msg = json.loads(data, encoding='utf-8')
+    def apply_inventory(self, data, changed=True): # type: (dict, bool)->None
+        self.ifconfig = data
+        if self.is_slave: self.factory.registry.update(self.address, data)
+        if changed: self.dump_json(data.get('SPHardwareDataType'))
+
+    def receive_inventory(self, payload): # type: (dict)->bool
+        inventory = self.factory.inventory
+        if 'delta' not in payload:
+            self.machine = machine_id(payload)
+            entry = inventory.get(self.machine)
+            data_digest = inventory.put(self.machine, payload)
+            self.apply_inventory(payload, changed=not entry or entry.get('digest') != data_digest)
+            self.factory.serving(self)
+            return True
+        self.machine = payload.get('machine')
+        entry = inventory.get(self.machine)
+        if not entry or entry.get('digest') != payload.get('base'):
+            self.send(command=Commands.INVENTORY_DIGEST_RSP, data={'want': 'full'})
+            return False
+        data = patch(entry.get('data'), payload.get('delta'))
+        if digest(data) != payload.get('digest'):
+            self.log(WARNING, 'inventory delta mismatch machine={}', self.machine)
+            self.send(command=Commands.INVENTORY_DIGEST_RSP, data={'want': 'full'})
+            return False
+        inventory.put(self.machine, data, payload.get('digest'))
+        self.apply_inventory(data)
+        self.factory.serving(self)
+        return True
+
+    def check_inventory(self, payload): # type: (dict)->None
+        self.machine = payload.get('machine')
+        entry = self.factory.inventory.get(self.machine)
+        if entry and entry.get('digest') == payload.get('digest'):
+            self.apply_inventory(entry.get('data'), changed=False)
+            self.send(command=Commands.INVENTORY_DIGEST_RSP, data={'want': 'none'})
+            self.factory.serving(self)
+        elif entry:
+            self.send(command=Commands.INVENTORY_DIGEST_RSP, data={'want': 'diff', 'base': entry.get('digest')})
+        else:
+            self.send(command=Commands.INVENTORY_DIGEST_RSP, data={'want': 'full'})
+
+    def packReceived(self, msg):
         command = msg.get('command')  # type: int
         payload = msg.get('data')  # type: dict
-        if command not in self.factory.silent_commands:
-            self.print('>>> {} {}'.format(self.get_command_name(command), data.decode('utf-8')))
-        if command in (Commands.SYSTEM_INFORMATION_RSP, Commands.SYSTEM_INFORMATION_NOTIFY):
-            self.ifconfig = payload
-            self.dump_json(payload.get('SPHardwareDataType'))
-            self.acknowledge(command)
+        self.log_frame('>>>', msg)
+        if self.is_slave: self.touch()
+        if command == Commands.SYSTEM_INFORMATION_RSP and is_offer(payload):
+            self.check_inventory(payload) # a delta slave answers our request with its digest first
+        elif command in (Commands.SYSTEM_INFORMATION_RSP, Commands.SYSTEM_INFORMATION_NOTIFY):
+            if self.receive_inventory(payload or {}): self.acknowledge(command)
+        elif command == Commands.INVENTORY_DIGEST_REQ:
+            self.check_inventory(payload or {})
         elif command == Commands.SERVE_AS_SLAVE_REQ:
+            if self.is_slave or not self.admit(payload or {}): return
             self.is_slave = True
+            if payload and payload.get('relay'):
+                self.relay = True
+                self.capacity = int(payload.get('slaves') or 0)
+            self.touch()
             self.factory.slave_count += 1
-            self.print('new slave #total={} #slaves={}'.format(len(self.factory.clients), self.factory.slave_count))
+            self.factory.registry.update(self.address, self.ifconfig)
+            self.log(INFO, 'new slave #total={} #slaves={}', len(self.factory.clients), self.factory.slave_count)
             self.send(command=Commands.SERVE_AS_SLAVE_RSP)
+            if self.factory.telemetry_interval > 0:
+                self.send(command=Commands.TELEMETRY_SUBSCRIBE_REQ,
+                          data={'interval': self.factory.telemetry_interval, 'batch': self.factory.telemetry_batch})
+        elif command == Commands.TELEMETRY_SUBSCRIBE_RSP:
+            pass
+        elif command == Commands.TELEMETRY_NOTIFY:
+            if payload: self.factory.telemetry.put(self.telemetry_key, payload.get('fields') or [], payload.get('samples') or [])
+        elif command == Commands.TELEMETRY_QUERY_REQ:
+            self.query_telemetry(payload or {})
         elif command == Commands.HEARTBEAT_REQ:
+            if payload and payload.get('rtt') is not None: self.rtt = float(payload['rtt'])
+            if self.relay and payload and 'slaves' in payload: self.capacity = int(payload['slaves'])
+            if payload and payload.get('profiler_cache'): self.profiler_cache = payload.pop('profiler_cache')
             self.send(command=Commands.HEARTBEAT_RSP, data=payload)
             return
+        elif command == Commands.STATS_REQ:
+            stats = {'metrics': METRICS.snapshot()}
+            if payload and payload.get('connections'):
+                stats['connections'] = [x.describe_traffic() for x in self.factory.clients.values()]
+            self.send(command=Commands.STATS_RSP, data=stats)
+        elif command == Commands.SLAVE_STATUS_REQ:
+            slaves = [x.describe() for x in self.factory.clients.values() if x.is_slave] + self.factory.describe_restoring()
+            counts = dict(collections.Counter(x['status'] for x in slaves))
+            self.send(command=Commands.SLAVE_STATUS_RSP, data={'slaves': slaves, 'counts': counts})
         elif command == Commands.COLLABORATE_REQ:
+            try:
+                selector = Selector(payload['selector']) if payload.get('selector') else None
+            except ValueError as error:
+                self.send(command=Commands.COLLABORATE_RSP, data={'msg': 'invalid selector'},
+                          retcode=Exceptions.ERROR_FORMAT, info=str(error))
+                return
+            try:
+                projection = Projection.parse(payload.get('projection'))
+            except ValueError as error:
+                self.send(command=Commands.COLLABORATE_RSP, data={'msg': 'invalid projection'},
+                          retcode=Exceptions.ERROR_FORMAT, info=str(error))
+                return
+            # slaves get the normalized form, equal projections written differently still share a round
+            if projection: payload['projection'] = projection.describe()
+            else: payload.pop('projection', None)
             self.send(command=Commands.COLLABORATE_RSP, data={'msg': 'wait for asynchronous notify'})
-            self.factory.get(mission=payload['mission']).dispatch_missions(sender=self.address, parameters=payload)
+            if payload.get('tasks'):
+                collaborate = self.factory.create(JobQueueScheduler, mission=payload['mission'], selector=selector, projection=projection)
+            elif int(payload['mission']) == CollaborateMissions.RUN_COMMAND:
+                # every command runs in a round of its own, a different command must never join one in flight
+                collaborate = self.factory.create(CollaborateScheduler, mission=payload['mission'], selector=selector,
+                                                  projection=projection, parameters=payload)
+            else:
+                collaborate = self.factory.get(mission=payload['mission'], selector=selector, projection=projection, parameters=payload)
+            collaborate.dispatch_missions(sender=self.address, parameters=payload)
         elif command == Commands.COLLABORATE_MISSION_RSP: # accept mission
             if payload and not payload.get('accepted'):
-                self.factory.get(mission=payload['mission']).finish(addr=self.address)
+                collaborate = self.factory.find(payload)
+                if collaborate: collaborate.finish(addr=self.address)
+        elif command == Commands.COLLABORATE_OUTPUT_REQ:
+            self.receive_output(payload or {})
+        elif command in ARTIFACT_COMMANDS:
+            self.transfers.handle(msg)
         elif command == Commands.COLLABORATE_COMPLETE_REQ:
             self.send(command=Commands.COLLABORATE_COMPLETE_RSP)
-            self.factory.get(mission=payload['mission']).receive(addr=self.address, rsp=msg)
+            if payload:
+                self.update_load(payload)
+                self.record_mission_latency(payload)
+            collaborate = self.factory.find(payload)
+            if collaborate: collaborate.receive(addr=self.address, rsp=msg)
         elif command == Commands.BROADCAST_REQ:
             self.send(command=Commands.BROADCAST_RSP)
             notify = {'sender': {'ip': self.address.host, 'port': self.address.port}}
             notify.update(payload)
-            for _, client in self.factory.clients.items():
-                if client != self: client.send(command=Commands.BROADCAST_NOTIFY, data=notify)
+            fanout(self.factory.clients.values(), command=Commands.BROADCAST_NOTIFY, data=notify, exclude=(self,))
         elif command < 100:
             self.send(command=command+1, data={'msg': 'success with auto response'})
 
     def connectionLost(self, reason=connectionDone):
+        if self.__liveness_call and self.__liveness_call.active(): self.__liveness_call.cancel()
+        self.__liveness_call = None
+        self.transfers.close()
         del self.factory.clients[self.address]
-        if self.is_slave: self.factory.slave_count -= 1
-        self.print('connection lost #total={} #slaves={}'.format(len(self.factory.clients), self.factory.slave_count))
+        self.factory.admission.release(self.address, 'lost')
+        if self.is_slave:
+            if self.machine and not self.relay:
+                self.factory.state.disconnect(self.machine)
+                self.factory.save_state()
+            self.factory.slave_count -= 1
+            self.factory.registry.remove(self.address)
+            self.factory.results.remove(self.address)
+            for collaborate in self.factory.collaborates():
+                collaborate.finish(addr=self.address)
+        self.log(INFO, 'connection lost #total={} #slaves={}', len(self.factory.clients), self.factory.slave_count)
+
+class MetricsResource(Resource):
+    isLeaf = True
+
+    def render_GET(self, request):
+        request.setHeader(b'content-type', b'text/plain; version=0.0.4; charset=utf-8')
+        return METRICS.exposition().encode('utf-8')
 
 class ClientConnectionFactory(Factory):
     def __init__(self):
         self.clients = {}  # type: dict[IPv4Address, ClientConnection]
         self.__sequence = 0
-        self.__collaborates = {}  # type: dict[int, CollaborateScheduler]
+        self.__collaborates = {}  # type: dict[tuple, CollaborateScheduler]
+        self.__rounds = {}  # type: dict[int, CollaborateScheduler]
+        self.__round = 0
+        self.registry = SlaveRegistry()
         self.slave_count = 0
-        self.silent_commands = (
-            Commands.HEARTBEAT_REQ,
-            Commands.HEARTBEAT_RSP,
-        )
+        self.results = ResultCache(clock=reactor)
+        self.inventory = InventoryStore()
+        self.state = QueenState()
+        self.state_save_delay = 5.0
+        self.__state_call = None # type: IDelayedCall
+        self.admission = AdmissionControl(clock=reactor)
+        self.clock = reactor
+        self.restoring = {} # type: dict[str, dict]
+        self.__restore_started = 0.0
+        self.__restore_call = None # type: IDelayedCall
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.compress_threshold = COMPRESS_THRESHOLD
+        self.verbose = True
+        self.suspect_after = 25.0
+        self.dead_after = 60.0
+        self.telemetry = TelemetryStore()
+        self.telemetry_interval = 1.0
+        self.telemetry_batch = 10
+        self.send_high_watermark = SEND_HIGH_WATERMARK
+        self.send_low_watermark = SEND_LOW_WATERMARK
+        self.send_max_queue_size = SEND_MAX_QUEUE_SIZE
+        self.send_overflow_timeout = SEND_OVERFLOW_TIMEOUT
+        self.artifact_dir = None # type: str
+        METRICS.gauge('connections', lambda: len(self.clients), 'open client connections')
+        METRICS.gauge('slaves', lambda: self.slave_count, 'connected slaves')
+        METRICS.gauge('handshakes_in_flight', lambda: len(self.admission), 'slaves admitted and still settling their inventory')
+        METRICS.gauge('restoring_slaves', lambda: len(self.restoring), 'slaves from the last snapshot that are not back yet')
+        METRICS.gauge('send_queue_bytes', lambda: sum(x.send_queue.size for x in self.clients.values()),
+                      'bytes waiting in all send queues')
+        METRICS.gauge('send_queue_max_bytes', lambda: max([x.send_queue.size for x in self.clients.values()] or [0]),
+                      'bytes waiting in the deepest send queue')
+
+    @property
+    def clock(self): return self.__clock # type: IReactorTime
 
-    def get(self, mission):
-        if mission not in self.__collaborates:
-            self.__collaborates[mission] = CollaborateScheduler(factory=self, mission=mission)
-        return self.__collaborates.get(mission)
+    @clock.setter
+    def clock(self, clock): # type: (IReactorTime)->None
+        # whatever keeps time for the queen gets the clock it is given, tests swap in a task.Clock
+        self.__clock = clock
+        self.results.clock = clock
+        self.admission.clock = clock
 
-    def update(self):
-        for addr, collaborate in self.__collaborates.items():
-            collaborate.update()
+    @staticmethod
+    def __key(mission, selector, projection=None, parameters=None): # type: (int, Selector, Projection, dict)->tuple
+        key = mission, selector.text.strip().lower() if selector else '', request_key(parameters)
+        return key + (projection.key,) if projection else key
+
+    def create(self, scheduler_class, mission, selector=None, key=None, projection=None, parameters=None):
+        self.__round += 1
+        collaborate = scheduler_class(factory=self, mission=mission, selector=selector, round=self.__round)
+        collaborate.key = key or (mission, '#{}'.format(self.__round))
+        collaborate.projection = projection
+        if isinstance(collaborate, CollaborateScheduler): collaborate.request_key = request_key(parameters)
+        self.__collaborates[collaborate.key] = self.__rounds[self.__round] = collaborate
+        return collaborate
+
+    def get(self, mission, selector=None, projection=None, parameters=None):
+        # type: (int, Selector, Projection, dict)->CollaborateScheduler
+        # a refresh must not be served by a round that may answer from the slave caches, so it never merges
+        if (parameters or {}).get('refresh'):
+            return self.create(CollaborateScheduler, mission=mission, selector=selector, projection=projection, parameters=parameters)
+        key = self.__key(mission, selector, projection, parameters)
+        collaborate = self.__collaborates.get(key)
+        if collaborate and not collaborate.joinable:
+            # artifacts the late request missed are gone, it runs a round of its own
+            return self.create(CollaborateScheduler, mission=mission, selector=selector, projection=projection, parameters=parameters)
+        if not collaborate:
+            return self.create(CollaborateScheduler, mission=mission, selector=selector, key=key, projection=projection,
+                               parameters=parameters)
+        return collaborate
+
+    def find(self, payload): # type: (dict)->CollaborateScheduler
+        if 'round' in payload: return self.__rounds.get(payload['round'])
+        return self.__collaborates.get(self.__key(payload.get('mission'), None))
+
+    def release(self, collaborate): # type: (CollaborateScheduler)->None
+        if self.__collaborates.get(collaborate.key) is collaborate:
+            del self.__collaborates[collaborate.key]
+        self.__rounds.pop(collaborate.round, None)
+
+    def busy_slaves(self):
+        busy = set()
+        for collaborate in self.__collaborates.values():
+            busy.update(collaborate.pending())
+        return busy
+
+    def select(self, selector): # type: (Selector)->list[ClientConnection]
+        # suspect slaves are left out up front instead of holding the round until mission_timeout
+        if not selector:
+            return [x for x in self.clients.values() if x.is_slave and x.alive]
+        # relays have no inventory here, they get the selector and match their own subtree
+        exclude = {k for k, v in self.clients.items() if v.relay or not v.alive}
+        selected = [self.clients[x] for x in self.registry.select(selector, busy=self.busy_slaves(), exclude=exclude)
+                    if x in self.clients]
+        return selected + [x for x in self.clients.values() if x.relay and x.alive]
+
+    def capacity(self): # type: ()->int
+        return sum(x.capacity for x in self.clients.values() if x.is_slave and x.alive)
+
+    def collaborates(self):
+        return list(self.__collaborates.values())
+
+    def restore(self, state): # type: (QueenState)->None
+        # slaves connected at the last snapshot are expected back, those missing after dead_after are let go
+        self.state = state
+        self.restoring = state.connected()
+        if not self.restoring: return
+        self.__restore_started = self.clock.seconds()
+        self.__restore_call = self.clock.callLater(self.dead_after, self.__restore_timeout)
+        LOG.info('-- warm restart expecting {} slaves snapshot_age={:.1f}s', len(self.restoring), time.time() - (state.saved or 0))
+
+    def __restore_timeout(self):
+        self.__restore_call = None
+        if not self.restoring: return
+        LOG.warning('-- warm restart gave up on {} slaves after {:.0f}s', len(self.restoring), self.dead_after)
+        for machine in list(self.restoring): self.state.disconnect(machine)
+        self.restoring.clear()
+        self.save_state()
+
+    def describe_restoring(self): # type: ()->list[dict]
+        return [{'machine': k, 'address': v.get('address'), 'status': SLAVE_RESTORING,
+                 'silence': round(time.time() - (v.get('seen') or 0), 3), 'rtt': v.get('rtt'), 'load': v.get('load')}
+                for k, v in self.restoring.items()]
+
+    def serving(self, client): # type: (ClientConnection)->None
+        # the handshake is over once the inventory is settled
+        elapse = self.admission.release(client.address)
+        if elapse is not None: client.log(DEBUG, 'handshake done in {:.3f}s', elapse)
+        if client.is_slave and client.machine and not client.relay:
+            record = self.restoring.pop(client.machine, None)
+            if record:
+                # a restored slave schedules with its last known load until it reports a fresh one
+                if client.load is None: client.load = record.get('load')
+                if client.rtt is None: client.rtt = record.get('rtt')
+                if not self.restoring: self.__restored()
+            self.state.put(client.machine, client.snapshot())
+        self.save_state()
+
+    def __restored(self):
+        if self.__restore_call and self.__restore_call.active(): self.__restore_call.cancel()
+        self.__restore_call = None
+        LOG.info('-- warm restart complete in {:.3f}s', self.clock.seconds() - self.__restore_started)
+
+    def save_state(self):
+        # coalesce the burst of updates after a restart into one write
+        if self.__state_call and self.__state_call.active(): return
+        if not self.inventory.dirty and not self.state.dirty: return
+        self.__state_call = self.clock.callLater(self.state_save_delay, self.flush_state)
+
+    def flush_state(self):
+        for client in self.clients.values():
+            if client.is_slave and client.machine and not client.relay: self.state.put(client.machine, client.snapshot())
+        self.inventory.save()
+        self.state.save()
 
     def buildProtocol(self, addr):
         client = ClientConnection(factory=self, addr=addr)
         client.uuid = self.__sequence
+        client.max_frame_size = self.max_frame_size
+        client.compress_threshold = self.compress_threshold
+        client.verbose = self.verbose
+        queue = client.send_queue
+        queue.clock = self.clock
+        queue.high_watermark, queue.low_watermark = self.send_high_watermark, self.send_low_watermark
+        queue.max_size, queue.overflow_timeout = self.send_max_queue_size, self.send_overflow_timeout
         self.__sequence += 1
         return client
 
+class RelayConnection(TCP):
+    # link from a relay to its parent queen, the whole local fleet shows up there as a single slave
+    def __init__(self, address, factory):
+        super(RelayConnection, self).__init__(address=address)
+        self.factory = factory # type: RelayConnectionFactory
+        self.queen = factory.queen # type: ClientConnectionFactory
+        self.verbose = self.queen.verbose
+        self.rtt = None # type: float
+        self.__capacity = 0
+        self.__heartbeat_time = 0.0
+        self.__heartbeat = None # type: task.LoopingCall
+        self.__output_acks = {} # type: dict[int, defer.Deferred]
+        self.__output_seq = 0
+
+    def connectionMade(self):
+        self.negotiate()
+        self.send(command=Commands.SERVE_AS_SLAVE_REQ, data={'relay': True, 'slaves': self.queen.capacity()})
+        self.__capacity = self.queen.capacity()
+        self.__heartbeat_time = 0.0
+        self.__heartbeat = task.LoopingCall(self.update)
+        self.__heartbeat.start(1.0)
+
+    def connectionLost(self, reason=connectionDone):
+        self.connected = 0 # rounds still running for the parent are dropped when they end
+        if self.__heartbeat and self.__heartbeat.running: self.__heartbeat.stop()
+        self.__heartbeat = None
+        # nothing upstream will ack these any more, let the slaves run their output out
+        waiters, self.__output_acks = self.__output_acks, {}
+        for waiter in waiters.values(): waiter.callback(None)
+
+    def update(self):
+        # the parent sizes job slots by the subtree, tell it about slaves coming and going without waiting for the next beat
+        capacity = self.queen.capacity()
+        if capacity != self.__capacity or time.time() - self.__heartbeat_time >= self.factory.heartbeat_interval:
+            self.__capacity = capacity
+            self.send_heartbeat()
+
+    def send_heartbeat(self):
+        self.__heartbeat_time = time.time()
+        heartbeat = {'ts': self.__heartbeat_time, 'slaves': self.queen.capacity()}
+        if self.rtt is not None: heartbeat['rtt'] = self.rtt
+        self.send(command=Commands.HEARTBEAT_REQ, data=heartbeat)
+
+    def dispatch(self, parameters): # type: (dict)->None
+        local = dict(parameters)
+        upstream = {k: local.pop(k) for k in ('id', 'round', 'task') if k in local}
+        upstream['stime'] = datetime.datetime.now().timestamp()
+        for name in ('mission_timeout', 'task_timeout'):
+            if float(local.get(name) or 0) > 0: local[name] = float(local[name]) * self.factory.timeout_ratio
+        try:
+            selector = Selector(local['selector']) if local.get('selector') else None
+            projection = Projection.parse(local.get('projection'))
+        except ValueError as error:
+            self.complete(upstream, local, retcode=Exceptions.ERROR_FORMAT, info=str(error))
+            return
+        if 'task' in upstream:
+            local['tasks'] = [{}]
+            collaborate = self.queen.create(JobQueueScheduler, mission=local.get('mission'), selector=selector, projection=projection)
+        else:
+            local['stream'] = False
+            collaborate = self.queen.create(CollaborateScheduler, mission=local.get('mission'), selector=selector, projection=projection,
+                                            parameters=local)
+        collaborate.add_listener(lambda results, summary, retcode: self.complete(upstream, local, results, summary, retcode),
+                                 output=lambda item: self.forward_output(upstream, item))
+        collaborate.dispatch_missions(sender=None, parameters=local)
+
+    def forward_output(self, upstream, item): # type: (dict, dict)->defer.Deferred
+        # the slave's ack waits for the parent's, stream ids are only unique per slave so chunks are keyed by a relay sequence
+        if not self.connected: return None
+        self.__output_seq += 1
+        data = dict(item)
+        data.update({k: v for k, v in upstream.items() if k != 'stime'})
+        data['relay_seq'] = self.__output_seq
+        waiter = self.__output_acks[self.__output_seq] = defer.Deferred()
+        self.send(command=Commands.COLLABORATE_OUTPUT_REQ, data=data)
+        return waiter
+
+    def complete(self, upstream, parameters, results=None, summary=None, retcode=0, info=''):
+        if not self.connected: return
+        data = {k: v for k, v in parameters.items() if k not in ('tasks', 'stream')}
+        if 'task' in upstream:
+            # a task of the parent job comes back as the artifact of the slave that ran it
+            if results: data.update(results[0])
+            else:
+                failed = (summary or {}).get('failed') or [{}]
+                retcode, info = retcode or Exceptions.MISSION_FAILED, info or failed[0].get('reason') or 'no slave available'
+        else:
+            data['artifacts'] = results or []
+            data['relay'] = summary or {}
+            if retcode: info = info or 'relay round failed'
+        data.update(upstream)
+        data['etime'] = datetime.datetime.now().timestamp()
+        self.send(command=Commands.COLLABORATE_COMPLETE_REQ, data=data, retcode=retcode, info=info)
+
+    def packReceived(self, msg):
+        command = msg.get('command') # type: int
+        payload = msg.get('data') # type: dict
+        self.log_frame('>>>', msg)
+        if command == Commands.HEARTBEAT_RSP:
+            if payload and payload.get('ts'): self.rtt = round(time.time() - float(payload['ts']), 6)
+        elif command == Commands.COLLABORATE_MISSION_REQ:
+            respond = {'accepted': True}
+            respond.update(payload)
+            self.send(command=Commands.COLLABORATE_MISSION_RSP, data=respond)
+            self.dispatch(payload or {})
+        elif command == Commands.COLLABORATE_OUTPUT_RSP:
+            waiter = self.__output_acks.pop((payload or {}).get('relay_seq'), None)
+            if waiter: waiter.callback(None)
+        elif command == Commands.TELEMETRY_SUBSCRIBE_REQ: # samples stay with the relay that owns the slaves
+            self.send(command=Commands.TELEMETRY_SUBSCRIBE_RSP, data={'interval': 0})
+        elif command == Commands.BROADCAST_NOTIFY:
+            fanout(self.queen.clients.values(), command=Commands.BROADCAST_NOTIFY, data=payload)
+
+class RelayConnectionFactory(ReconnectingClientFactory):
+    maxDelay = 30
+
+    def __init__(self, queen):
+        self.queen = queen # type: ClientConnectionFactory
+        self.connection = None # type: RelayConnection
+        self.heartbeat_interval = 10.0
+        self.timeout_ratio = RELAY_TIMEOUT_RATIO
+
+    def buildProtocol(self, addr):
+        self.resetDelay()
+        self.connection = RelayConnection(address=addr, factory=self)
+        self.connection.compress_threshold = self.queen.compress_threshold
+        return self.connection
+
+    def clientConnectionFailed(self, connector, reason):
+        LOG.warning('upstream connection fail {}', reason.getErrorMessage())
+        super(RelayConnectionFactory, self).clientConnectionFailed(connector, reason)
+        self.connection = None
+
+    def clientConnectionLost(self, connector, reason):
+        LOG.warning('upstream connection lost {}', reason.getErrorMessage())
+        super(RelayConnectionFactory, self).clientConnectionLost(connector, reason)
+        self.connection = None
+
 def main():
     import argparse, sys
     arguments = argparse.ArgumentParser()
     arguments.add_argument('--port', '-p', required=True, type=int, help='server listen port number')
+    arguments.add_argument('--max-frame-size', type=int, default=MAX_FRAME_SIZE >> 20, help='max frame size in MB')
+    arguments.add_argument('--compress-threshold', type=int, default=COMPRESS_THRESHOLD >> 10,
+                           help='compress frames from this size in KB, 0 to disable')
+    arguments.add_argument('--result-ttl', type=float, default=3600.0, help='seconds to keep slave results for max_staleness, 0 to disable')
+    arguments.add_argument('--suspect-after', type=float, default=25.0, help='seconds of silence before a slave is left out of rounds')
+    arguments.add_argument('--dead-after', type=float, default=60.0, help='seconds of silence before a slave is disconnected')
+    arguments.add_argument('--telemetry-interval', type=float, default=1.0, help='seconds between slave telemetry samples, 0 to disable')
+    arguments.add_argument('--telemetry-batch', type=int, default=10, help='telemetry samples per frame')
+    arguments.add_argument('--metrics-port', type=int, default=0, help='serve prometheus metrics on localhost at this port')
+    arguments.add_argument('--send-high-watermark', type=int, default=SEND_HIGH_WATERMARK >> 10,
+                           help='KB queued for a slow peer before broadcasts are dropped and the overflow timer starts')
+    arguments.add_argument('--send-low-watermark', type=int, default=SEND_LOW_WATERMARK >> 10,
+                           help='KB the send queue has to drain to before the overflow timer is cleared')
+    arguments.add_argument('--send-max-queue-size', type=int, default=SEND_MAX_QUEUE_SIZE >> 20,
+                           help='MB queued for a peer before it is disconnected at once')
+    arguments.add_argument('--send-overflow-timeout', type=float, default=SEND_OVERFLOW_TIMEOUT,
+                           help='seconds a peer may stay over the high watermark before it is disconnected')
+    arguments.add_argument('--upstream', metavar='HOST:PORT', help='run as a relay that serves its slaves to this queen as one node')
+    arguments.add_argument('--relay-timeout-ratio', type=float, default=RELAY_TIMEOUT_RATIO,
+                           help='share of the parent mission timeout a relay waits for its own slaves')
+    arguments.add_argument('--quiet', action='store_true', help='do not log every frame of every connection')
+    logger.add_arguments(arguments)
+    arguments.add_argument('--inventory', default='~/.codmci/inventory.json', help='persisted per-machine slave inventory')
+    arguments.add_argument('--state', default='~/.codmci/queen-state.json', help='snapshot of the slaves being served, for warm restarts')
+    arguments.add_argument('--admission-rate', type=float, default=ADMISSION_RATE, help='slave handshakes admitted per second, 0 to disable')
+    arguments.add_argument('--admission-burst', type=int, default=ADMISSION_BURST, help='slave handshakes admitted at once before the rate applies')
+    arguments.add_argument('--max-handshakes', type=int, default=MAX_HANDSHAKES,
+                           help='slaves allowed to settle their inventory at the same time, 0 for no limit')
+    arguments.add_argument('--artifact-dir', default='~/.codmci/artifacts', help='where uploaded artifacts are kept and served from, empty to disable')
     options = arguments.parse_args(sys.argv[1:])
+    logger.configure(options)
     factory = ClientConnectionFactory()
-    t = task.LoopingCall(factory.update)
-    t.start(1.0/5)
-    reactor.listenTCP(options.port, factory)
+    factory.inventory = InventoryStore(filename=os.path.expanduser(options.inventory)).load()
+    if options.artifact_dir: factory.artifact_dir = os.path.expanduser(options.artifact_dir)
+    factory.results.ttl = options.result_ttl
+    factory.verbose = not options.quiet
+    factory.suspect_after = options.suspect_after
+    factory.dead_after = options.dead_after
+    factory.telemetry_interval = options.telemetry_interval
+    factory.telemetry_batch = options.telemetry_batch
+    factory.max_frame_size = options.max_frame_size << 20
+    factory.compress_threshold = options.compress_threshold << 10
+    factory.send_high_watermark = options.send_high_watermark << 10
+    factory.send_low_watermark = min(options.send_low_watermark << 10, factory.send_high_watermark)
+    factory.send_max_queue_size = options.send_max_queue_size << 20
+    factory.send_overflow_timeout = options.send_overflow_timeout
+    factory.admission = AdmissionControl(clock=factory.clock, rate=options.admission_rate, burst=options.admission_burst,
+                                         max_handshakes=options.max_handshakes)
+    factory.restore(QueenState(filename=os.path.expanduser(options.state)).load())
+    reactor.addSystemEventTrigger('before', 'shutdown', factory.flush_state)
+    reactor.listenTCP(options.port, factory, backlog=1024)
+    if options.upstream:
+        host, _, port = options.upstream.rpartition(':')
+        upstream = RelayConnectionFactory(queen=factory)
+        upstream.timeout_ratio = options.relay_timeout_ratio
+        reactor.connectTCP(host or 'localhost', int(port), upstream)
+    if options.metrics_port: reactor.listenTCP(options.metrics_port, Site(MetricsResource()), interface='127.0.0.1')
     reactor.run()
 
 if __name__ == '__main__':
@@ -1,11 +1,30 @@
 from twisted.internet.protocol import Protocol
 from twisted.internet.endpoints import IPv4Address
-import json, struct, io, datetime
+from twisted.internet import reactor, defer
+from twisted.internet.interfaces import IPushProducer, IReactorTime, IDelayedCall
+from zope.interface import implementer
+import json, struct, io, datetime, zlib, time, collections
 from serialization import decode_system_information
+from codec import *
+from logger import LOG, DEBUG, INFO, WARNING, ERROR
 
 __author__ = 'larryhou'
 
 TRANSPORT_MAGIC_NUMBER = 0x12345678
+FRAME_HEADER = struct.Struct('>II')
+FRAME_HEADER_SIZE = FRAME_HEADER.size
+MAX_FRAME_SIZE = 64 << 20
+COMPRESS_THRESHOLD = 16 << 10
+FRAME_FLAG_BINARY = 0x01
+FRAME_FLAG_COMPRESSED = 0x02
+FRAME_FLAG_CHUNK = 0x04 # raw artifact bytes behind a CHUNK_HEADER instead of an encoded message
+FRAME_FLAG_MASK = 0x07
+FEATURE_INVENTORY_DELTA = 'inventory-delta'
+FEATURE_ARTIFACT_TRANSFER = 'artifact-transfer'
+FEATURE_ADMISSION = 'admission' # slaves wait to be admitted before sending their inventory
+CHUNK_HEADER = struct.Struct('>IQI') # transfer id, offset, crc32
+ARTIFACT_CHUNK_SIZE = 64 << 10
+ARTIFACT_BURST_SIZE = 1 << 20 # artifact bytes written in one reactor turn before reading again
 
 class Enum(object):
     __name_map = {}
@@ -24,6 +43,7 @@ class CollaborateMissions(Enum):
     REPORT_SYSTEM_STATS = 20000
     REPORT_PERFORMANCE_STATS = 20001
     REPORT_SYSTEM_PROFILER = 20002
+    RUN_COMMAND = 20003
 
 class Broadcasts(Enum):
     CHAT = 30000
@@ -42,30 +62,378 @@ class Commands(Enum):
     COLLABORATE_MISSION_RSP = 8
     COLLABORATE_COMPLETE_REQ = 9
     COLLABORATE_COMPLETE_RSP = 10
+    COLLABORATE_ARTIFACT_NOTIFY = 10010
     SERVE_AS_SLAVE_REQ = 11
     SERVE_AS_SLAVE_RSP = 12
     BROADCAST_REQ = 13
     BROADCAST_RSP = 14
     BROADCAST_NOTIFY = 10014
+    NEGOTIATE_REQ = 15
+    NEGOTIATE_RSP = 16
+    INVENTORY_DIGEST_REQ = 17
+    INVENTORY_DIGEST_RSP = 18
+    TELEMETRY_SUBSCRIBE_REQ = 19
+    TELEMETRY_SUBSCRIBE_RSP = 20
+    TELEMETRY_NOTIFY = 10020
+    TELEMETRY_QUERY_REQ = 21
+    TELEMETRY_QUERY_RSP = 22
+    SLAVE_STATUS_REQ = 23
+    SLAVE_STATUS_RSP = 24
+    STATS_REQ = 25
+    STATS_RSP = 26
+    COLLABORATE_OUTPUT_REQ = 27
+    COLLABORATE_OUTPUT_RSP = 28
+    COLLABORATE_OUTPUT_NOTIFY = 10028
+    ARTIFACT_PUT_REQ = 29
+    ARTIFACT_PUT_RSP = 30
+    ARTIFACT_GET_REQ = 31
+    ARTIFACT_GET_RSP = 32
+    ARTIFACT_SEEK_NOTIFY = 10031
+    ARTIFACT_DONE_NOTIFY = 10032
+    COLLABORATE_CANCEL_NOTIFY = 10033
+
+ARTIFACT_COMMANDS = (Commands.ARTIFACT_PUT_REQ, Commands.ARTIFACT_PUT_RSP, Commands.ARTIFACT_GET_REQ,
+                     Commands.ARTIFACT_GET_RSP, Commands.ARTIFACT_SEEK_NOTIFY, Commands.ARTIFACT_DONE_NOTIFY)
+
+SILENT_COMMANDS = (Commands.HEARTBEAT_REQ, Commands.HEARTBEAT_RSP, Commands.TELEMETRY_NOTIFY,
+                   Commands.COLLABORATE_OUTPUT_REQ, Commands.COLLABORATE_OUTPUT_RSP, Commands.COLLABORATE_OUTPUT_NOTIFY)
+# output of a command mission travels in chunks, at most a window of unacknowledged bytes per command
+COMMAND_CHUNK_SIZE = 32 << 10
+COMMAND_WINDOW = 1 << 20
+COMMAND_TAIL_SIZE = 4 << 10
+
+SEND_HIGH_WATERMARK = 4 << 20
+SEND_LOW_WATERMARK = 1 << 20
+SEND_MAX_QUEUE_SIZE = 128 << 20
+SEND_OVERFLOW_TIMEOUT = 30.0
+SEND_POLICY_KEEP = 'keep'
+SEND_POLICY_DROP_OLDEST = 'drop-oldest'
+# commands missing here are kept, mission results and responses must never be lost
+SEND_POLICIES = {Commands.BROADCAST_NOTIFY: SEND_POLICY_DROP_OLDEST}
 
 class Exceptions(Enum):
     ERROR_FORMAT = -1
     NOT_IMPLEMENTED = -2
     COLLABORATE_TIMEOUT = -3
+    MISSION_FAILED = -4
+    ARTIFACT_FAILED = -5
+    HANDSHAKE_DEFERRED = -6
+    ARTIFACT_BUSY = -7
+
+class Histogram(object):
+    # log-linear buckets in the spirit of HdrHistogram: each power of two is split into 2**precision
+    # sub buckets, so any recorded value is off by less than 1/2**precision and memory stays tiny
+    def __init__(self, precision=5):
+        self.precision = precision
+        self.sub_buckets = 1 << precision
+        self.buckets = {} # type: dict[int, int]
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def __index(self, value): # type: (int)->int
+        if value < self.sub_buckets: return value
+        exponent = value.bit_length() - self.precision - 1
+        return exponent * self.sub_buckets + (value >> exponent)
+
+    def __value(self, index): # type: (int)->int
+        if index < self.sub_buckets: return index
+        exponent = index // self.sub_buckets - 1
+        lower = (index - exponent * self.sub_buckets) << exponent
+        return lower + ((1 << exponent) >> 1) # middle of the bucket
+
+    def record(self, value): # type: (float)->None
+        value = int(value) if value > 0 else 0
+        index = self.__index(value)
+        self.buckets[index] = self.buckets.get(index, 0) + 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min: self.min = value
+        if self.max is None or value > self.max: self.max = value
+
+    def percentile(self, p): # type: (float)->int
+        if not self.count: return None
+        rank, seen = max(1, int(p / 100.0 * self.count + 0.5)), 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank: return max(min(self.__value(index), self.max), self.min)
+        return self.max
+
+    def summary(self): # type: ()->dict
+        summary = {'count': self.count, 'sum': self.sum, 'min': self.min, 'max': self.max}
+        if self.count:
+            summary['mean'] = round(self.sum / self.count, 3)
+            for p in METRIC_PERCENTILES: summary['p{}'.format(p)] = self.percentile(p)
+        return summary
+
+METRIC_PERCENTILES = (50, 90, 99, 99.9)
+
+class MetricsRegistry(object):
+    def __init__(self, namespace='codmci'):
+        self.namespace = namespace
+        self.started = time.time()
+        self.counters = {} # type: dict[str, dict[str, float]]
+        self.histograms = {} # type: dict[str, dict[str, Histogram]]
+        self.gauges = {} # type: dict[str, callable]
+        self.descriptions = {} # type: dict[str, tuple[str, str]]
+
+    def describe(self, name, text, label=None): # type: (str, str, str)->None
+        self.descriptions[name] = (text, label)
+
+    def inc(self, name, label='', value=1):
+        series = self.counters.get(name)
+        if series is None: series = self.counters[name] = {}
+        series[label] = series.get(label, 0) + value
+
+    def observe(self, name, value, label=''):
+        series = self.histograms.get(name)
+        if series is None: series = self.histograms[name] = {}
+        histogram = series.get(label)
+        if histogram is None: histogram = series[label] = Histogram()
+        histogram.record(value)
+
+    def gauge(self, name, func, text=''): # type: (str, callable, str)->None
+        self.gauges[name] = func
+        if text: self.describe(name, text)
+
+    def snapshot(self): # type: ()->dict
+        return {'uptime': round(time.time() - self.started, 3),
+                'counters': {name: series.get('') if list(series) == [''] else dict(series) for name, series in self.counters.items()},
+                'gauges': {name: func() for name, func in self.gauges.items()},
+                'histograms': {name: {k: v.summary() for k, v in series.items()} for name, series in self.histograms.items()}}
+
+    def __labels(self, name, label, extra=''):
+        key = self.descriptions.get(name, ('', None))[1]
+        pairs = ['{}="{}"'.format(key, label)] if key and label else []
+        if extra: pairs.append(extra)
+        return '{{{}}}'.format(','.join(pairs)) if pairs else ''
+
+    def __header(self, lines, name, kind, suffix=''):
+        text = self.descriptions.get(name, ('', None))[0]
+        if text: lines.append('# HELP {}_{}{} {}'.format(self.namespace, name, suffix, text))
+        lines.append('# TYPE {}_{}{} {}'.format(self.namespace, name, suffix, kind))
+
+    def exposition(self): # type: ()->str
+        lines = []
+        for name, series in sorted(self.counters.items()):
+            self.__header(lines, name, 'counter', suffix='_total')
+            for label, value in sorted(series.items()):
+                lines.append('{}_{}_total{} {}'.format(self.namespace, name, self.__labels(name, label), value))
+        for name, func in sorted(self.gauges.items()):
+            self.__header(lines, name, 'gauge')
+            lines.append('{}_{} {}'.format(self.namespace, name, func()))
+        for name, series in sorted(self.histograms.items()):
+            self.__header(lines, name, 'summary')
+            for label, histogram in sorted(series.items()):
+                for p in METRIC_PERCENTILES:
+                    quantile = 'quantile="{:g}"'.format(p / 100.0)
+                    lines.append('{}_{}{} {}'.format(self.namespace, name, self.__labels(name, label, quantile), histogram.percentile(p) or 0))
+                lines.append('{}_{}_sum{} {}'.format(self.namespace, name, self.__labels(name, label), histogram.sum))
+                lines.append('{}_{}_count{} {}'.format(self.namespace, name, self.__labels(name, label), histogram.count))
+        lines.append('{}_uptime_seconds {}'.format(self.namespace, round(time.time() - self.started, 3)))
+        return '\n'.join(lines) + '\n'
+
+METRICS = MetricsRegistry()
+METRICS.describe('frames_sent', 'frames written by command', label='command')
+METRICS.describe('frames_received', 'frames decoded by command', label='command')
+METRICS.describe('bytes_sent', 'bytes written to all connections')
+METRICS.describe('bytes_received', 'bytes read from all connections')
+METRICS.describe('frame_bytes', 'encoded frame size in bytes', label='direction')
+METRICS.describe('collaborate_round_us', 'collaborate round duration in microseconds', label='mission')
+METRICS.gauge('log_dropped', lambda: LOG.dropped, 'log records dropped because the writer fell behind')
+METRICS.describe('send_dropped', 'queued frames dropped for slow peers by command', label='command')
+METRICS.describe('send_overflow_disconnects', 'peers disconnected for keeping the send queue over the limit')
+METRICS.describe('artifact_bytes', 'artifact bytes moved in verified chunks', label='direction')
+METRICS.describe('artifact_chunk_errors', 'artifact chunks rejected for a bad checksum')
+METRICS.describe('handshakes', 'slave handshakes by outcome', label='outcome')
+METRICS.describe('handshake_us', 'slave handshake from admission until its inventory is settled in microseconds')
+METRICS.describe('mission_latency_us', 'slave mission latency from stime to etime in microseconds', label='mission')
+
+def make_request(command, data=None, retcode=0, info=''):
+    request = {'retcode': retcode, 'command': command}
+    if data is not None: request['data'] = data
+    request['ts'] = datetime.datetime.now().timestamp()
+    if retcode != 0:
+        if data is None: data = request['data'] = {}
+        data['error'] = {'info':info, 'code':retcode}
+    return request
+
+def fanout(connections, command, data=None, retcode=0, info='', exclude=(), predicate=None):
+    request = make_request(command, data, retcode, info)
+    frames = {}  # type: dict[tuple, bytes]
+    count = 0
+    for connection in connections: # type: TCP
+        if connection in exclude or (predicate and not predicate(connection)): continue
+        key = connection.frame_format
+        frame = frames.get(key)
+        if frame is None:
+            frame = frames[key] = connection.encode_frame(request)
+        connection.write_frame(frame, command=command)
+        count += 1
+    if count: METRICS.inc('frames_sent', label=Commands.name(command), value=count)
+    if count and command not in SILENT_COMMANDS:
+        LOG.info('<<< fanout {} recipients={} frames={}', Commands.name(command), count, len(frames))
+    return count
+
+@implementer(IPushProducer)
+class SendQueue(object):
+    # frames wait here while the transport buffer is full, so a stalled peer costs at most the watermarks
+    def __init__(self, connection, clock=None):
+        self.connection = connection # type: TCP
+        self.clock = clock or reactor # type: IReactorTime
+        self.high_watermark = SEND_HIGH_WATERMARK
+        self.low_watermark = SEND_LOW_WATERMARK
+        self.max_size = SEND_MAX_QUEUE_SIZE
+        self.overflow_timeout = SEND_OVERFLOW_TIMEOUT
+        self.policies = SEND_POLICIES
+        self.size = 0
+        self.peak = 0
+        self.dropped = 0
+        self.paused = False
+        self.attached = False
+        self.closed = False
+        self.__frames = collections.deque() # type: collections.deque[list]
+        self.__droppable = collections.deque() # type: collections.deque[list]
+        self.__drain_waiters = [] # type: list[defer.Deferred]
+        self.__writable_waiters = [] # type: list[defer.Deferred]
+        self.__overflow_call = None # type: IDelayedCall
+
+    def __len__(self):
+        return len(self.__frames)
+
+    def write(self, frame, command=None): # type: (bytes, int)->None
+        transport = self.connection.transport
+        # frames written until the aborted transport goes away would only pile up again
+        if transport is None or self.closed: return
+        if not self.attached:
+            self.attached = True
+            transport.registerProducer(self, True)
+        if not self.paused and not self.__frames:
+            transport.write(frame)
+            return
+        entry = [command, frame]
+        self.__frames.append(entry)
+        if self.policies.get(command) == SEND_POLICY_DROP_OLDEST: self.__droppable.append(entry)
+        self.size += len(frame)
+        if self.size > self.peak: self.peak = self.size
+        if self.size > self.high_watermark: self.__overflow()
+
+    def drained(self): # type: ()->defer.Deferred
+        if self.size <= self.low_watermark: return defer.succeed(None)
+        waiter = defer.Deferred()
+        self.__drain_waiters.append(waiter)
+        return waiter
+
+    def writable(self): # type: ()->defer.Deferred
+        # bulk senders write only into an idle queue, so control frames never wait behind their backlog
+        if not self.paused and not self.__frames: return defer.succeed(None)
+        waiter = defer.Deferred()
+        self.__writable_waiters.append(waiter)
+        return waiter
+
+    @staticmethod
+    def __release(waiters): # type: (list[defer.Deferred])->None
+        for waiter in waiters: waiter.callback(None)
+
+    def __overflow(self):
+        while self.size > self.high_watermark and self.__droppable:
+            entry = self.__droppable.popleft()
+            self.size -= len(entry[1])
+            entry[1] = None
+            self.dropped += 1
+            METRICS.inc('send_dropped', label=Commands.name(entry[0]))
+        if self.size <= self.high_watermark: return
+        if self.size > self.max_size and len(self.__frames) > 1:
+            self.disconnect('send queue {} bytes over the limit {}'.format(self.size, self.max_size))
+            return
+        if self.__overflow_call is None:
+            self.__overflow_call = self.clock.callLater(self.overflow_timeout, self.__expire)
+
+    def __expire(self):
+        self.__overflow_call = None
+        self.disconnect('send queue over {} bytes for {}s'.format(self.high_watermark, self.overflow_timeout))
+
+    def disconnect(self, reason): # type: (str)->None
+        self.connection.log(WARNING, 'disconnect slow peer: {}', reason)
+        METRICS.inc('send_overflow_disconnects')
+        self.closed = True
+        self.stopProducing()
+        if self.connection.transport: self.connection.transport.abortConnection()
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        transport = self.connection.transport
+        limit = getattr(transport, 'bufferSize', SEND_LOW_WATERMARK)
+        # hand the backlog over in batches of one transport buffer, writing may pause us again
+        while self.__frames and not self.paused:
+            batch, size = [], 0
+            while self.__frames and size < limit:
+                entry = self.__frames.popleft()
+                if self.__droppable and self.__droppable[0] is entry: self.__droppable.popleft()
+                frame = entry[1]
+                if frame is None: continue
+                batch.append(frame)
+                size += len(frame)
+            self.size -= size
+            if batch: transport.writeSequence(batch)
+        if self.size <= self.low_watermark:
+            if self.__overflow_call and self.__overflow_call.active(): self.__overflow_call.cancel()
+            self.__overflow_call = None
+            if self.__drain_waiters:
+                waiters, self.__drain_waiters = self.__drain_waiters, []
+                self.__release(waiters)
+        if self.__writable_waiters and not self.paused and not self.__frames:
+            waiters, self.__writable_waiters = self.__writable_waiters, []
+            self.__release(waiters)
+
+    def stopProducing(self):
+        self.paused = True
+        self.__frames.clear()
+        self.__droppable.clear()
+        self.size = 0
+        if self.__overflow_call and self.__overflow_call.active(): self.__overflow_call.cancel()
+        self.__overflow_call = None
+        waiters, self.__drain_waiters, self.__writable_waiters = self.__drain_waiters + self.__writable_waiters, [], []
+        self.__release(waiters)
+
+    def describe(self): # type: ()->dict
+        return {'queued_frames': len(self.__frames), 'queued_bytes': self.size,
+                'queue_peak_bytes': self.peak, 'dropped': self.dropped}
 
 class TCP(Protocol):
     def __init__(self, address, verbose=True):
         self.address = address # type: IPv4Address
-        self.__pack = b''
-        self.__size = 0
-        self.__received = 0
-        self.__stage = 0
+        self.__buffer = bytearray()
+        self.__corrupted = False
+        self.max_frame_size = MAX_FRAME_SIZE
+        self.codec = JSONCodec
+        self.compression = None # type: ZlibCompression
+        self.compress_threshold = COMPRESS_THRESHOLD
+        self.compress_level = 6
+        self.features = set() # type: set[str]
+        self.peer_features = set() # type: set[str]
         self.verbose = verbose
+        self.frames_sent = 0
+        self.frames_received = 0
+        self.bytes_sent = 0
+        self.bytes_received = 0
+        self.send_queue = SendQueue(self)
+        self.transfers = None # type: TransferManager
 
-    def print(self, msg):
-        if not self.verbose: return
-        ts = datetime.datetime.now().isoformat()
-        print('[{}] {}:{} {}'.format(ts, self.address.host, self.address.port, msg))
+    def log(self, level, message, *args, **fields):
+        # quiet only mutes chatter, warnings and errors always get through
+        if (not self.verbose and level < WARNING) or not LOG.enabled(level): return
+        LOG.log(level, '{}:{} ' + message, self.address.host, self.address.port, *args, **fields)
+
+    def log_frame(self, direction, msg): # type: (str, dict)->None
+        command = msg.get('command')
+        if not self.verbose or command in SILENT_COMMANDS or not LOG.enabled(INFO): return
+        name = self.get_command_name(command)
+        if LOG.sampled(name): self.log(INFO, '{} {}', direction, name, frame=msg)
 
     def get_command_name(self, command):
         return Commands.name(command)
@@ -74,41 +442,150 @@ class TCP(Protocol):
     def decode_system_information(text):
         return decode_system_information(text)
 
+    @property
+    def frame_format(self):
+        compression = (self.compression.name, self.compression.level, self.compress_threshold) if self.compression else None
+        return self.codec, compression
+
+    def encode_frame(self, request): # type: (dict)->bytes
+        serialized_request = self.codec.encode(request)
+        number = TRANSPORT_MAGIC_NUMBER | (FRAME_FLAG_BINARY if self.codec.binary else 0)
+        if self.compression and 0 < self.compress_threshold <= len(serialized_request):
+            compressed = self.compression.compress(serialized_request)
+            if len(compressed) < len(serialized_request):
+                serialized_request = compressed
+                number |= FRAME_FLAG_COMPRESSED
+        return FRAME_HEADER.pack(number, len(serialized_request) + FRAME_HEADER_SIZE) + serialized_request
+
+    @staticmethod
+    def encode_chunk(transfer, offset, crc, data): # type: (int, int, int, bytes)->bytes
+        size = FRAME_HEADER_SIZE + CHUNK_HEADER.size + len(data)
+        return FRAME_HEADER.pack(TRANSPORT_MAGIC_NUMBER | FRAME_FLAG_CHUNK, size) + CHUNK_HEADER.pack(transfer, offset, crc) + data
+
+    def write_frame(self, frame, command=None): # type: (bytes, int)->None
+        self.frames_sent += 1
+        self.bytes_sent += len(frame)
+        METRICS.inc('bytes_sent', value=len(frame))
+        METRICS.observe('frame_bytes', len(frame), label='out')
+        self.send_queue.write(frame, command=command)
+
+    def traffic(self): # type: ()->dict
+        traffic = {'frames_sent': self.frames_sent, 'frames_received': self.frames_received,
+                   'bytes_sent': self.bytes_sent, 'bytes_received': self.bytes_received}
+        traffic.update(self.send_queue.describe())
+        return traffic
+
     def send(self, command, data=None, retcode=0, info=''):
-        request = {'retcode': retcode, 'command': command}
-        if data is not None: request['data'] = data
-        request['ts'] = datetime.datetime.now().timestamp()
-        if retcode != 0:
-            data['error'] = {'info':info, 'code':retcode}
-        if command not in (Commands.HEARTBEAT_RSP, Commands.HEARTBEAT_REQ):
-            self.print('<<< {} {}'.format(self.get_command_name(command), json.dumps(request, ensure_ascii=False)))
-        serialized_request = json.dumps(request, ensure_ascii=False).encode('utf-8')
-        self.transport.write(struct.pack('>I', TRANSPORT_MAGIC_NUMBER))
-        self.transport.write(struct.pack('>I', len(serialized_request) + 8))
-        self.transport.write(serialized_request)
-
-    def packReceived(self, data): # type: (bytes)->None
+        request = make_request(command, data, retcode, info)
+        self.log_frame('<<<', request)
+        METRICS.inc('frames_sent', label=Commands.name(command))
+        self.write_frame(self.encode_frame(request), command=command)
+
+    def negotiate(self):
+        self.send(command=Commands.NEGOTIATE_REQ, data={'codecs': [x.name for x in CODECS],
+                                                        'compressions': [x.name for x in COMPRESSIONS],
+                                                        'features': sorted(self.features)})
+
+    def __negotiate(self, command, payload): # type: (int, dict)->None
+        payload = payload or {}
+        if command == Commands.NEGOTIATE_REQ:
+            codec = negotiate_codec(payload.get('codecs'))
+            compression = negotiate_compression(payload.get('compressions'))
+            self.peer_features = self.features.intersection(payload.get('features') or ())
+            self.send(command=Commands.NEGOTIATE_RSP,
+                      data={'codec': codec.name, 'compression': compression.name if compression else None,
+                            'features': sorted(self.peer_features)})
+        else: # servers predating negotiation answer with an auto response
+            codec = negotiate_codec([payload.get('codec')])
+            compression = negotiate_compression([payload.get('compression')])
+            self.peer_features = self.features.intersection(payload.get('features') or ())
+        self.codec = codec
+        self.compression = compression(level=self.compress_level) if compression else None
+        self.log(INFO, 'negotiated codec={} compression={} features={}',
+                 codec.name, compression.name if compression else None, sorted(self.peer_features))
+        self.negotiated()
+
+    def negotiated(self):
         pass
 
-    def dataReceived(self, data):
-        if self.__stage == 0:
-            self.__pack = b''
-            self.__received = 0
-            number, = struct.unpack('>I', data[:4])
-            if number != TRANSPORT_MAGIC_NUMBER: return
-            self.__size, = struct.unpack('>I', data[4:8])
-            self.__stage = 1
-        self.__received += len(data)
-        self.__pack += data
-        if self.__stage == 1:
-            if self.__received >= self.__size:
-                self.__stage = 2
-        if self.__stage == 2:
-            self.packReceived(self.__pack[8:self.__size])
-            self.__stage = 0
-            if self.__received > self.__size:
-                self.dataReceived(data=self.__pack[self.__size:])
+    def frameReceived(self, flags, data): # type: (int, memoryview)->None
+        self.frames_received += 1
+        METRICS.observe('frame_bytes', len(data) + FRAME_HEADER_SIZE, label='in')
+        if flags & FRAME_FLAG_CHUNK:
+            if len(data) < CHUNK_HEADER.size or not self.transfers:
+                self.frameError('unexpected artifact chunk')
+                return
+            transfer, offset, crc = CHUNK_HEADER.unpack_from(data)
+            self.transfers.chunk_received(transfer, offset, crc, data[CHUNK_HEADER.size:])
+            return
+        codec = JSONCodec
+        if flags & FRAME_FLAG_BINARY:
+            codec = find_codec(MessagePackCodec.name)
+            if not codec:
+                self.frameError('unsupported binary codec')
+                return
+        if flags & FRAME_FLAG_COMPRESSED:
+            try:
+                data = ZlibCompression.decompress(data, self.max_frame_size)
+            except (ValueError, zlib.error) as error:
+                self.frameError('bad compressed frame: {}'.format(error))
+                return
+        msg = codec.decode(data) # type: dict
+        command = msg.get('command')
+        METRICS.inc('frames_received', label=Commands.name(command))
+        if command in (Commands.NEGOTIATE_REQ, Commands.NEGOTIATE_RSP):
+            self.__negotiate(command, msg.get('data'))
+            return
+        self.packReceived(msg)
+
+    def packReceived(self, msg): # type: (dict)->None
+        pass
 
+    def frameError(self, reason):
+        self.log(WARNING, 'frame error: {}', reason)
+        self.__corrupted = True
+        self.__buffer = bytearray()
+        if self.transport: self.transport.loseConnection()
+
+    def __decode_frames(self, view): # type: (memoryview)->int
+        offset, length = 0, len(view)
+        while length - offset >= FRAME_HEADER_SIZE:
+            number, size = FRAME_HEADER.unpack_from(view, offset)
+            if number & ~FRAME_FLAG_MASK != TRANSPORT_MAGIC_NUMBER:
+                self.frameError('bad magic number 0x{:08x}'.format(number))
+                return length
+            if size < FRAME_HEADER_SIZE or size > self.max_frame_size:
+                self.frameError('bad frame size {} limit={}'.format(size, self.max_frame_size))
+                return length
+            if length - offset < size: break
+            pack = view[offset + FRAME_HEADER_SIZE:offset + size]
+            try:
+                self.frameReceived(number & FRAME_FLAG_MASK, pack)
+            finally:
+                pack.release()
+            offset += size
+            if self.__corrupted: return length
+        return offset
+
+    def dataReceived(self, data):
+        if self.__corrupted: return
+        self.bytes_received += len(data)
+        METRICS.inc('bytes_received', value=len(data))
+        if not self.__buffer:
+            # fast path: decode frames straight out of the chunk and only buffer the tail
+            with memoryview(data) as view:
+                offset = self.__decode_frames(view)
+                if not self.__corrupted and offset < len(view):
+                    self.__buffer += view[offset:]
+            return
+        self.__buffer += data
+        with memoryview(self.__buffer) as view:
+            offset = self.__decode_frames(view)
+        if self.__corrupted or not offset: return
+        try:
+            del self.__buffer[:offset]
+        except BufferError: # a view of the buffer escaped from frameReceived
+            self.__buffer = bytearray(self.__buffer[offset:])
 
     def acknowledge(self, command, data='success'):
         self.send(command=Commands.ACKNOWLEDGE, data=':{} {}'.format(command, data))
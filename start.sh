@@ -19,7 +19,7 @@ rsync -av --exclude='/.*' --exclude='/__*' ./ ${SCRIPT_INSTALL_PATH}
 cp -fv plist/${DAEMON_IDENTIFIER}.plist ${CONFIG_INSTALL_PATH}
 sed -i '' "s/~/\/Users\/$(whoami)/g" ${CONFIG_INSTALL_PATH}
 
-cat ${CONFIG_INSTALL_PATH} | grep log \
+cat ${CONFIG_INSTALL_PATH} | grep '\.log<' \
 | awk -F'>' '{print $2}' \
 | awk -F'<' '{print $1}' | xargs -I{} dirname {} \
 | xargs -I{} mkdir -pv {}
@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+import json, os, time
+from logger import LOG
+
+__author__ = 'larryhou'
+
+STATE_VERSION = 1
+
+class QueenState(object):
+    # slaves the queen was serving when it last wrote this, their inventory lives in the InventoryStore by digest
+    def __init__(self, filename=None):
+        self.filename = filename # type: str
+        self.dirty = False
+        self.saved = None # type: float
+        self.__slaves = {} # type: dict[str, dict]
+
+    def __len__(self):
+        return len(self.__slaves)
+
+    def load(self):
+        if not self.filename or not os.path.exists(self.filename): return self
+        try:
+            with open(self.filename, 'r', encoding='utf-8') as fp:
+                state = json.load(fp)
+            if state.get('version') != STATE_VERSION: raise ValueError('version {}'.format(state.get('version')))
+            self.saved = state.get('saved')
+            self.__slaves = state.get('slaves') or {}
+        except (IOError, ValueError, AttributeError) as error:
+            LOG.warning('-- state load failed {} {}', self.filename, error)
+        return self
+
+    def save(self):
+        if not self.filename or not self.dirty: return
+        directory = os.path.dirname(self.filename)
+        if directory and not os.path.exists(directory): os.makedirs(directory)
+        self.saved = time.time()
+        temp = self.filename + '.tmp'
+        with open(temp, 'w', encoding='utf-8') as fp:
+            json.dump({'version': STATE_VERSION, 'saved': self.saved, 'slaves': self.__slaves}, fp, ensure_ascii=False)
+        os.replace(temp, self.filename)
+        self.dirty = False
+
+    def get(self, machine): # type: (str)->dict
+        return self.__slaves.get(machine)
+
+    def put(self, machine, record): # type: (str, dict)->None
+        if self.__slaves.get(machine) == record: return
+        self.__slaves[machine] = record
+        self.dirty = True
+
+    def disconnect(self, machine): # type: (str)->None
+        record = self.__slaves.get(machine)
+        if not record or not record.get('connected'): return
+        record.update(connected=False, seen=time.time())
+        self.dirty = True
+
+    def connected(self): # type: ()->dict[str, dict]
+        return {k: v for k, v in self.__slaves.items() if v.get('connected')}
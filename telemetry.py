@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+import array, collections, math
+
+__author__ = 'larryhou'
+
+TELEMETRY_FIELDS = ('cpu', 'mem', 'load')
+# (bucket resolution in seconds, buckets kept): 1s for an hour, 1m for a day, 1h for a month
+TELEMETRY_TIERS = ((1, 3600), (60, 1440), (3600, 720))
+TELEMETRY_PERCENTILES = (50, 95, 99)
+
+def percentile(values, p): # type: (list[float], float)->float
+    if not values: return None
+    rank = int(math.ceil(p / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+class RingBuffer(object):
+    def __init__(self, capacity, width):
+        self.capacity = capacity
+        self.width = width
+        self.timestamps = array.array('d', bytes(8 * capacity))
+        self.values = array.array('f', bytes(4 * capacity * width))
+        self.head = 0
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def append(self, ts, row): # type: (float, list[float])->None
+        slot = self.head
+        self.timestamps[slot] = ts
+        offset = slot * self.width
+        self.values[offset:offset + self.width] = array.array('f', row)
+        self.head = (slot + 1) % self.capacity
+        if self.count < self.capacity: self.count += 1
+
+    def __slot(self, n):
+        return (self.head - self.count + n) % self.capacity
+
+    def __search(self, ts): # first logical index with a timestamp >= ts
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) >> 1
+            if self.timestamps[self.__slot(mid)] < ts: lo = mid + 1
+            else: hi = mid
+        return lo
+
+    def rows(self, start, end): # type: (float, float)->iter
+        for n in range(self.__search(start), self.count):
+            slot = self.__slot(n)
+            ts = self.timestamps[slot]
+            if ts >= end: break
+            offset = slot * self.width
+            yield ts, self.values[offset:offset + self.width]
+
+class Tier(object):
+    def __init__(self, resolution, capacity, width):
+        self.resolution = resolution
+        self.width = width
+        # each bucket keeps the average and the peak of every field
+        self.buffer = RingBuffer(capacity, width=width * 2)
+        self.__bucket = None # type: float
+        self.__count = 0
+        self.__sum = [0.0] * width
+        self.__max = [0.0] * width
+
+    @property
+    def retention(self):
+        return self.resolution * self.buffer.capacity
+
+    def __row(self):
+        row = []
+        for n in range(self.width):
+            row.append(self.__sum[n] / self.__count)
+            row.append(self.__max[n])
+        return row
+
+    def add(self, ts, values): # type: (float, list[float])->bool
+        bucket = ts - ts % self.resolution
+        if bucket != self.__bucket:
+            if self.__bucket is not None:
+                if bucket < self.__bucket: return False # late sample for a closed bucket
+                self.buffer.append(self.__bucket, self.__row())
+            self.__bucket, self.__count = bucket, 0
+            self.__sum = [0.0] * self.width
+            self.__max = [-math.inf] * self.width
+        self.__count += 1
+        for n, value in enumerate(values):
+            self.__sum[n] += value
+            if value > self.__max[n]: self.__max[n] = value
+        return True
+
+    def rows(self, start, end): # type: (float, float)->iter
+        for row in self.buffer.rows(start, end): yield row
+        if self.__count and start <= self.__bucket < end:
+            yield self.__bucket, self.__row()
+
+class Series(object):
+    def __init__(self, fields=TELEMETRY_FIELDS, tiers=TELEMETRY_TIERS):
+        self.fields = tuple(fields)
+        self.tiers = [Tier(resolution, capacity, len(self.fields)) for resolution, capacity in tiers]
+        self.updated = 0.0
+
+    def add(self, ts, values): # type: (float, list[float])->None
+        for tier in self.tiers: tier.add(ts, values)
+        self.updated = max(self.updated, ts)
+
+    def tier(self, start, now, resolution=None): # type: (float, float, float)->Tier
+        for tier in self.tiers:
+            if resolution and tier.resolution >= float(resolution): return tier
+            if not resolution and now - start <= tier.retention: return tier
+        return self.tiers[-1]
+
+class TelemetryStore(object):
+    def __init__(self, fields=TELEMETRY_FIELDS, tiers=TELEMETRY_TIERS, max_series=1024):
+        self.fields = tuple(fields)
+        self.tiers = tiers
+        self.max_series = max_series
+        self.evictions = 0
+        self.__series = collections.OrderedDict() # type: dict[str, Series]
+
+    def __len__(self):
+        return len(self.__series)
+
+    def __contains__(self, key):
+        return key in self.__series
+
+    def put(self, key, fields, samples): # type: (str, list[str], list[list[float]])->int
+        series = self.__series.get(key)
+        if series is None:
+            series = self.__series[key] = Series(self.fields, self.tiers)
+            # memory is bounded by the series count, machines gone the longest make room first
+            while len(self.__series) > self.max_series:
+                self.__series.popitem(last=False)
+                self.evictions += 1
+        self.__series.move_to_end(key)
+        columns = [fields.index(x) + 1 if x in fields else None for x in self.fields]
+        count = 0
+        for sample in samples:
+            if not sample: continue
+            series.add(float(sample[0]), [float(sample[n] or 0) if n else 0.0 for n in columns])
+            count += 1
+        return count
+
+    def query(self, metric, start, end, keys=None, resolution=None, series=False): # type: (str, float, float, list, float, bool)->dict
+        if metric not in self.fields: raise ValueError('unknown metric {!r}, expect one of {}'.format(metric, ', '.join(self.fields)))
+        column = self.fields.index(metric) * 2
+        averages, peak, tiers, found = [], None, set(), 0
+        result = {'metric': metric, 'start': start, 'end': end}
+        detail = {} if series else None
+        if series: result['series'] = detail
+        for key in (self.__series.keys() if keys is None else keys):
+            item = self.__series.get(key)
+            if item is None: continue
+            found += 1
+            tier = item.tier(start, end, resolution)
+            tiers.add(tier.resolution)
+            points = []
+            for ts, row in tier.rows(start, end):
+                averages.append(row[column])
+                if peak is None or row[column + 1] > peak: peak = row[column + 1]
+                if detail is not None: points.append([ts, round(row[column], 3), round(row[column + 1], 3)])
+            if detail is not None: detail[key] = points
+        averages.sort()
+        result['slaves'] = found
+        result['resolution'] = sorted(tiers)
+        aggregates = result['aggregates'] = {'count': len(averages), 'max': peak}
+        if averages:
+            aggregates.update(avg=sum(averages) / len(averages), min=averages[0])
+            for p in TELEMETRY_PERCENTILES: aggregates['p{}'.format(p)] = percentile(averages, p)
+        return result
@@ -0,0 +1,9 @@
+import os, sys
+
+# the modules live flat at the top of the repository
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+def pytest_sessionfinish(session, exitstatus):
+    # the writer thread holds on to the captured stdout, flush it before pytest closes that
+    from logger import LOG
+    LOG.close()
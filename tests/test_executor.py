@@ -0,0 +1,105 @@
+import os, sys, signal, subprocess
+from twisted.internet import defer, reactor, task
+from twisted.trial import unittest
+from executor import SESSION_LAUNCHER, kill_process_group, run_streaming_command
+
+# stands in for a profiler or command that hangs, it shrugs off SIGTERM once it says it is ready
+SLOW_COMMAND = '''import signal, sys, time
+if sys.argv[1:] == ['stubborn']: signal.signal(signal.SIGTERM, signal.SIG_IGN)
+print('ready', flush=True)
+time.sleep(60)
+'''
+
+class FakeProcess(object):
+    def __init__(self, popen): # type: (subprocess.Popen)->None
+        self.popen = popen
+        self.pid = popen.pid
+        self.resumed = False
+
+    def resumeProducing(self):
+        self.resumed = True
+
+    def wait(self):
+        status = self.popen.wait(timeout=10)
+        self.pid = None # reaped, the way the reactor leaves it
+        return status
+
+def launch(*args): # type: (str)->FakeProcess
+    popen = subprocess.Popen([sys.executable, '-c', SESSION_LAUNCHER, sys.executable, '-c', SLOW_COMMAND] + list(args),
+                             stdout=subprocess.PIPE)
+    assert popen.stdout.readline() == b'ready\n'
+    return FakeProcess(popen)
+
+def test_kill_before_setsid():
+    # no process group of its own yet, the signal goes to the process
+    process = FakeProcess(subprocess.Popen([sys.executable, '-c', SLOW_COMMAND]))
+    clock = task.Clock()
+    kill_process_group(process, grace=1.0, clock=clock)
+    assert process.wait() == -signal.SIGTERM
+    assert process.resumed
+    clock.advance(1.0)
+
+def test_kill_group():
+    process = launch()
+    clock = task.Clock()
+    kill_process_group(process, grace=1.0, clock=clock)
+    assert process.wait() == -signal.SIGTERM
+
+def test_kill_after_grace():
+    process = launch('stubborn')
+    clock = task.Clock()
+    kill_process_group(process, grace=1.0, clock=clock)
+    assert len(clock.getDelayedCalls()) == 1
+    clock.advance(1.0)
+    assert process.wait() == -signal.SIGKILL
+
+def test_kill_ended():
+    process = launch()
+    process.popen.kill()
+    process.wait()
+    clock = task.Clock()
+    kill_process_group(process, clock=clock)
+    assert not clock.getDelayedCalls()
+
+class CommandTest(unittest.TestCase):
+    timeout = 20
+
+    @defer.inlineCallbacks
+    def wait_reaped(self, process):
+        while process.pid: yield task.deferLater(reactor, 0.05, lambda: None)
+
+    @defer.inlineCallbacks
+    def test_cancel_right_away(self):
+        # cancelled before the launcher has had a chance to call setsid
+        clock = task.Clock()
+        deferred, process = run_streaming_command([sys.executable, '-c', SLOW_COMMAND], lambda *_: None, kill_grace=1.0, clock=clock)
+        deferred.cancel()
+        yield self.assertFailure(deferred, defer.CancelledError)
+        yield self.wait_reaped(process)
+        self.assertEqual(process.status, signal.SIGTERM)
+        clock.advance(1.0)
+
+    @defer.inlineCallbacks
+    def test_cancel_stubborn(self):
+        ready = defer.Deferred()
+        def receive(stream, data):
+            if not ready.called and b'ready' in data: ready.callback(None)
+        clock = task.Clock()
+        deferred, process = run_streaming_command([sys.executable, '-c', SLOW_COMMAND, 'stubborn'], receive, kill_grace=1.0, clock=clock)
+        yield ready
+        deferred.cancel()
+        yield self.assertFailure(deferred, defer.CancelledError)
+        clock.advance(1.0)
+        yield self.wait_reaped(process)
+        self.assertEqual(process.status, signal.SIGKILL)
+
+    @defer.inlineCallbacks
+    def test_timeout(self):
+        # the way a mission times out, the timeout cancels the command
+        clock = task.Clock()
+        deferred, process = run_streaming_command([sys.executable, '-c', SLOW_COMMAND], lambda *_: None, kill_grace=1.0, clock=clock)
+        deferred.addTimeout(0.2, reactor)
+        yield self.assertFailure(deferred, defer.TimeoutError)
+        yield self.wait_reaped(process)
+        self.assertEqual(process.status, signal.SIGTERM)
+        clock.advance(1.0)
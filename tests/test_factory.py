@@ -0,0 +1,37 @@
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from admission import AdmissionControl
+from server import ClientConnectionFactory
+
+def test_clock_reaches_cache_and_admission():
+    factory = ClientConnectionFactory()
+    factory.admission = AdmissionControl(clock=factory.clock, rate=1.0, burst=1, max_handshakes=0, timeout=0)
+    clock = factory.clock = task.Clock()
+    addr = IPv4Address('TCP', '127.0.0.1', 1)
+    factory.results.put(1, addr, {'n': 1})
+    clock.advance(10.0)
+    assert factory.results.get(1, addr, max_staleness=20.0)['age'] == 10.0
+    assert factory.results.get(1, addr, max_staleness=5.0) is None
+    assert factory.admission.admit('a') == 0
+    assert factory.admission.admit('b') > 0
+    # the bucket refills by the fake clock only
+    clock.advance(1.0)
+    assert factory.admission.admit('b') == 0
+
+def test_disconnect_is_saved(tmpdir):
+    from state import QueenState
+    from server import ClientConnection
+    factory = ClientConnectionFactory()
+    clock = factory.clock = task.Clock()
+    factory.state = QueenState(str(tmpdir.join('state.json')))
+    factory.state.put('mac-1', {'connected': True, 'address': '127.0.0.1'})
+    factory.flush_state()
+    client = ClientConnection(factory, IPv4Address('TCP', '127.0.0.1', 1))
+    client.connectionMade()
+    client.is_slave, client.machine = True, 'mac-1'
+    factory.slave_count += 1
+    client.connectionLost()
+    assert QueenState(factory.state.filename).load().get('mac-1')['connected']
+    # written once the debounce runs out
+    clock.advance(factory.state_save_delay)
+    assert not QueenState(factory.state.filename).load().get('mac-1')['connected']
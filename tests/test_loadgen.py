@@ -0,0 +1,52 @@
+import argparse
+from twisted.internet import defer, task
+from twisted.trial import unittest
+import loadgen
+
+def options(**kwargs):
+    values = dict(slaves=12, requesters=2, rounds=2, scenarios=list(loadgen.SCENARIOS), timeout=20, port=0, relays=0,
+                  in_process=True, queen_args=[], output=None)
+    values.update(kwargs)
+    return argparse.Namespace(**values)
+
+class InProcessFleetTest(unittest.TestCase):
+    timeout = 60
+
+    @defer.inlineCallbacks
+    def start(self, **kwargs):
+        self.clock = task.Clock()
+        self.harness = loadgen.FleetHarness(options(**kwargs), clock=self.clock)
+        self.harness.start_queen()
+        yield self.harness.connect()
+
+    @defer.inlineCallbacks
+    def tearDown(self):
+        for factory in self.harness.factories: factory.stopTrying()
+        for slave in self.harness.slaves: slave.transport.loseConnection()
+        for requester in self.harness.requesters: requester.transport.loseConnection()
+        yield self.harness.stop_queen()
+        yield task.deferLater(loadgen.reactor, 0.1, lambda: None) # let the closed connections be reaped
+
+    @defer.inlineCallbacks
+    def test_scenarios(self):
+        yield self.start()
+        for name in loadgen.SCENARIOS:
+            report = yield self.harness.run(name)
+            self.assertNotIn('error', report, name)
+            self.assertTrue(report['in_process'])
+        self.assertEqual(self.harness.queen.factory.slave_count, 12)
+
+    @defer.inlineCallbacks
+    def test_relays(self):
+        yield self.start(relays=2)
+        report = yield self.harness.run('stats')
+        self.assertEqual(report['artifacts'], 12 * 2 * 2)
+
+    @defer.inlineCallbacks
+    def test_queen_clock(self):
+        yield self.start()
+        factory = self.harness.queen.factory
+        self.assertEqual(len(factory.select(None)), 12)
+        # the queen keeps time by the test clock, its slaves go quiet only when that clock says so
+        self.clock.advance(factory.suspect_after)
+        self.assertEqual(factory.select(None), [])
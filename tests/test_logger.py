@@ -0,0 +1,42 @@
+from logger import AsyncLogger, INFO, DEBUG, WARNING
+
+class MemoryWriter(object):
+    def __init__(self):
+        self.lines = [] # type: list[str]
+
+    def write(self, line):
+        self.lines.append(line)
+
+    def flush(self): pass
+    def close(self): pass
+
+def test_fields_are_snapshot_by_the_caller():
+    logger = AsyncLogger(level=INFO, max_field=64)
+    logger.writer = writer = MemoryWriter()
+    frame = {'command': 1, 'data': {'items': list(range(3))}}
+    logger.log(INFO, 'frame', frame=frame)
+    # the reactor keeps using the payload once it has been logged
+    frame['data']['items'].extend(range(100))
+    frame['data']['extra'] = 'x' * 1000
+    logger.log(DEBUG, 'dropped by level', frame=frame)
+    logger.close()
+    assert len(writer.lines) == 1
+    assert writer.lines[0].endswith(' INFO frame frame={"command": 1, "data": {"items": [0, 1, 2]}}\n')
+
+def test_large_fields_are_truncated():
+    logger = AsyncLogger(level=INFO, max_field=16)
+    logger.writer = writer = MemoryWriter()
+    logger.log(INFO, 'frame', frame={'data': 'x' * 100})
+    logger.close()
+    assert writer.lines[0].endswith(' frame={"data": "xxxxxx...<truncated>\n')
+
+def test_quiet_connection_keeps_warnings(monkeypatch):
+    from twisted.internet.address import IPv4Address
+    from shared import TCP, LOG
+    lines = []
+    monkeypatch.setattr(LOG, 'log', lambda level, message, *args, **fields: lines.append(level))
+    connection = TCP(IPv4Address('TCP', '127.0.0.1', 1), verbose=False)
+    connection.log(INFO, 'chatter')
+    connection.log_frame('<<<', {'command': 1})
+    connection.log(WARNING, 'slave dead')
+    assert lines == [WARNING]
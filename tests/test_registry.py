@@ -0,0 +1,71 @@
+import json, os
+import pytest
+from registry import parse_value, Selector, SlaveRegistry
+
+FIXTURES = os.path.join(os.path.dirname(__file__), 'fixtures')
+
+def hardware():
+    with open(os.path.join(FIXTURES, 'SPHardwareDataType.json'), 'r', encoding='utf-8') as fp:
+        return json.load(fp)
+
+@pytest.mark.parametrize('text,value', [
+    ('2.3', (2, 3)),
+    ('2.3 GHz', (2, 3)),
+    ('3.2GHz', (3, 2)),
+    ('12.6.1', (12, 6, 1)),
+    ('8', 8.0),
+    ('8 cores', 8.0),
+    ('32 GB', 32.0),
+    ('512mb', 0.5),
+    ('MacBookPro16,1', 'macbookpro16,1'),
+])
+def test_parse_value(text, value):
+    assert parse_value(text) == value
+
+@pytest.fixture
+def registry():
+    registry = SlaveRegistry()
+    registry.update('intel', {'SPHardwareDataType': hardware(), 'osversion': '12.6.1', 'tags': ['ios']})
+    silicon = hardware()
+    silicon['Hardware']['HardwareOverview'].update(ProcessorSpeed='3.2GHz', Memory='16 GB', TotalNumberofCores='10')
+    registry.update('silicon', {'SPHardwareDataType': silicon, 'osversion': '13', 'tags': ['android']})
+    return registry
+
+@pytest.mark.parametrize('text,expected', [
+    ('os >= 12', ['intel', 'silicon']),
+    ('os > 12', ['intel', 'silicon']),
+    ('os >= 12.7', ['silicon']),
+    ('os < 13', ['intel']),
+    ('os = 13.0', ['silicon']),
+    ('os = 12', []),
+    ('os != 13', ['intel']),
+    ('processorspeed >= 2.5 GHz', ['silicon']),
+    ('processorspeed >= 2.3GHz', ['intel', 'silicon']),
+    ('processorspeed = 2.3', ['intel']),
+    ('processorspeed < 3', ['intel']),
+    ('mem >= 32gb', ['intel']),
+    ('mem > 8', ['intel', 'silicon']),
+    ('cores >= 10', ['silicon']),
+    ('cores = 8.0', ['intel']),
+    ('tag = ios and os >= 12', ['intel']),
+])
+def test_select(registry, text, expected):
+    assert sorted(registry.select(Selector(text))) == expected
+
+def test_lookup(registry):
+    assert registry.lookup('os', '13.0.0') == {'silicon'}
+    assert registry.lookup('cores', '8') == {'intel'}
+    registry.remove('silicon')
+    assert registry.lookup('os', '13') == set()
+
+@pytest.mark.parametrize('text,limited', [
+    ('any 5 slaves', 'any 2 slaves'),
+    ('any 5 os >= 12 and tag = ios', 'any 2 os >= 12 and tag = ios'),
+    ('cores >= 8', 'any 2 cores >= 8'),
+])
+def test_limited(text, limited):
+    assert Selector(text).limited(2) == limited
+    assert Selector(limited).limit == 2
+
+def test_select_exclude(registry):
+    assert registry.select(Selector('any 1 os >= 12'), exclude={'intel'}) == ['silicon']
@@ -0,0 +1,123 @@
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from shared import Commands
+from server import JobQueueScheduler, CollaborateScheduler, ResultCache
+
+class FakeSlave(object):
+    def __init__(self, port):
+        self.address = IPv4Address('TCP', '127.0.0.1', port)
+        self.uuid = port
+        self.relay = False
+        self.load = None
+        self.tasks = [] # type: list[int]
+        self.sent = [] # type: list[tuple]
+
+    def dispatch_collaborate_mission(self, parameters):
+        self.tasks.append(parameters.get('task'))
+
+    def send(self, command, data=None, **_):
+        self.sent.append((command, data))
+
+    frame_format = None
+
+    def encode_frame(self, request):
+        return request
+
+    def write_frame(self, frame, command):
+        self.send(command, frame.get('data'))
+
+class FakeFactory(object):
+    def __init__(self, slaves):
+        self.clock = task.Clock()
+        self.clients = {x.address: x for x in slaves}
+        self.results = ResultCache(clock=self.clock)
+        self.released = []
+
+    def select(self, selector):
+        return [x for x in self.clients.values() if x.address.port < 100]
+
+    def busy_slaves(self):
+        return set()
+
+    def release(self, collaborate):
+        self.released.append(collaborate)
+
+def complete(scheduler, slave, index):
+    scheduler.receive(slave.address, {'data': {'task': index}})
+
+def test_idle_slave_steals_without_events():
+    fast, slow = FakeSlave(1), FakeSlave(2)
+    factory = FakeFactory([fast, slow])
+    scheduler = JobQueueScheduler(factory, mission=1, round=7)
+    results = []
+    scheduler.add_listener(lambda items, summary, retcode: results.append(summary))
+    scheduler.dispatch_missions(sender=None, parameters={'tasks': [{}, {}], 'steal_after': 2.0})
+    assert fast.tasks == [0] and slow.tasks == [1]
+    factory.clock.advance(0.5)
+    complete(scheduler, fast, 0)
+    # nothing else arrives, the idle slave picks up the slow task once it is due
+    factory.clock.advance(1.0)
+    assert fast.tasks == [0]
+    factory.clock.advance(0.5)
+    assert fast.tasks == [0, 1]
+    complete(scheduler, fast, 1)
+    assert slow.sent == [(Commands.COLLABORATE_CANCEL_NOTIFY, {'round': 7, 'task': 1})]
+    assert results and results[0]['completed'] == 2
+    # the original finishing late is ignored
+    complete(scheduler, slow, 1)
+    assert len(results) == 1
+    assert not factory.clock.getDelayedCalls()
+
+def test_no_steal_from_itself():
+    only = FakeSlave(1)
+    factory = FakeFactory([only])
+    scheduler = JobQueueScheduler(factory, mission=1)
+    scheduler.dispatch_missions(sender=None, parameters={'tasks': [{}], 'steal_after': 1.0, 'slots_per_slave': 2})
+    assert only.tasks == [0]
+    assert not factory.clock.getDelayedCalls()
+    factory.clock.advance(5.0)
+    assert only.tasks == [0]
+
+def test_late_observers_get_earlier_artifacts():
+    first, second = FakeSlave(1), FakeSlave(2)
+    streaming, polling, watching = FakeSlave(101), FakeSlave(102), FakeSlave(103)
+    factory = FakeFactory([first, second, streaming, polling, watching])
+    scheduler = CollaborateScheduler(factory, mission=1)
+    scheduler.dispatch_missions(sender=streaming.address, parameters={'stream': True})
+    scheduler.receive(first.address, {'data': {'n': 1}})
+    scheduler.dispatch_missions(sender=polling.address, parameters={})
+    scheduler.dispatch_missions(sender=watching.address, parameters={'stream': True})
+    assert [x[1]['n'] for x in watching.sent if x[0] == Commands.COLLABORATE_ARTIFACT_NOTIFY] == [1]
+    scheduler.receive(second.address, {'data': {'n': 2}})
+    notify = [x[1] for x in polling.sent if x[0] == Commands.COLLABORATE_NOTIFY]
+    assert [x['n'] for x in notify[0]] == [1, 2]
+    assert [x[1]['n'] for x in watching.sent if x[0] == Commands.COLLABORATE_ARTIFACT_NOTIFY] == [1, 2]
+
+def loaded(port, cpu):
+    slave = FakeSlave(port)
+    slave.load = {'cpu': cpu, 'mem': 10.0}
+    return slave
+
+def test_saturated_slave_left_out():
+    idle, busy, saturated = loaded(1, 10.0), loaded(2, 60.0), loaded(3, 95.0)
+    factory = FakeFactory([saturated, busy, idle])
+    scheduler = JobQueueScheduler(factory, mission=1)
+    scheduler.dispatch_missions(sender=None, parameters={'tasks': [{}, {}, {}]})
+    # one slot each, the least loaded slave gets first pick and the saturated one nothing
+    assert (idle.tasks, busy.tasks, saturated.tasks) == ([0], [1], [])
+    complete(scheduler, idle, 0)
+    assert idle.tasks == [0, 2] and not saturated.tasks
+
+def test_slots_follow_load():
+    idle, busy = loaded(1, 0.0), loaded(2, 50.0)
+    factory = FakeFactory([busy, idle])
+    scheduler = JobQueueScheduler(factory, mission=1)
+    scheduler.dispatch_missions(sender=None, parameters={'tasks': [{}] * 8, 'slots_per_slave': 4})
+    assert (len(idle.tasks), len(busy.tasks)) == (4, 2)
+
+def test_all_saturated_still_run():
+    first, second = loaded(1, 95.0), loaded(2, 99.0)
+    factory = FakeFactory([first, second])
+    scheduler = JobQueueScheduler(factory, mission=1)
+    scheduler.dispatch_missions(sender=None, parameters={'tasks': [{}, {}]})
+    assert (first.tasks, second.tasks) == ([0], [1])
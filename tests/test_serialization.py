@@ -0,0 +1,68 @@
+import os, io, gzip, json, glob
+import pytest
+from serialization import decode_system_information, iterate_system_information
+
+__author__ = 'larryhou'
+
+# system_profiler text and what the original readlines() decoder made of it, the streaming decoder has to agree
+FIXTURES = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures')
+NAMES = sorted(os.path.basename(x)[:-4] for x in glob.glob(os.path.join(FIXTURES, '*.txt')))
+LARGE = sorted(os.path.basename(x)[:-7] for x in glob.glob(os.path.join(FIXTURES, '*.txt.gz')))
+
+def opener(path):
+    return gzip.open if path.endswith('.gz') else open
+
+def load_text(name): # type: (str)->str
+    path = os.path.join(FIXTURES, name + ('.txt.gz' if name in LARGE else '.txt'))
+    with opener(path)(path, 'rt', encoding='utf-8') as fp: return fp.read()
+
+def load_golden(name): # type: (str)->dict
+    path = os.path.join(FIXTURES, name + ('.json.gz' if name in LARGE else '.json'))
+    with opener(path)(path, 'rt', encoding='utf-8') as fp: return json.load(fp)
+
+def combined(): # type: ()->tuple[str, dict]
+    # several sections in one run, the way system_profiler prints them
+    text, expect = '', {}
+    for name in NAMES:
+        text += load_text(name)
+        expect.update(load_golden(name))
+    return text, expect
+
+@pytest.mark.parametrize('name', NAMES + LARGE)
+def test_golden(name):
+    text, expect = load_text(name), load_golden(name)
+    assert decode_system_information(text) == expect
+    assert decode_system_information(text.encode('utf-8')) == expect
+    assert decode_system_information(io.StringIO(text)) == expect
+
+@pytest.mark.parametrize('name', LARGE)
+def test_golden_from_pipe(name):
+    # bytes lines straight off a binary stream, as spawnProcess output or an open pipe would give them
+    path = os.path.join(FIXTURES, name + '.txt.gz')
+    with gzip.open(path, 'rb') as fp:
+        assert decode_system_information(fp) == load_golden(name)
+
+@pytest.mark.parametrize('name', NAMES + LARGE)
+def test_golden_section(name):
+    expect = load_golden(name)
+    section, = expect
+    assert decode_system_information(load_text(name), sections=[section]) == expect
+    assert decode_system_information(load_text(name), sections=['Nothing']) == {}
+
+def test_combined_sections():
+    text, expect = combined()
+    assert decode_system_information(text) == expect
+    assert [x for x, _ in iterate_system_information(io.StringIO(text))] == list(expect)
+    for section in expect:
+        assert decode_system_information(io.StringIO(text), sections=[section]) == {section: expect[section]}
+    wanted = ['Storage', 'Graphics/Displays']
+    assert decode_system_information(text, sections=wanted) == {x: expect[x] for x in wanted}
+    # names are matched the way keys are built, without spaces
+    assert decode_system_information(text, sections=['Graphics / Displays']) == {'Graphics/Displays': expect['Graphics/Displays']}
+
+def test_combined_large_sections():
+    usb, storage = load_text('SPUSBDataType-large'), load_text('SPStorageDataType-large')
+    text = storage + load_text('SPHardwareDataType') + usb
+    assert decode_system_information(io.StringIO(text), sections=['USB']) == load_golden('SPUSBDataType-large')
+    assert decode_system_information(io.StringIO(text), sections=['Storage', 'Hardware']) == \
+        dict(load_golden('SPStorageDataType-large'), **load_golden('SPHardwareDataType'))
@@ -0,0 +1,148 @@
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+from shared import Commands, CollaborateMissions, FEATURE_INVENTORY_DELTA, FRAME_HEADER, FRAME_HEADER_SIZE
+from codec import JSONCodec
+from server import ClientConnectionFactory
+import client_mission # imports client on the way, the other order trips over their cycle
+from client import ClientSlaveConnectionFactory
+
+def connect(factory, port, slave=False):
+    client = factory.buildProtocol(IPv4Address('TCP', '127.0.0.1', port))
+    client.makeConnection(StringTransport())
+    if slave:
+        client.is_slave = True
+        factory.slave_count += 1
+        factory.registry.update(client.address, {})
+    return client
+
+def fleet(slaves=2):
+    factory = ClientConnectionFactory()
+    factory.clock = task.Clock()
+    factory.verbose = False
+    return factory, [connect(factory, 1000 + n, slave=True) for n in range(slaves)]
+
+def collaborate(client, **data):
+    client.packReceived({'command': Commands.COLLABORATE_REQ, 'data': data})
+
+def test_commands_never_merge():
+    factory, _ = fleet()
+    first, second = connect(factory, 1), connect(factory, 2)
+    collaborate(first, mission=CollaborateMissions.RUN_COMMAND, command='make A')
+    collaborate(second, mission=CollaborateMissions.RUN_COMMAND, command='make A')
+    assert len(factory.collaborates()) == 2
+
+def complete(slaves, collaborate, **data):
+    for slave in slaves:
+        slave.packReceived({'command': Commands.COLLABORATE_COMPLETE_REQ, 'retcode': 0,
+                            'data': dict(data, mission=collaborate.mission, round=collaborate.round)})
+
+def test_commands_are_never_cached():
+    factory, slaves = fleet()
+    requester = connect(factory, 1)
+    collaborate(requester, mission=CollaborateMissions.RUN_COMMAND, command='echo FIRST')
+    complete(slaves, factory.collaborates()[0], exit_code=0, tail='FIRST\n')
+    assert not factory.collaborates()
+    collaborate(requester, mission=CollaborateMissions.RUN_COMMAND, command='echo THIRD', max_staleness=60)
+    assert len(factory.collaborates()[0].pending()) == 2
+
+def test_cache_key_follows_the_request():
+    factory, slaves = fleet()
+    requester = connect(factory, 1)
+    collaborate(requester, mission=CollaborateMissions.REPORT_SYSTEM_STATS, argument='a')
+    complete(slaves, factory.collaborates()[0], User='a')
+    collaborate(requester, mission=CollaborateMissions.REPORT_SYSTEM_STATS, argument='b', max_staleness=60)
+    assert len(factory.collaborates()[0].pending()) == 2
+    complete(slaves, factory.collaborates()[0], User='b')
+    collaborate(requester, mission=CollaborateMissions.REPORT_SYSTEM_STATS, argument='a', max_staleness=60)
+    assert not factory.collaborates() # served from the cache
+
+def test_merge_key_follows_the_request():
+    factory, _ = fleet()
+    first, second = connect(factory, 1), connect(factory, 2)
+    collaborate(first, mission=CollaborateMissions.REPORT_SYSTEM_STATS)
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS, stream=True)
+    assert len(factory.collaborates()) == 1
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS, argument='b')
+    assert len(factory.collaborates()) == 2
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS, refresh=True)
+    collaborate(first, mission=CollaborateMissions.REPORT_SYSTEM_STATS, refresh=True)
+    assert len(factory.collaborates()) == 4
+
+def test_late_join_keeps_the_timeout():
+    factory, _ = fleet()
+    first, second = connect(factory, 1), connect(factory, 2)
+    collaborate(first, mission=CollaborateMissions.REPORT_SYSTEM_STATS, mission_timeout=10)
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS, mission_timeout=1, timeout_allowed=False)
+    round = factory.collaborates()[0]
+    assert (round.mission_timeout, round.timeout_allowed) == (10, True)
+    factory.clock.advance(5)
+    assert round.running
+    factory.clock.advance(5)
+    assert not factory.collaborates()
+
+def test_late_join_after_lost_artifacts():
+    factory, slaves = fleet()
+    first, second = connect(factory, 1), connect(factory, 2)
+    collaborate(first, mission=CollaborateMissions.REPORT_SYSTEM_STATS, stream=True)
+    round = factory.collaborates()[0]
+    # a failed artifact is never cached and nobody buffers for a streaming round
+    slaves[0].packReceived({'command': Commands.COLLABORATE_COMPLETE_REQ, 'retcode': -1,
+                            'data': {'mission': round.mission, 'round': round.round}})
+    assert not round.joinable
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS)
+    assert len(factory.collaborates()) == 2
+
+def test_late_join_from_the_cache():
+    factory, slaves = fleet()
+    first, second = connect(factory, 1), connect(factory, 2)
+    collaborate(first, mission=CollaborateMissions.REPORT_SYSTEM_STATS, stream=True)
+    round = factory.collaborates()[0]
+    complete(slaves[:1], round, User='a')
+    collaborate(second, mission=CollaborateMissions.REPORT_SYSTEM_STATS)
+    assert factory.collaborates() == [round]
+    second.transport.clear()
+    complete(slaves[1:], round, User='b')
+    assert b'"User": "a"' in second.transport.value() and b'"User": "b"' in second.transport.value()
+
+def pump(source, target): # type: (TCP, TCP)->list[int]
+    data, commands = source.transport.value(), []
+    source.transport.clear()
+    offset = 0
+    while offset < len(data):
+        _, size = FRAME_HEADER.unpack_from(data, offset)
+        commands.append(JSONCodec.decode(memoryview(data)[offset + FRAME_HEADER_SIZE:offset + size])['command'])
+        offset += size
+    target.dataReceived(data)
+    return commands
+
+def test_requested_inventory_answered_in_kind():
+    factory, _ = fleet(slaves=0)
+    queen = connect(factory, 1000, slave=True)
+    slave = ClientSlaveConnectionFactory().buildProtocol(queen.address)
+    slave.transport = StringTransport()
+    slave.peer_features = {FEATURE_INVENTORY_DELTA}
+    slave.system_information = data = {'uname': 'Darwin mac-1 22.1.0', 'osversion': '13'}
+    # the queen asked, the digest and what follows it come back as the response
+    slave.offer_inventory(Commands.SYSTEM_INFORMATION_RSP, data)
+    assert pump(slave, queen) == [Commands.SYSTEM_INFORMATION_RSP]
+    assert pump(queen, slave) == [Commands.INVENTORY_DIGEST_RSP]
+    assert pump(slave, queen) == [Commands.SYSTEM_INFORMATION_RSP]
+    assert pump(queen, slave) == [Commands.ACKNOWLEDGE]
+    assert factory.inventory.get('mac-1')['data'] == data
+    slave.system_information = data = dict(data, osversion='13.1')
+    slave.offer_inventory(Commands.SYSTEM_INFORMATION_RSP, data)
+    pump(slave, queen)
+    pump(queen, slave)
+    assert pump(slave, queen) == [Commands.SYSTEM_INFORMATION_RSP]
+    assert factory.inventory.get('mac-1')['data'] == data and queen.ifconfig == data
+
+def test_profiler_cache_in_stats():
+    factory, slaves = fleet(slaves=1)
+    stats = {'hits': 3, 'misses': 1, 'evictions': 0, 'entries': 1, 'loading': 0}
+    slaves[0].packReceived({'command': Commands.HEARTBEAT_REQ, 'data': {'ts': 1.0, 'profiler_cache': stats}})
+    assert slaves[0].describe_traffic()['profiler_cache'] == stats
+    requester = connect(factory, 1)
+    requester.transport.clear()
+    requester.packReceived({'command': Commands.STATS_REQ, 'data': {'connections': True}})
+    assert b'"hits": 3' in requester.transport.value()
@@ -0,0 +1,175 @@
+from twisted.internet import task
+from twisted.internet.address import IPv4Address
+from twisted.internet.testing import StringTransport
+from shared import *
+
+class Peer(TCP):
+    def __init__(self):
+        super(Peer, self).__init__(IPv4Address('TCP', '127.0.0.1', 1), verbose=False)
+        self.received = [] # type: list[dict]
+        self.errors = [] # type: list[str]
+        self.makeConnection(StringTransport())
+
+    def packReceived(self, msg):
+        self.received.append(msg)
+
+    def frameError(self, reason):
+        self.errors.append(reason)
+        super(Peer, self).frameError(reason)
+
+def frame(command, data=None, flags=0):
+    payload = JSONCodec.encode(make_request(command, data))
+    return FRAME_HEADER.pack(TRANSPORT_MAGIC_NUMBER | flags, len(payload) + FRAME_HEADER_SIZE) + payload
+
+def commands(peer): # type: (Peer)->list[int]
+    return [x['command'] for x in peer.received]
+
+def test_frames_in_one_chunk():
+    peer = Peer()
+    peer.dataReceived(frame(1) + frame(2) + frame(3))
+    assert commands(peer) == [1, 2, 3]
+
+def test_frames_split_anywhere():
+    peer = Peer()
+    stream = frame(1, 'x' * 100) + frame(2) + frame(3, {'n': 3})
+    for n in range(len(stream)): peer.dataReceived(stream[n:n + 1])
+    assert commands(peer) == [1, 2, 3]
+    assert peer.received[0]['data'] == 'x' * 100 and peer.received[2]['data'] == {'n': 3}
+    assert not peer.errors
+
+def test_tail_kept_across_chunks():
+    peer = Peer()
+    stream = frame(1) + frame(2)
+    peer.dataReceived(stream[:len(stream) - 3])
+    assert commands(peer) == [1]
+    peer.dataReceived(stream[len(stream) - 3:] + frame(3)[:5])
+    peer.dataReceived(frame(3)[5:])
+    assert commands(peer) == [1, 2, 3]
+
+def test_bits_outside_the_flags_are_bad_magic():
+    peer = Peer()
+    peer.dataReceived(frame(1, flags=0x80) + frame(2))
+    assert peer.errors and peer.errors[0].startswith('bad magic number')
+    assert not peer.received and peer.transport.disconnecting
+    peer.dataReceived(frame(3)) # nothing is decoded past a corrupted frame
+    assert not peer.received
+
+def test_frame_size_limit():
+    peer = Peer()
+    peer.max_frame_size = 64
+    peer.dataReceived(frame(1, 'x' * 100))
+    assert peer.errors and peer.errors[0].startswith('bad frame size')
+    peer = Peer()
+    peer.dataReceived(FRAME_HEADER.pack(TRANSPORT_MAGIC_NUMBER, FRAME_HEADER_SIZE - 1))
+    assert peer.errors
+
+def test_chunk_flag_without_transfers():
+    peer = Peer()
+    peer.dataReceived(TCP.encode_chunk(1, 0, 0, b'data'))
+    assert peer.errors == ['unexpected artifact chunk']
+
+def pump(source, target): # type: (Peer, Peer)->None
+    data = source.transport.value()
+    source.transport.clear()
+    target.dataReceived(data)
+
+def test_negotiate_codec():
+    client, server = Peer(), Peer()
+    client.features = server.features = {FEATURE_INVENTORY_DELTA}
+    client.negotiate()
+    pump(client, server)
+    pump(server, client)
+    assert client.codec is server.codec is CODECS[0]
+    assert client.peer_features == server.peer_features == {FEATURE_INVENTORY_DELTA}
+    server.send(7, {'n': 7})
+    assert server.transport.value()[3] & FRAME_FLAG_BINARY == int(CODECS[0].binary)
+    pump(server, client)
+    assert [(x['command'], x['data']) for x in client.received] == [(7, {'n': 7})]
+
+def test_negotiate_with_old_peer():
+    server = Peer()
+    # a peer that only knows json, or names nothing we know, keeps json
+    server.dataReceived(frame(Commands.NEGOTIATE_REQ, {'codecs': ['json']}))
+    assert server.codec is JSONCodec and server.compression is None
+    server = Peer()
+    server.dataReceived(frame(Commands.NEGOTIATE_REQ, {'codecs': ['bson']}))
+    assert server.codec is JSONCodec
+
+def test_negotiate_without_msgpack(monkeypatch):
+    import codec
+    monkeypatch.setattr(codec, 'CODECS', [JSONCodec])
+    assert codec.negotiate_codec(['msgpack', 'json']) is JSONCodec
+    assert codec.negotiate_codec(None) is JSONCodec
+
+def compressing(threshold): # type: (int)->Peer
+    peer = Peer()
+    peer.compression = ZlibCompression()
+    peer.compress_threshold = threshold
+    return peer
+
+def flags(data): # type: (bytes)->int
+    return FRAME_HEADER.unpack_from(data)[0] & FRAME_FLAG_MASK
+
+def test_compress_threshold():
+    request = make_request(1, 'x' * 1000)
+    size = len(JSONCodec.encode(request))
+    assert not flags(compressing(size + 1).encode_frame(request)) & FRAME_FLAG_COMPRESSED
+    data = compressing(size).encode_frame(request)
+    assert flags(data) & FRAME_FLAG_COMPRESSED and len(data) < size
+    assert not flags(compressing(0).encode_frame(request)) & FRAME_FLAG_COMPRESSED # zero turns it off
+    peer = Peer()
+    peer.dataReceived(data)
+    assert peer.received[0]['data'] == 'x' * 1000
+
+def test_incompressible_frame_sent_as_is():
+    request = make_request(1)
+    data = compressing(1).encode_frame(request)
+    assert not flags(data) & FRAME_FLAG_COMPRESSED
+    assert data[FRAME_HEADER_SIZE:] == JSONCodec.encode(request)
+
+def test_decompressed_size_limit():
+    data = compressing(1).encode_frame(make_request(1, 'x' * 10000))
+    peer = Peer()
+    peer.max_frame_size = 4096
+    peer.dataReceived(data)
+    assert not peer.received and peer.errors[0].startswith('bad compressed frame')
+
+def stalled(high=100, low=40, max_size=1000): # type: (int, int, int)->tuple[Peer, SendQueue, task.Clock]
+    peer, clock = Peer(), task.Clock()
+    queue = peer.send_queue = SendQueue(peer, clock=clock)
+    queue.high_watermark, queue.low_watermark, queue.max_size, queue.overflow_timeout = high, low, max_size, 5.0
+    queue.write(b'x' * 10)
+    queue.pauseProducing() # the transport buffer is full
+    return peer, queue, clock
+
+def test_send_queue_drains_below_low_watermark():
+    peer, queue, clock = stalled()
+    for _ in range(3): queue.write(b'x' * 50, command=1)
+    assert queue.size == 150 and clock.getDelayedCalls()
+    drained = queue.drained()
+    assert not drained.called
+    queue.resumeProducing()
+    assert drained.called and queue.size == 0 and not clock.getDelayedCalls()
+    assert len(peer.transport.value()) == 160
+    assert not peer.transport.disconnecting
+
+def test_slow_peer_disconnected_after_timeout():
+    peer, queue, clock = stalled()
+    for _ in range(3): queue.write(b'x' * 50, command=1)
+    clock.advance(4.9)
+    assert not peer.transport.disconnecting
+    clock.advance(0.1)
+    assert peer.transport.disconnected and queue.size == 0
+
+def test_slow_peer_disconnected_over_max_size():
+    peer, queue, clock = stalled()
+    for _ in range(25): queue.write(b'x' * 50, command=1)
+    assert peer.transport.disconnected and not clock.getDelayedCalls()
+
+def test_droppable_frames_go_first():
+    peer, queue, clock = stalled()
+    queue.write(b'b' * 60, command=Commands.BROADCAST_NOTIFY)
+    queue.write(b'r' * 60, command=1)
+    assert queue.dropped == 1 and queue.size == 60 and not clock.getDelayedCalls()
+    queue.resumeProducing()
+    assert peer.transport.value() == b'x' * 10 + b'r' * 60
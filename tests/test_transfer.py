@@ -0,0 +1,76 @@
+import os, zlib
+import pytest
+import transfer
+from shared import Commands, Exceptions
+from transfer import ArtifactReceiver, TransferManager
+
+class FakeConnection(object):
+    def __init__(self):
+        self.sent = [] # type: list[dict]
+        self.peer_features = set()
+
+    def send(self, command, data=None, retcode=0, info=''):
+        self.sent.append({'command': command, 'data': data, 'retcode': retcode, 'info': info})
+
+    def log(self, level, message, *args, **fields): pass
+
+def put(manager, key, name='build/app.ipa', size=1024):
+    manager.handle({'command': Commands.ARTIFACT_PUT_REQ, 'data': {'key': key, 'name': name, 'size': size}})
+    return manager.connection.sent[-1]
+
+def test_receiver_per_partial(tmpdir):
+    path = os.path.join(str(tmpdir), 'app.ipa')
+    receiver = ArtifactReceiver(path, 'app.ipa')
+    with pytest.raises(IOError):
+        ArtifactReceiver(path, 'app.ipa')
+    receiver.close()
+    ArtifactReceiver(path, 'app.ipa').close()
+
+def test_concurrent_uploads_of_a_name(tmpdir):
+    first, second = TransferManager(FakeConnection(), str(tmpdir)), TransferManager(FakeConnection(), str(tmpdir))
+    accepted = put(first, key=1)
+    assert accepted['retcode'] == 0 and accepted['data']['offset'] == 0
+    refused = put(second, key=7)
+    assert refused['retcode'] == Exceptions.ARTIFACT_BUSY and refused['data'] == {'key': 7}
+    assert put(second, key=8, name='build/other.ipa')['retcode'] == 0
+    # once the first connection is gone the name can be uploaded again and resumes from its part file
+    first.close()
+    second.close()
+    third = TransferManager(FakeConnection(), str(tmpdir))
+    assert put(third, key=9)['retcode'] == 0
+    third.close()
+
+def receive(path, data):
+    receiver = ArtifactReceiver(path, 'app.ipa')
+    assert receiver.write(receiver.offset, zlib.crc32(data), data)
+    return receiver
+
+def test_resume_from_saved_crc(tmpdir):
+    path = os.path.join(str(tmpdir), 'app.ipa')
+    receive(path, b'a' * 100).close()
+    receiver = ArtifactReceiver(path, 'app.ipa')
+    assert (receiver.offset, receiver.crc) == (100, zlib.crc32(b'a' * 100))
+    receiver.close()
+
+def test_leftover_without_crc_restarts(tmpdir):
+    path = os.path.join(str(tmpdir), 'app.ipa')
+    with open(path + '.part', 'wb') as fp: fp.write(b'a' * 100)
+    receiver = ArtifactReceiver(path, 'app.ipa')
+    assert (receiver.offset, receiver.crc) == (0, 0) and os.path.getsize(path + '.part') == 0
+    receiver.close()
+
+def test_bytes_past_the_saved_crc_dropped(tmpdir, monkeypatch):
+    monkeypatch.setattr(transfer, 'CRC_CHECKPOINT_INTERVAL', 64)
+    path = os.path.join(str(tmpdir), 'app.ipa')
+    receiver = receive(path, b'a' * 100)
+    assert receiver.write(100, zlib.crc32(b'b' * 10), b'b' * 10)
+    # the process dies here, the last 10 bytes were never covered by a saved crc
+    os.close(receiver.fd)
+    ArtifactReceiver.partials.discard(os.path.abspath(path) + '.part')
+    receiver = ArtifactReceiver(path, 'app.ipa')
+    assert (receiver.offset, receiver.crc) == (100, zlib.crc32(b'a' * 100)) and os.path.getsize(path + '.part') == 100
+    receiver.write(100, zlib.crc32(b'c'), b'c')
+    receiver.size = 101
+    receiver.finish()
+    assert not os.path.exists(path + '.part.crc')
+    with open(path, 'rb') as fp: assert fp.read() == b'a' * 100 + b'c'
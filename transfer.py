@@ -0,0 +1,375 @@
+#!/usr/bin/env python3
+from twisted.internet import reactor, defer
+from shared import *
+import os, zlib, json, posixpath
+
+__author__ = 'larryhou'
+
+CRC_BLOCK_SIZE = 1 << 20
+CRC_CHECKPOINT_INTERVAL = 8 << 20 # bytes received between saves of the running crc, a crash costs at most this much
+
+def safe_name(name): # type: (str)->str
+    name = posixpath.normpath(str(name or '').replace('\\', '/')).lstrip('/')
+    if not name or name == '.' or name.split('/')[0] == '..': raise ValueError('bad artifact name {!r}'.format(name))
+    return name
+
+def file_crc(fd, size, crc=0): # type: (int, int, int)->int
+    offset = 0
+    while offset < size:
+        block = os.pread(fd, min(CRC_BLOCK_SIZE, size - offset), offset)
+        if not block: break
+        crc = zlib.crc32(block, crc)
+        offset += len(block)
+    return crc
+
+def load_checkpoint(path): # type: (str)->tuple[int, int]
+    try:
+        with open(path, 'r', encoding='utf-8') as fp:
+            checkpoint = json.load(fp)
+        return int(checkpoint['offset']), int(checkpoint['crc32'])
+    except (IOError, OSError, ValueError, KeyError, TypeError):
+        return None
+
+def save_checkpoint(path, offset, crc): # type: (str, int, int)->None
+    temp = path + '.tmp'
+    with open(temp, 'w', encoding='utf-8') as fp:
+        json.dump({'offset': offset, 'crc32': crc}, fp)
+    os.replace(temp, path)
+
+def remove_file(path): # type: (str)->None
+    if os.path.exists(path): os.remove(path)
+
+def error_text(name, error): # type: (str, Exception)->str
+    # never hand out local paths, the peer only knows the artifact name
+    return '{}: {}'.format(name, error.strerror) if isinstance(error, OSError) and error.strerror else str(error)
+
+class ArtifactSender(object):
+    # reads each chunk at its offset when it is due, a file of any size costs one chunk of memory
+    def __init__(self, path, name, key=0):
+        self.path = path # type: str
+        self.name = name # type: str
+        self.key = key
+        self.id = None # type: int
+        self.fd = os.open(path, os.O_RDONLY)
+        self.size = os.fstat(self.fd).st_size
+        self.offset = 0
+        self.crc = 0
+        self.deferred = None # type: defer.Deferred
+
+    def seek(self, offset, crc): # type: (int, int)->int
+        # the receiver keeps what it verified, continue after it unless our copy of that prefix differs
+        offset = int(offset or 0)
+        if 0 < offset <= self.size and file_crc(self.fd, offset) == crc:
+            self.offset, self.crc = offset, crc
+        else:
+            self.offset, self.crc = 0, 0
+        return self.offset
+
+    @property
+    def pending(self): return self.offset < self.size
+
+    def next_chunk(self, chunk_size): # type: (int)->bytes
+        data = os.pread(self.fd, min(chunk_size, self.size - self.offset), self.offset)
+        if not data: raise IOError('{} shrank to {} bytes while sending'.format(self.path, self.offset))
+        crc = zlib.crc32(data)
+        frame = TCP.encode_chunk(self.id, self.offset, crc, data)
+        self.offset += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        return frame
+
+    def describe(self): # type: ()->dict
+        return {'name': self.name, 'size': self.size, 'crc32': self.crc}
+
+    def close(self):
+        if self.fd is None: return
+        os.close(self.fd)
+        self.fd = None
+
+class ArtifactReceiver(object):
+    # chunks land in a .part file that survives the connection, a later transfer of the same name resumes from it
+    partials = set() # type: set[str]
+
+    @staticmethod
+    def busy(path): # type: (str)->bool
+        # one receiver per .part file across all connections, a second one would write over the first
+        return os.path.abspath(path) + '.part' in ArtifactReceiver.partials
+
+    def __init__(self, path, name, id=0):
+        self.path = path # type: str
+        self.name = name # type: str
+        self.id = id
+        self.size = 0
+        self.offset = 0
+        self.crc = 0
+        self.deferred = None # type: defer.Deferred
+        self.__partial = os.path.abspath(path) + '.part'
+        self.__checkpoint = self.__partial + '.crc'
+        self.__checkpoint_offset = 0
+        if self.__partial in self.partials: raise IOError('{} is being received already'.format(name))
+        directory = os.path.dirname(path)
+        if directory and not os.path.exists(directory): os.makedirs(directory)
+        self.fd = os.open(self.__partial, os.O_RDWR | os.O_CREAT, 0o644)
+        self.partials.add(self.__partial)
+        # hashing a large leftover would stall the reactor, resume from the crc saved with it and drop what came after
+        size = os.fstat(self.fd).st_size
+        checkpoint = load_checkpoint(self.__checkpoint) if size else None
+        if checkpoint and 0 < checkpoint[0] <= size:
+            self.offset, self.crc = checkpoint
+            self.__checkpoint_offset = self.offset
+            if size > self.offset: os.ftruncate(self.fd, self.offset)
+        elif size: self.restart()
+
+    def restart(self):
+        os.ftruncate(self.fd, 0)
+        self.offset, self.crc = 0, 0
+        self.__checkpoint_offset = 0
+        remove_file(self.__checkpoint)
+
+    def __save_checkpoint(self):
+        save_checkpoint(self.__checkpoint, self.offset, self.crc)
+        self.__checkpoint_offset = self.offset
+
+    def write(self, offset, crc, data): # type: (int, int, memoryview)->bool
+        if offset == 0 and self.offset: self.restart()
+        if offset != self.offset: return False # in flight before a seek, the sender is coming back
+        if zlib.crc32(data) != crc:
+            METRICS.inc('artifact_chunk_errors')
+            return False
+        os.pwrite(self.fd, data, offset)
+        self.offset += len(data)
+        self.crc = zlib.crc32(data, self.crc)
+        METRICS.inc('artifact_bytes', label='in', value=len(data))
+        if self.offset - self.__checkpoint_offset >= CRC_CHECKPOINT_INTERVAL: self.__save_checkpoint()
+        return True
+
+    @property
+    def complete(self): return self.offset >= self.size
+
+    def finish(self):
+        self.partials.discard(self.__partial)
+        os.ftruncate(self.fd, self.offset)
+        os.close(self.fd)
+        self.fd = None
+        os.replace(self.__partial, self.path)
+        remove_file(self.__checkpoint)
+
+    def describe(self): # type: ()->dict
+        return {'name': self.name, 'size': self.offset, 'crc32': self.crc}
+
+    def close(self):
+        if self.fd is None: return
+        os.close(self.fd)
+        self.fd = None
+        self.partials.discard(self.__partial)
+        if self.offset:
+            if self.offset != self.__checkpoint_offset: self.__save_checkpoint()
+        else:
+            remove_file(self.__partial)
+            remove_file(self.__checkpoint)
+
+class TransferManager(object):
+    # moves files over one connection: the receiver allocates transfer ids and tells where to resume,
+    # the sender streams raw chunk frames round robin between its transfers whenever the send queue is idle
+    def __init__(self, connection, directory=None, chunk_size=ARTIFACT_CHUNK_SIZE):
+        self.connection = connection # type: TCP
+        self.directory = directory # type: str
+        self.chunk_size = chunk_size
+        self.__sequence = 0
+        self.__uploads = {} # type: dict[int, ArtifactSender]
+        self.__senders = {} # type: dict[int, ArtifactSender]
+        self.__active = collections.deque() # type: collections.deque[ArtifactSender]
+        self.__receivers = {} # type: dict[int, ArtifactReceiver]
+        self.__pumping = False
+
+    def __next_id(self):
+        self.__sequence += 1
+        return self.__sequence
+
+    def __local_path(self, name): # type: (str)->str
+        if not self.directory: raise IOError('artifact transfer disabled')
+        return os.path.join(self.directory, *safe_name(name).split('/'))
+
+    def upload(self, path, name=None): # type: (str, str)->defer.Deferred
+        if FEATURE_ARTIFACT_TRANSFER not in self.connection.peer_features:
+            return defer.fail(IOError('peer does not accept artifacts'))
+        try:
+            sender = ArtifactSender(path, safe_name(name or os.path.basename(path)), key=self.__next_id())
+        except (IOError, OSError, ValueError) as error:
+            return defer.fail(error)
+        sender.deferred = defer.Deferred(canceller=lambda _: self.__drop_sender(sender))
+        self.__uploads[sender.key] = sender
+        self.connection.send(command=Commands.ARTIFACT_PUT_REQ, data={'key': sender.key, 'name': sender.name, 'size': sender.size})
+        return sender.deferred
+
+    def download(self, name, path): # type: (str, str)->defer.Deferred
+        if FEATURE_ARTIFACT_TRANSFER not in self.connection.peer_features:
+            return defer.fail(IOError('peer does not serve artifacts'))
+        try:
+            receiver = ArtifactReceiver(path, safe_name(name), id=self.__next_id())
+        except (IOError, OSError, ValueError) as error:
+            return defer.fail(error)
+        receiver.deferred = defer.Deferred(canceller=lambda _: self.__drop_receiver(receiver))
+        self.__receivers[receiver.id] = receiver
+        self.connection.send(command=Commands.ARTIFACT_GET_REQ, data={'id': receiver.id, 'name': receiver.name,
+                                                                      'offset': receiver.offset, 'crc32': receiver.crc})
+        return receiver.deferred
+
+    def handle(self, msg): # type: (dict)->None
+        command, retcode, payload = msg.get('command'), msg.get('retcode'), msg.get('data') or {}
+        info = (payload.get('error') or {}).get('info')
+        try:
+            if command == Commands.ARTIFACT_PUT_REQ: self.__accept_upload(payload)
+            elif command == Commands.ARTIFACT_PUT_RSP: self.__start_upload(payload, retcode, info)
+            elif command == Commands.ARTIFACT_GET_REQ: self.__serve_download(payload)
+            elif command == Commands.ARTIFACT_GET_RSP: self.__start_download(payload, retcode, info)
+            elif command == Commands.ARTIFACT_SEEK_NOTIFY: self.__seek(payload)
+            elif command == Commands.ARTIFACT_DONE_NOTIFY: self.__done(payload)
+        except (IOError, OSError) as error:
+            self.connection.log(WARNING, 'artifact {} failed: {}', Commands.name(command), error)
+
+    def __accept_upload(self, payload): # type: (dict)->None
+        reply = {'key': payload.get('key')}
+        try:
+            path = self.__local_path(payload.get('name'))
+            if ArtifactReceiver.busy(path):
+                self.connection.send(command=Commands.ARTIFACT_PUT_RSP, data=reply, retcode=Exceptions.ARTIFACT_BUSY,
+                                     info='{} is being uploaded by another slave'.format(payload.get('name')))
+                return
+            receiver = ArtifactReceiver(path, safe_name(payload.get('name')), id=self.__next_id())
+        except (IOError, OSError, ValueError) as error:
+            self.connection.send(command=Commands.ARTIFACT_PUT_RSP, data=reply, retcode=Exceptions.ARTIFACT_FAILED,
+                                 info=error_text(payload.get('name'), error))
+            return
+        receiver.size = int(payload.get('size') or 0)
+        # a full sized leftover cannot be told apart from a different file, only resume real prefixes
+        if receiver.offset and receiver.offset >= receiver.size: receiver.restart()
+        self.__receivers[receiver.id] = receiver
+        reply.update(id=receiver.id, offset=receiver.offset, crc32=receiver.crc)
+        self.connection.log(INFO, 'artifact upload {} size={} resume={}', receiver.name, receiver.size, receiver.offset)
+        self.connection.send(command=Commands.ARTIFACT_PUT_RSP, data=reply)
+        self.__check(receiver)
+
+    def __start_upload(self, payload, retcode, info): # type: (dict, int, str)->None
+        sender = self.__uploads.pop(payload.get('key'), None)
+        if not sender: return
+        if retcode:
+            sender.close()
+            sender.deferred.errback(IOError(info or 'artifact refused'))
+            return
+        sender.id = payload.get('id')
+        sender.seek(payload.get('offset'), payload.get('crc32'))
+        self.__senders[sender.id] = sender
+        self.__activate(sender)
+
+    def __serve_download(self, payload): # type: (dict)->None
+        reply = {'id': payload.get('id')}
+        try:
+            sender = ArtifactSender(self.__local_path(payload.get('name')), safe_name(payload.get('name')))
+        except (IOError, OSError, ValueError) as error:
+            self.connection.send(command=Commands.ARTIFACT_GET_RSP, data=reply, retcode=Exceptions.ARTIFACT_FAILED,
+                                 info=error_text(payload.get('name'), error))
+            return
+        sender.id = payload.get('id')
+        reply.update(size=sender.size, offset=sender.seek(payload.get('offset'), payload.get('crc32')))
+        self.__senders[sender.id] = sender
+        self.connection.send(command=Commands.ARTIFACT_GET_RSP, data=reply)
+        self.__activate(sender)
+
+    def __start_download(self, payload, retcode, info): # type: (dict, int, str)->None
+        receiver = self.__receivers.get(payload.get('id'))
+        if not receiver: return
+        if retcode:
+            self.__drop_receiver(receiver)
+            receiver.deferred.errback(IOError(info or 'artifact not served'))
+            return
+        receiver.size = int(payload.get('size') or 0)
+        if payload.get('offset') != receiver.offset: receiver.restart()
+        self.__check(receiver)
+
+    def __seek(self, payload): # type: (dict)->None
+        sender = self.__senders.get(payload.get('id'))
+        if not sender: return
+        sender.seek(payload.get('offset'), payload.get('crc32'))
+        self.__activate(sender)
+
+    def __done(self, payload): # type: (dict)->None
+        sender = self.__senders.get(payload.get('id'))
+        if not sender: return
+        self.__drop_sender(sender)
+        result = sender.describe()
+        if payload.get('size') != sender.size or payload.get('crc32') != sender.crc:
+            error = IOError('artifact {} arrived as {} bytes crc32={}'.format(sender.name, payload.get('size'), payload.get('crc32')))
+            if sender.deferred: sender.deferred.errback(error)
+            return
+        if sender.deferred: sender.deferred.callback(result)
+
+    def chunk_received(self, transfer, offset, crc, data): # type: (int, int, int, memoryview)->None
+        receiver = self.__receivers.get(transfer)
+        if not receiver: return
+        if receiver.write(offset, crc, data):
+            self.__check(receiver)
+        elif offset == receiver.offset:
+            self.connection.log(WARNING, 'artifact {} bad chunk at {}, resend', receiver.name, offset)
+            self.connection.send(command=Commands.ARTIFACT_SEEK_NOTIFY, data={'id': receiver.id, 'offset': receiver.offset, 'crc32': receiver.crc})
+
+    def __check(self, receiver): # type: (ArtifactReceiver)->None
+        if not receiver.complete: return
+        del self.__receivers[receiver.id]
+        receiver.finish()
+        result = receiver.describe()
+        self.connection.log(INFO, 'artifact {} received size={} crc32={}', receiver.name, receiver.offset, receiver.crc)
+        self.connection.send(command=Commands.ARTIFACT_DONE_NOTIFY, data=dict(result, id=receiver.id))
+        if receiver.deferred: receiver.deferred.callback(dict(result, path=receiver.path))
+
+    def __activate(self, sender): # type: (ArtifactSender)->None
+        if sender not in self.__active: self.__active.append(sender)
+        if not self.__pumping:
+            self.__pumping = True
+            reactor.callLater(0, self.__pump)
+
+    def __pump(self):
+        self.__pumping = False
+        queue, budget = self.connection.send_queue, ARTIFACT_BURST_SIZE
+        # one chunk per transfer in turn, and only while nothing else waits to be sent
+        while self.__active and budget > 0 and self.connection.transport and not queue.paused and not len(queue):
+            sender = self.__active.popleft()
+            if not sender.pending: continue
+            try:
+                frame = sender.next_chunk(self.chunk_size)
+            except (IOError, OSError) as error:
+                self.__drop_sender(sender)
+                if sender.deferred: sender.deferred.errback(error)
+                continue
+            self.connection.write_frame(frame)
+            METRICS.inc('artifact_bytes', label='out', value=len(frame) - FRAME_HEADER_SIZE - CHUNK_HEADER.size)
+            budget -= len(frame)
+            if sender.pending: self.__active.append(sender)
+        if not self.__active or not self.connection.transport: return
+        self.__pumping = True
+        if budget <= 0: reactor.callLater(0, self.__pump) # let the reactor read before the next burst
+        else: queue.writable().addCallback(lambda _: self.__pump())
+
+    def __drop_sender(self, sender): # type: (ArtifactSender)->None
+        self.__uploads.pop(sender.key, None)
+        if self.__senders.get(sender.id) is sender: del self.__senders[sender.id]
+        if sender in self.__active: self.__active.remove(sender)
+        sender.close()
+
+    def __drop_receiver(self, receiver): # type: (ArtifactReceiver)->None
+        if self.__receivers.get(receiver.id) is receiver: del self.__receivers[receiver.id]
+        receiver.close()
+
+    def describe(self): # type: ()->dict
+        return {'sending': [dict(x.describe(), offset=x.offset) for x in self.__senders.values()],
+                'receiving': [dict(x.describe(), expected=x.size) for x in self.__receivers.values()]}
+
+    def close(self):
+        # partial files stay on disk, the next transfer of the same name picks up where this one stopped
+        error = IOError('connection lost')
+        for sender in list(self.__uploads.values()) + list(self.__senders.values()):
+            self.__drop_sender(sender)
+            if sender.deferred and not sender.deferred.called: sender.deferred.errback(error)
+        for receiver in list(self.__receivers.values()):
+            self.__drop_receiver(receiver)
+            if receiver.deferred and not receiver.deferred.called: receiver.deferred.errback(error)
+        self.__active.clear()